@@ -0,0 +1,95 @@
+"""Benchmark fuzzy matching every pattern against every doc with spaczz's
+FuzzyMatcher vs. only the candidates from the character q-gram index, on a
+synthetic product catalogue. Run from the repository root:
+
+    python -m benchmarks.fuzzy_candidates --n-patterns 5000
+"""
+import random
+import string
+from argparse import ArgumentParser, RawTextHelpFormatter
+from time import perf_counter
+
+import spacy
+from spaczz.matcher import FuzzyMatcher
+
+from components.fuzzy import CandidateFuzzyMatcher
+
+
+BRANDS = ["acme", "globex", "initech", "umbrella", "hooli", "stark", "wayne", "wonka"]
+PRODUCTS = ["blender", "kettle", "toaster", "headphones", "monitor", "keyboard",
+            "drill", "vacuum", "router", "camera", "speaker", "charger"]
+FILLER = ("we ordered the {} last week and it arrived with a broken box , "
+          "so please check whether the {} can be replaced soon")
+
+
+def make_patterns(n_patterns, rng):
+    patterns = set()
+    while len(patterns) < n_patterns:
+        model = "".join(rng.choice(string.ascii_lowercase) for _ in range(3))
+        number = rng.randint(100, 9999)
+        patterns.add(f"{rng.choice(BRANDS)} {rng.choice(PRODUCTS)} {model}{number}")
+    return sorted(patterns)
+
+
+def add_typo(text, rng):
+    i = rng.randrange(len(text))
+    return text[:i] + rng.choice(string.ascii_lowercase) + text[i + 1:]
+
+
+def make_texts(patterns, n_texts, rng):
+    return [FILLER.format(add_typo(rng.choice(patterns), rng), rng.choice(patterns))
+            for _ in range(n_texts)]
+
+
+def get_matches(matcher, docs):
+    start_time = perf_counter()
+    matches = [{match[:3] for match in matcher(doc)} for doc in docs]
+    return matches, (perf_counter() - start_time) / len(docs)
+
+
+def main(n_patterns, n_texts, min_share, seed):
+    rng = random.Random(seed)
+    nlp = spacy.blank("en")
+    patterns = make_patterns(n_patterns, rng)
+    docs = list(nlp.pipe(make_texts(patterns, n_texts, rng)))
+    pattern_docs = [(i, doc) for i, doc in enumerate(nlp.pipe(patterns))]
+
+    full_matcher = FuzzyMatcher(nlp.vocab)
+    for key, pattern_doc in pattern_docs:
+        full_matcher.add(key, [pattern_doc], kwargs=[{"ignorecase": True}])
+    start_time = perf_counter()
+    candidate_matcher = CandidateFuzzyMatcher(nlp.vocab, pattern_docs, min_share=min_share,
+                                              kwargs={"ignorecase": True})
+    index_time = perf_counter() - start_time
+
+    full_matches, full_time = get_matches(full_matcher, docs)
+    candidate_matches, candidate_time = get_matches(candidate_matcher, docs)
+    n_full = sum(len(m) for m in full_matches)
+    n_found = sum(len(f & c) for f, c in zip(full_matches, candidate_matches))
+    n_candidates = sum(len(candidate_matcher.index.candidates(doc.text)) for doc in docs)
+    print(f"patterns: {n_patterns}, texts: {n_texts}, min share: {min_share}")
+    print(f"index built in {index_time:.2f} s, "
+          f"{n_candidates / len(docs):.1f} candidate patterns per text")
+    print(f"{'full FuzzyMatcher':<24} {full_time * 1000:>10.2f} ms/text")
+    print(f"{'q-gram candidates':<24} {candidate_time * 1000:>10.2f} ms/text")
+    print(f"speedup: {full_time / candidate_time:.1f}x, "
+          f"recall: {n_found}/{n_full} matches of the full matcher")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Fuzzy matching candidate index benchmark",
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument("--n-patterns", "-p",
+                        help="Number of catalogue patterns. Default 2000",
+                        type=int, metavar="", default=2000)
+    parser.add_argument("--n-texts", "-n",
+                        help="Number of texts to match. Default 20",
+                        type=int, metavar="", default=20)
+    parser.add_argument("--min-share", "-m",
+                        help="Minimum share of shared 3-grams for candidates. Default 0.5",
+                        type=float, metavar="", default=0.5)
+    parser.add_argument("--seed", "-s",
+                        help="Random seed. Default 0",
+                        type=int, metavar="", default=0)
+    args = parser.parse_args()
+    main(args.n_patterns, args.n_texts, args.min_share, args.seed)
@@ -0,0 +1,85 @@
+"""Benchmark creating tasks with copy.deepcopy vs. the shallow, copy-on-write
+derive_task helper. Run from the repository root:
+
+    python -m benchmarks.task_copy --image-size 2
+"""
+import base64
+import copy
+import json
+import os
+import tracemalloc
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+from time import perf_counter
+
+from components.tasks import derive_task
+
+
+EXAMPLE_DATASETS = Path(__file__).parent.parent / "example-datasets"
+SPANS = [{"start": 0, "end": 5, "token_start": 0, "token_end": 0, "label": "ORG"}]
+
+
+def with_deepcopy(eg):
+    task = copy.deepcopy(eg)
+    task["spans"] = SPANS
+    return task
+
+
+def with_derive_task(eg):
+    return derive_task(eg, spans=SPANS)
+
+
+def measure(make_task, examples, n_iter):
+    """Return the average time per task in microseconds and the number of
+    bytes allocated per task."""
+    start_time = perf_counter()
+    for _ in range(n_iter):
+        for eg in examples:
+            make_task(eg)
+    time_per_task = (perf_counter() - start_time) / (n_iter * len(examples))
+    tracemalloc.start()
+    tasks = [make_task(eg) for eg in examples]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tasks
+    return time_per_task * 1e6, allocated / len(examples)
+
+
+def load_examples(path):
+    with Path(path).open("r", encoding="utf8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_image_examples(n_examples, size_mb):
+    data = base64.b64encode(os.urandom(int(size_mb * 1024 * 1024 * 3 / 4)))
+    image = "data:image/jpeg;base64," + data.decode("ascii")
+    return [{"image": image, "meta": {"file": f"{i}.jpg"}} for i in range(n_examples)]
+
+
+def main(image_size, n_images, n_iter):
+    datasets = {p.name: load_examples(p) for p in sorted(EXAMPLE_DATASETS.glob("*.jsonl"))}
+    datasets[f"images ({image_size} MB base64)"] = make_image_examples(n_images, image_size)
+    row = "{:<58} {:>12} {:>12} {:>14} {:>14}"
+    print(row.format("dataset", "deepcopy µs", "derive µs", "deepcopy B", "derive B"))
+    for name, examples in datasets.items():
+        iters = 1 if name.startswith("images") else n_iter
+        copy_time, copy_mem = measure(with_deepcopy, examples, iters)
+        derive_time, derive_mem = measure(with_derive_task, examples, iters)
+        print(row.format(name, f"{copy_time:.2f}", f"{derive_time:.2f}",
+                         f"{copy_mem:.0f}", f"{derive_mem:.0f}"))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Task copy benchmark",
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument("--image-size", "-s",
+                        help="Size of the synthetic base64 images in MB. Default 2",
+                        type=float, metavar="", default=2.0)
+    parser.add_argument("--n-images", "-n",
+                        help="Number of synthetic image tasks. Default 200",
+                        type=int, metavar="", default=200)
+    parser.add_argument("--n-iter", "-i",
+                        help="Number of passes over the text datasets. Default 5",
+                        type=int, metavar="", default=5)
+    args = parser.parse_args()
+    main(args.image_size, args.n_images, args.n_iter)
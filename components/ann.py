@@ -0,0 +1,177 @@
+import hashlib
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from .util import get_cache_dir
+from .vectors import VectorTable, top_k
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+# Number of vectors sampled from the table to train the IVF cells
+IVF_TRAIN_PER_CELL = 64
+# Number of rows assigned to their cell at once while building the IVF index
+IVF_CHUNK_SIZE = 2 ** 16
+
+
+def get_table_hash(table: VectorTable, name: str = "") -> str:
+    """Hash identifying the contents of a vector table. The keys and shape are
+    hashed fully, the vectors are sampled, so hashing millions of vectors
+    doesn't take longer than loading them."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{name}\n{table.matrix.shape}".encode("utf8"))
+    h.update(table.orths.tobytes())
+    step = max(1, len(table) // 4096)
+    h.update(np.ascontiguousarray(table.matrix[::step]).tobytes())
+    return h.hexdigest()
+
+
+class IVFIndex:
+    """Inverted-file index over the unit-normalised vectors of a table, built
+    with spherical k-means in NumPy. A query only scores the vectors in the
+    `n_probe` cells whose centroids are closest to the query vector.
+    """
+
+    def __init__(self, matrix: np.ndarray, centroids: np.ndarray, rows: np.ndarray,
+                 offsets: np.ndarray, n_probe: int = 16):
+        self.matrix = matrix
+        self.centroids = centroids
+        # Row indices of the table sorted by cell, cell i being
+        # rows[offsets[i]:offsets[i + 1]]
+        self.rows = rows
+        self.offsets = offsets
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, n_cells: Optional[int] = None,
+              n_iter: int = 10, seed: int = 0) -> "IVFIndex":
+        n_rows = matrix.shape[0]
+        if n_cells is None:
+            n_cells = max(1, int(np.sqrt(n_rows)))
+        n_cells = min(n_cells, n_rows)
+        rng = np.random.RandomState(seed)
+        n_train = min(n_rows, n_cells * IVF_TRAIN_PER_CELL)
+        sample = matrix[np.sort(rng.choice(n_rows, n_train, replace=False))]
+        centroids = sample[rng.choice(n_train, n_cells, replace=False)].copy()
+        for _ in range(n_iter):
+            assigned = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assigned, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Keep the previous centroid for cells that ended up empty
+            empty = norms[:, 0] == 0
+            sums[empty] = centroids[empty]
+            norms[empty] = 1.0
+            centroids = (sums / norms).astype("float32")
+        cells = np.empty((n_rows,), dtype="int64")
+        for start in range(0, n_rows, IVF_CHUNK_SIZE):
+            chunk = matrix[start : start + IVF_CHUNK_SIZE]
+            cells[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+        rows = np.argsort(cells, kind="stable")
+        offsets = np.zeros((n_cells + 1,), dtype="int64")
+        np.cumsum(np.bincount(cells, minlength=n_cells), out=offsets[1:])
+        return cls(matrix, centroids, rows, offsets)
+
+    @classmethod
+    def load(cls, path: Path, matrix: np.ndarray) -> "IVFIndex":
+        with np.load(path) as data:
+            return cls(matrix, data["centroids"], data["rows"], data["offsets"])
+
+    def save(self, path: Path) -> None:
+        with path.open("wb") as f:
+            np.savez(f, centroids=self.centroids, rows=self.rows, offsets=self.offsets)
+
+    def query(self, vector: np.ndarray, k: int,
+              mask: Optional[np.ndarray] = None) -> np.ndarray:
+        cell_order = np.argsort(-(self.centroids @ vector))
+        candidates = []
+        n_found = 0
+        # Probe at least n_probe cells, and more until there are k candidates
+        for n_probed, cell in enumerate(cell_order):
+            if n_probed >= self.n_probe and n_found >= k:
+                break
+            rows = self.rows[self.offsets[cell] : self.offsets[cell + 1]]
+            if mask is not None:
+                rows = rows[mask[rows]]
+            candidates.append(rows)
+            n_found += len(rows)
+        rows = np.concatenate(candidates) if candidates else np.zeros((0,), dtype="int64")
+        scores = self.matrix[rows] @ vector
+        return rows[top_k(scores, k)]
+
+
+class HNSWIndex:
+    """HNSW graph index via hnswlib, using the inner product of the
+    unit-normalised vectors, i.e. the cosine similarity."""
+
+    def __init__(self, index, n_rows: int):
+        self.index = index
+        self.n_rows = n_rows
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, m: int = 16, ef_construction: int = 200) -> "HNSWIndex":
+        index = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        index.init_index(max_elements=matrix.shape[0], M=m, ef_construction=ef_construction)
+        index.add_items(matrix, np.arange(matrix.shape[0]))
+        return cls(index, matrix.shape[0])
+
+    @classmethod
+    def load(cls, path: Path, matrix: np.ndarray) -> "HNSWIndex":
+        index = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        index.load_index(str(path), max_elements=matrix.shape[0])
+        return cls(index, matrix.shape[0])
+
+    def save(self, path: Path) -> None:
+        self.index.save_index(str(path))
+
+    def query(self, vector: np.ndarray, k: int,
+              mask: Optional[np.ndarray] = None) -> np.ndarray:
+        n_wanted = min(k, self.n_rows if mask is None else int(mask.sum()))
+        n_query = min(k, self.n_rows)
+        while True:
+            self.index.set_ef(max(n_query, 64))
+            labels, _ = self.index.knn_query(vector, k=n_query)
+            rows = labels[0].astype("int64")
+            if mask is not None:
+                rows = rows[mask[rows]]
+            if len(rows) >= n_wanted or n_query == self.n_rows:
+                return rows[:k]
+            # Too many of the neighbours were masked, so fetch more of them
+            n_query = min(n_query * 2, self.n_rows)
+
+
+BACKENDS = {"hnsw": HNSWIndex, "ivf": IVFIndex}
+
+
+def get_ann_index(
+    table: VectorTable,
+    name: str = "",
+    backend: Optional[str] = None,
+    cache_dir: Optional[Union[str, Path]] = None,
+):
+    """Load the approximate nearest-neighbour index for a vector table from
+    the cache, or build and cache it. Uses HNSW if hnswlib is installed and
+    falls back to the NumPy IVF index otherwise. The returned index has a
+    `query(vector, k, mask=None)` method returning the row indices of the
+    (approximately) k most similar vectors to the unit-normalised vector.
+    """
+    if backend is None:
+        backend = "hnsw" if hnswlib is not None else "ivf"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown ANN backend: {backend}. Available: {list(BACKENDS)}")
+    if backend == "hnsw" and hnswlib is None:
+        raise ValueError("The HNSW backend requires hnswlib: pip install hnswlib")
+    cls = BACKENDS[backend]
+    path = get_cache_dir("ann", cache_dir) / f"{get_table_hash(table, name)}.{backend}"
+    if path.exists():
+        return cls.load(path, table.matrix)
+    index = cls.build(table.matrix)
+    tmp_path = path.with_name(path.name + ".tmp")
+    index.save(tmp_path)
+    tmp_path.replace(path)
+    return index
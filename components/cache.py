@@ -0,0 +1,79 @@
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
+
+import srsly
+from spacy.language import Language
+
+from .util import get_cache_dir
+
+
+# Name of the SQLite database in the cache directory
+PREDICTIONS_DB = "predictions.sqlite"
+
+
+def get_model_fingerprint(nlp: Language) -> str:
+    """Hash identifying a pipeline and its weights, used to key cached
+    predictions. The vocab is excluded from the serialized pipeline, since it
+    grows while processing texts. Only the name and shape of the vectors are
+    included instead of the full table."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(nlp.to_bytes(exclude=["vocab"]))
+    vectors = nlp.vocab.vectors
+    h.update(f"{vectors.name}\n{vectors.shape}".encode("utf8"))
+    return h.hexdigest()
+
+
+class PredictionCache:
+    """On-disk cache of a model's predictions in a SQLite database, keyed by
+    the model fingerprint and the input hash of the example. Values are any
+    JSON-serializable data, e.g. the predicted spans.
+
+    The database is shared by all models and uses write-ahead logging, so
+    several caches can be read and written concurrently, e.g. from the
+    threads of the two models in ner.eval-ab.
+    """
+
+    def __init__(self, nlp: Language, cache_dir: Optional[Union[str, Path]] = None):
+        self.model = get_model_fingerprint(nlp)
+        self.path = get_cache_dir("predictions", cache_dir) / PREDICTIONS_DB
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "model TEXT NOT NULL, input_hash INTEGER NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (model, input_hash))"
+            )
+
+    def get_many(self, input_hashes: Iterable[int]) -> Dict[int, Any]:
+        """Get the cached values for the input hashes that are in the cache."""
+        input_hashes = list(set(input_hashes))
+        result = {}
+        with self._lock:
+            # Stay below SQLite's limit of host parameters per query
+            for i in range(0, len(input_hashes), 500):
+                batch = input_hashes[i : i + 500]
+                query = (
+                    "SELECT input_hash, value FROM predictions WHERE model = ? "
+                    f"AND input_hash IN ({', '.join('?' * len(batch))})"
+                )
+                for input_hash, value in self._conn.execute(query, [self.model, *batch]):
+                    result[input_hash] = srsly.json_loads(value)
+        return result
+
+    def set_many(self, items: Iterable[Tuple[int, Any]]) -> None:
+        """Add or replace the values for the given (input hash, value) items."""
+        rows = [(self.model, h, srsly.json_dumps(value)) for h, value in items]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO predictions (model, input_hash, value) VALUES (?, ?, ?)",
+                rows,
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
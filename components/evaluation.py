@@ -0,0 +1,128 @@
+import math
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import srsly
+from prodigy.util import TASK_HASH_ATTR
+
+
+def wilson_interval(successes: int, total: int, z: float = 1.96) -> Tuple[float, float]:
+    """Wilson score interval for a binomial proportion, by default the 95%
+    confidence interval. Unlike the normal approximation, it stays within
+    [0, 1] and is still meaningful for small samples."""
+    if total == 0:
+        return (0.0, 1.0)
+    p = successes / total
+    denominator = 1 + z ** 2 / total
+    center = (p + z ** 2 / (2 * total)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / total + z ** 2 / (4 * total ** 2)) / denominator
+    return (max(0.0, center - margin), min(1.0, center + margin))
+
+
+class ABTally:
+    """Running tally of the answers to A/B evaluation questions created with
+    the choice interface, updated with every batch of answers instead of
+    re-reading the dataset to report the results.
+
+    Only accepted answers with exactly one selected option are counted. If a
+    question is answered again, the latest answer wins. Questions are
+    identified by their task hash, since the ids are only unique within one
+    session.
+    """
+
+    def __init__(self, counts: Optional[Dict[str, int]] = None):
+        self.counts = Counter(counts or {})
+        self._selected = {}
+
+    @classmethod
+    def from_examples(cls, examples: Iterable[Dict[str, Any]]) -> "ABTally":
+        tally = cls()
+        tally.update(examples)
+        return tally
+
+    def update(self, answers: Iterable[Dict[str, Any]]) -> None:
+        for eg in answers:
+            if "answer" not in eg or "options" not in eg:
+                continue
+            selected = eg.get("accept", [])
+            if not selected or len(selected) != 1 or eg["answer"] != "accept":
+                continue
+            key = eg.get(TASK_HASH_ATTR, eg.get("id"))
+            previous = self._selected.get(key)
+            if previous is not None:
+                self.counts[previous] -= 1
+            self._selected[key] = selected[0]
+            self.counts[selected[0]] += 1
+
+    def to_dict(self) -> Dict[str, int]:
+        return {key: count for key, count in self.counts.items() if count}
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Counts per option and the share of A-vs-B decisions that preferred
+        each option, with 95% confidence intervals."""
+        n_decisions = self.counts["A"] + self.counts["B"]
+        metrics = {"counts": self.to_dict(), "decisions": n_decisions}
+        for key in ("A", "B"):
+            low, high = wilson_interval(self.counts[key], n_decisions)
+            share = self.counts[key] / n_decisions if n_decisions else None
+            metrics[key] = {"share": share, "ci95": [low, high]}
+        return metrics
+
+    def write_metrics(self, path: Union[str, Path]) -> None:
+        """Write the metrics to a JSON file. The file is replaced atomically,
+        so it can be polled while the server is running."""
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        srsly.write_json(tmp_path, self.get_metrics())
+        tmp_path.replace(path)
+
+
+class EloRatings:
+    """Elo ratings of a set of models, updated from pairwise preferences."""
+
+    def __init__(self, names: Iterable[str], k: float = 32.0, initial: float = 1000.0):
+        self.k = k
+        self.ratings = {name: initial for name in names}
+        self.wins = Counter()
+        self.games = Counter()
+
+    def expected(self, a: str, b: str) -> float:
+        """Expected probability that a is preferred over b."""
+        return 1.0 / (1.0 + 10 ** ((self.ratings[b] - self.ratings[a]) / 400))
+
+    def update(self, winner: str, loser: str) -> None:
+        delta = self.k * (1.0 - self.expected(winner, loser))
+        self.ratings[winner] += delta
+        self.ratings[loser] -= delta
+        self.wins[winner] += 1
+        self.games[winner] += 1
+        self.games[loser] += 1
+
+    def leaderboard(self) -> List[Tuple[str, float, int, int]]:
+        """(name, rating, wins, games) tuples sorted by descending rating."""
+        rows = [(name, r, self.wins[name], self.games[name]) for name, r in self.ratings.items()]
+        return sorted(rows, key=lambda row: -row[1])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"ratings": self.ratings, "wins": dict(self.wins), "games": dict(self.games)}
+
+    def restore(self, data: Dict[str, Any]) -> "EloRatings":
+        """Restore the ratings of the known models from a previous session."""
+        for name in self.ratings:
+            if name in data["ratings"]:
+                self.ratings[name] = data["ratings"][name]
+                self.wins[name] = data["wins"].get(name, 0)
+                self.games[name] = data["games"].get(name, 0)
+        return self
+
+    def write_metrics(self, path: Union[str, Path]) -> None:
+        """Write the leaderboard to a JSON file, replaced atomically."""
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        rows = [
+            {"model": name, "rating": rating, "wins": wins, "games": games}
+            for name, rating, wins, games in self.leaderboard()
+        ]
+        srsly.write_json(tmp_path, {"leaderboard": rows})
+        tmp_path.replace(path)
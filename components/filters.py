@@ -0,0 +1,168 @@
+import hashlib
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+from prodigy.util import set_hashes, INPUT_HASH_ATTR
+
+from .util import get_cache_dir
+
+
+# Merge the append-only log into the sorted index once it grows this large
+COMPACT_THRESHOLD = 2 ** 16
+
+
+def get_input_hash(eg: Dict[str, Any]) -> int:
+    """Get the input hash of an example, adding it if it's not set yet. Only
+    the input hash is added, so the task hash is still computed later on, once
+    the stream has added spans, options etc."""
+    if INPUT_HASH_ATTR not in eg:
+        eg[INPUT_HASH_ATTR] = set_hashes(dict(eg))[INPUT_HASH_ATTR]
+    return eg[INPUT_HASH_ATTR]
+
+
+class InputHashIndex:
+    """Persistent index of the input hashes saved in a dataset.
+
+    The hashes are stored as a sorted array of 64-bit integers in the cache
+    directory, plus an append-only log of the hashes added since the array was
+    last written. The index is keyed by the dataset's creation timestamp, so
+    it's rebuilt if the dataset is dropped and re-created. New answers are
+    added incrementally via `add`.
+
+    The index also stores the number of examples in the dataset it covers.
+    When it's loaded, `refresh` compares it to the dataset's current count,
+    which is a single cheap query, and only reads all input hashes again if
+    they differ, e.g. after answers were added by another session or via
+    db-in, or a save failed after the answers were added to the index. A
+    deletion followed by the same number of additions isn't detected, so the
+    index should only be used to pre-filter the stream, with Prodigy's own
+    `exclude_by: "input"` filter as the source of truth.
+    """
+
+    def __init__(self, db, dataset: str, cache_dir: Optional[Union[str, Path]] = None):
+        self.db = db
+        self.dataset = dataset
+        meta = db.get_meta(dataset) or {}
+        created = str(meta.get("created", ""))
+        key = hashlib.md5(f"{dataset}\n{created}".encode("utf8")).hexdigest()[:16]
+        cache_dir = get_cache_dir("input_hashes", cache_dir)
+        self.path = cache_dir / f"{key}.hashes"
+        self.log_path = cache_dir / f"{key}.hashes.log"
+        self.count_path = cache_dir / f"{key}.hashes.count"
+        self._new = set()
+        if self.path.exists() and self.count_path.exists():
+            self._hashes = self._read(self.path)
+            self.count = int(self.count_path.read_text())
+            if self.log_path.exists():
+                self._new.update(self._read(self.log_path))
+            if len(self._new) >= COMPACT_THRESHOLD:
+                self._compact()
+            self.refresh()
+        else:
+            self._rebuild(db.count_dataset(dataset))
+
+    def __contains__(self, input_hash: int) -> bool:
+        if input_hash in self._new:
+            return True
+        i = bisect_left(self._hashes, input_hash)
+        return i < len(self._hashes) and self._hashes[i] == input_hash
+
+    def __len__(self) -> int:
+        return len(self._hashes) + len(self._new)
+
+    def refresh(self) -> bool:
+        """Re-read the input hashes from the database if the dataset has more
+        or fewer examples than the index covers. Returns whether the index
+        was rebuilt."""
+        count = self.db.count_dataset(self.dataset)
+        if count == self.count:
+            return False
+        self._rebuild(count)
+        return True
+
+    def add(self, examples: List[Dict[str, Any]]) -> None:
+        """Add the input hashes of examples about to be saved to the index."""
+        hashes = array("q")
+        for eg in examples:
+            input_hash = eg.get(INPUT_HASH_ATTR)
+            if input_hash is not None and input_hash not in self:
+                hashes.append(input_hash)
+                self._new.add(input_hash)
+        if hashes:
+            with self.log_path.open("ab") as f:
+                hashes.tofile(f)
+        # Every answer is saved to the dataset, including repeated inputs. If
+        # the save fails, the count won't match and the index is rebuilt.
+        self._write_count(self.count + len(examples))
+
+    def _rebuild(self, count: int) -> None:
+        self._hashes = array("q", sorted(self.db.get_input_hashes(self.dataset)))
+        self._new = set()
+        self._write(self._hashes)
+        self._write_count(count)
+
+    def _compact(self) -> None:
+        self._hashes = array("q", sorted(set(self._hashes) | self._new))
+        self._write(self._hashes)
+        self._new = set()
+
+    def _write(self, hashes: array) -> None:
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with tmp_path.open("wb") as f:
+            hashes.tofile(f)
+        tmp_path.replace(self.path)
+        if self.log_path.exists():
+            self.log_path.unlink()
+
+    def _write_count(self, count: int) -> None:
+        self.count = count
+        self.count_path.write_text(str(count))
+
+    def _read(self, path: Path) -> array:
+        hashes = array("q")
+        with path.open("rb") as f:
+            hashes.frombytes(f.read())
+        return hashes
+
+
+class SeenInputs:
+    """Skip examples whose input is already annotated in the dataset or in
+    one of the excluded datasets, using one `InputHashIndex` per dataset.
+    Only the index of the current dataset is updated with new answers.
+    The indexes are checked for staleness when they're loaded, so this is a
+    pre-filter: the recipes still pass the datasets to Prodigy's filter.
+    """
+
+    def __init__(
+        self,
+        db,
+        dataset: str,
+        exclude: Optional[List[str]] = None,
+        cache_dir: Optional[Union[str, Path]] = None,
+    ):
+        names = [dataset] + [name for name in exclude or [] if name != dataset]
+        self.indexes = {
+            name: InputHashIndex(db, name, cache_dir=cache_dir)
+            for name in names
+            if name and name in db
+        }
+        self.dataset_index = self.indexes.get(dataset)
+
+    def __contains__(self, eg: Dict[str, Any]) -> bool:
+        input_hash = get_input_hash(eg)
+        return any(input_hash in index for index in self.indexes.values())
+
+    def filter(self, stream: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Yield the examples from the stream that weren't annotated yet."""
+        for eg in stream:
+            if eg not in self:
+                yield eg
+
+    def add(self, answers: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Add new answers to the index of the current dataset. Returns the
+        answers unchanged, so it can be used as the `before_db` callback."""
+        if self.dataset_index is not None:
+            self.dataset_index.add(answers)
+        return answers
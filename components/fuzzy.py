@@ -0,0 +1,213 @@
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import spacy
+from spacy.language import Language
+from spacy.tokens import Doc, DocBin
+from spacy.vocab import Vocab
+from spaczz.matcher import FuzzyMatcher
+
+from .pipeline import ordered_map
+from .util import get_cache_dir, hash_file
+
+
+# Number of pattern texts tokenized at once
+PATTERN_BATCH_SIZE = 1000
+
+
+def load_pattern_docs(
+    nlp: Language,
+    patterns_path: Union[str, Path],
+    texts: Sequence[str],
+    cache_dir: Optional[Union[str, Path]] = None,
+) -> List[Doc]:
+    """Get the tokenized Docs of the pattern texts read from a patterns file.
+    The fuzzy matcher only needs the tokens, so the texts are only run
+    through the tokenizer, in batches. The Docs are cached as a DocBin keyed
+    by the patterns file contents and the tokenizer, so restarts with the
+    same patterns skip tokenization entirely.
+    """
+    meta = {
+        "lang": nlp.lang,
+        "name": nlp.meta.get("name"),
+        "version": nlp.meta.get("version"),
+        "spacy": spacy.__version__,
+        "n_texts": len(texts),
+    }
+    key = hash_file(patterns_path, meta)
+    path = get_cache_dir("fuzzy_patterns", cache_dir) / f"{key}.spacy"
+    if path.exists():
+        return list(DocBin().from_disk(path).get_docs(nlp.vocab))
+    docs = list(nlp.tokenizer.pipe(texts, batch_size=PATTERN_BATCH_SIZE))
+    tmp_path = path.with_name(path.name + ".tmp")
+    DocBin(docs=docs).to_disk(tmp_path)
+    tmp_path.replace(path)
+    return docs
+
+
+def get_qgrams(text: str, q: int = 3) -> set:
+    """The distinct character q-grams of a lowercased text."""
+    text = text.lower()
+    return {text[i : i + q] for i in range(len(text) - q + 1)}
+
+
+class QGramIndex:
+    """Inverted index from character q-grams to the texts containing them,
+    used to find the texts that share enough q-grams with a query to
+    possibly be a fuzzy match.
+
+    A text is a candidate if the query contains at least `min_share` of its
+    distinct q-grams. Texts shorter than q are always candidates. The filter
+    is approximate: spans that only reach the fuzzy matcher's threshold with
+    edits spread over most of their q-grams can be missed, so a lower
+    `min_share` trades speed for recall.
+    """
+
+    def __init__(self, texts: Sequence[str], q: int = 3, min_share: float = 0.5):
+        self.q = q
+        self.min_share = min_share
+        postings = {}
+        n_qgrams = np.zeros((len(texts),), dtype="int64")
+        for i, text in enumerate(texts):
+            qgrams = get_qgrams(text, q)
+            n_qgrams[i] = len(qgrams)
+            for qgram in qgrams:
+                postings.setdefault(qgram, []).append(i)
+        self.postings = {qgram: np.asarray(ids, dtype="int64") for qgram, ids in postings.items()}
+        self.n_texts = len(texts)
+        self.min_shared = np.asarray(
+            [math.ceil(min_share * n) for n in n_qgrams], dtype="int64"
+        )
+        self.always = np.flatnonzero(n_qgrams == 0).tolist()
+
+    def __len__(self) -> int:
+        return self.n_texts
+
+    def candidates(self, text: str) -> List[int]:
+        """Indices of the indexed texts that may fuzzy-match part of the text."""
+        if self.min_share <= 0:
+            return list(range(self.n_texts))
+        lists = [self.postings[qgram] for qgram in get_qgrams(text, self.q) if qgram in self.postings]
+        if not lists:
+            return list(self.always)
+        shared = np.bincount(np.concatenate(lists), minlength=self.n_texts)
+        # Texts without q-grams have a threshold of 0 and are always included
+        return np.flatnonzero(shared >= self.min_shared).tolist()
+
+
+class CandidateFuzzyMatcher:
+    """spaczz fuzzy matcher that only runs the patterns that share enough
+    character q-grams with a doc, instead of every pattern against every doc.
+
+    The candidates are looked up in a `QGramIndex` of the pattern texts, and
+    a FuzzyMatcher with just those patterns is run on the doc. With
+    `min_share=0`, all patterns are always matched, like a plain FuzzyMatcher.
+    Calling the matcher returns the same match tuples as spaczz.
+    """
+
+    def __init__(
+        self,
+        vocab: Vocab,
+        patterns: Sequence[Tuple[Hashable, Doc]],
+        q: int = 3,
+        min_share: float = 0.5,
+        kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        self.vocab = vocab
+        self.keys = [key for key, _ in patterns]
+        self.docs = [doc for _, doc in patterns]
+        self.kwargs = kwargs or {}
+        self.index = QGramIndex([doc.text for doc in self.docs], q=q, min_share=min_share)
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def __call__(self, doc: Doc) -> List[Tuple]:
+        candidates = self.index.candidates(doc.text)
+        if not candidates:
+            return []
+        matcher = FuzzyMatcher(self.vocab)
+        for i in candidates:
+            matcher.add(self.keys[i], [self.docs[i]], kwargs=[self.kwargs])
+        return matcher(doc)
+
+
+# Matcher of the current worker process, created once by _init_worker
+_worker = {}
+
+
+def _init_worker(
+    spacy_model: str,
+    patterns_path: str,
+    patterns: List[Tuple[Hashable, str]],
+    q: int,
+    min_share: float,
+    kwargs: Dict[str, Any],
+) -> None:
+    nlp = spacy.load(spacy_model)
+    # The pattern Docs are already cached by the main process
+    docs = load_pattern_docs(nlp, patterns_path, [text for _, text in patterns])
+    keyed_docs = [(key, doc) for (key, _), doc in zip(patterns, docs)]
+    _worker["vocab"] = nlp.vocab
+    _worker["matcher"] = CandidateFuzzyMatcher(
+        nlp.vocab, keyed_docs, q=q, min_share=min_share, kwargs=kwargs
+    )
+
+
+def _match_batch(data: bytes) -> List[List[Tuple[Hashable, int, int]]]:
+    docs = DocBin().from_bytes(data).get_docs(_worker["vocab"])
+    return [[match[:3] for match in _worker["matcher"](doc)] for doc in docs]
+
+
+class FuzzyMatcherPool:
+    """Run a `CandidateFuzzyMatcher` in a pool of worker processes. Each
+    worker loads the pipeline and builds the matcher once. The Docs are sent
+    to the workers in batches, serialized as DocBin bytes, and the workers
+    return (key, start, end) tuples for each Doc. Results are yielded in input
+    order and at most two batches per worker are in flight.
+    """
+
+    def __init__(
+        self,
+        n_workers: int,
+        spacy_model: str,
+        patterns_path: Union[str, Path],
+        patterns: Sequence[Tuple[Hashable, str]],
+        q: int = 3,
+        min_share: float = 0.5,
+        kwargs: Optional[Dict[str, Any]] = None,
+        batch_size: int = 32,
+    ):
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        initargs = (spacy_model, str(patterns_path), list(patterns), q, min_share, kwargs or {})
+        # Spawn fresh processes instead of forking the server process
+        self.executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=initargs,
+        )
+
+    def pipe(self, docs: Iterable[Doc]) -> Iterator[List[Tuple[Hashable, int, int]]]:
+        """Yield the matches for each Doc, in order."""
+        batches = self._serialize(docs)
+        max_pending = 2 * self.n_workers
+        for matches in ordered_map(_match_batch, batches, self.executor, max_pending):
+            yield from matches
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    def _serialize(self, docs: Iterable[Doc]) -> Iterator[bytes]:
+        docs = iter(docs)
+        while True:
+            batch = list(islice(docs, self.batch_size))
+            if not batch:
+                return
+            yield DocBin(docs=batch).to_bytes()
@@ -0,0 +1,283 @@
+import mmap
+import os
+import tempfile
+from array import array
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import srsly
+from spacy.tokens import Doc, DocBin
+from spacy.vocab import Vocab
+
+
+# Suffix of the line-offset index written next to the source file
+INDEX_SUFFIX = ".idx"
+# Number of offsets buffered in memory before they're flushed to the index
+INDEX_CHUNK_SIZE = 2 ** 16
+# Suffix of spaCy's binary DocBin files
+DOCBIN_SUFFIX = ".spacy"
+
+
+class IndexedJSONL:
+    """Memory-mapped JSONL reader backed by a persistent line-offset index.
+
+    Iterating the reader yields one dict per line, just like Prodigy's
+    `JSONL(source)`, so it can be used as a drop-in replacement in recipes.
+    Records are streamed as the file is read, so the first one is available
+    right away, even for very large sources.
+
+    The first complete pass over a source also writes the byte offset of
+    every non-empty line to `<source>.idx`, as a side effect of the scan.
+    Once the index exists, `len()`, `reader[i]` and starting from a given
+    record (`start`) don't need to scan the file. Calling them before
+    there's an index scans the file once. The recipes only iterate the
+    reader, so they only use the streaming reads. The index stores the size and
+    modification time of the source and is rebuilt if the file changes. If
+    it can't be written (e.g. read-only directory), it's kept in memory for
+    the current session.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        start: int = 0,
+        index_path: Optional[Union[str, Path]] = None,
+    ):
+        self.path = Path(path)
+        if not self.path.exists():
+            raise ValueError(f"Can't find JSONL file: {self.path}")
+        self.index_path = (
+            Path(index_path)
+            if index_path is not None
+            else self.path.with_name(self.path.name + INDEX_SUFFIX)
+        )
+        self.start = start
+        self._file = None
+        self._data = None
+        self._offsets = None
+
+    def __len__(self) -> int:
+        return max(len(self.offsets) - 1 - self.start, 0)
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        n_lines = len(self.offsets) - 1
+        if i < 0:
+            i += n_lines
+        if not 0 <= i < n_lines:
+            raise IndexError(f"Line {i} out of range for {self.path}")
+        return self._read_line(i)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return self.iter_from(self.start)
+
+    def iter_from(self, start: int) -> Iterator[Dict[str, Any]]:
+        """Iterate over the records, starting at record number `start`. If
+        there's no index yet, the records are parsed while the file is
+        scanned and the index is written once the scan completes."""
+        if self._offsets is None:
+            self._offsets = self._load_index()
+        if self._offsets is not None:
+            for i in range(start, len(self._offsets) - 1):
+                yield self._read_line(i)
+            return
+        for i, (pos, end) in enumerate(self._scan()):
+            if i >= start:
+                yield self._parse(self.data[pos:end], i)
+
+    @property
+    def data(self) -> Union[mmap.mmap, bytes]:
+        if self._data is None:
+            self._file = self.path.open("rb")
+            if os.fstat(self._file.fileno()).st_size == 0:
+                # Empty files can't be memory-mapped
+                self._data = b""
+            else:
+                self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._data
+
+    @property
+    def offsets(self):
+        """The line offsets, followed by a final end-of-data sentinel."""
+        if self._offsets is None:
+            self._offsets = self._load_index()
+            if self._offsets is None:
+                self._offsets = self._build_index()
+        return self._offsets
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        if self._file is not None:
+            self._file.close()
+        self._file = self._data = None
+
+    def _read_line(self, i: int) -> Dict[str, Any]:
+        return self._parse(self.data[self.offsets[i] : self.offsets[i + 1]], i)
+
+    def _parse(self, line: bytes, i: int) -> Dict[str, Any]:
+        try:
+            return srsly.json_loads(line)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON on line {i + 1} of {self.path}: {line[:100]}") from e
+
+    def _get_header(self) -> array:
+        stat = self.path.stat()
+        return array("Q", [stat.st_size, stat.st_mtime_ns])
+
+    def _load_index(self) -> Optional[memoryview]:
+        """Map an existing index if it was built for the current source."""
+        if not self.index_path.exists():
+            return None
+        header = self._get_header()
+        with self.index_path.open("rb") as f:
+            stored = array("Q")
+            try:
+                stored.fromfile(f, len(header))
+            except EOFError:
+                return None
+            if stored != header:
+                return None
+            index_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Skip the header and expose the offsets as unsigned 64-bit integers
+        return memoryview(index_data)[header.itemsize * len(header) :].cast("Q")
+
+    def _build_index(self) -> Union[array, memoryview]:
+        for _ in self._scan():
+            pass
+        return self._offsets
+
+    def _scan(self) -> Iterator[Tuple[int, int]]:
+        """Scan the source once and yield the start and end offset of every
+        non-empty line. The offsets are written to a temporary file as the
+        scan goes, which replaces the index when the scan completes. Each
+        offset marks the start of a record and the end of the previous one,
+        so blank lines in between are only ever read as whitespace."""
+        try:
+            f = tempfile.NamedTemporaryFile(
+                dir=self.index_path.parent,
+                prefix=self.index_path.name,
+                suffix=".tmp",
+                delete=False,
+            )
+        except OSError:
+            # Directory isn't writable, so keep the index for this session only
+            f = None
+        all_offsets = array("Q")
+        offsets = all_offsets if f is None else array("Q")
+        complete = False
+        try:
+            if f is not None:
+                self._get_header().tofile(f)
+            data = self.data
+            size = len(data)
+            pos = 0
+            while pos < size:
+                end = data.find(b"\n", pos)
+                end = size if end == -1 else end + 1
+                if data[pos:end].strip():
+                    offsets.append(pos)
+                    if f is not None and len(offsets) >= INDEX_CHUNK_SIZE:
+                        offsets.tofile(f)
+                        offsets = array("Q")
+                    yield pos, end
+                pos = end
+            offsets.append(size)
+            if f is not None:
+                offsets.tofile(f)
+            complete = True
+        finally:
+            if f is not None:
+                f.close()
+                if complete:
+                    Path(f.name).replace(self.index_path)
+                else:
+                    # Stopped before the end, so the index is incomplete
+                    Path(f.name).unlink()
+        self._offsets = all_offsets if f is None else self._load_index()
+
+
+def is_docbin_source(path: Union[str, Path]) -> bool:
+    """Whether a source is a .spacy file or a directory of .spacy files."""
+    path = Path(path)
+    if path.is_dir():
+        return any(path.glob(f"*{DOCBIN_SUFFIX}"))
+    return path.suffix == DOCBIN_SUFFIX
+
+
+def get_doc_tokens(doc: Doc) -> List[Dict[str, Any]]:
+    """Token dicts for a Doc, in the format add_tokens produces."""
+    return [
+        {
+            "text": token.text,
+            "start": token.idx,
+            "end": token.idx + len(token.text),
+            "id": token.i,
+            "ws": bool(token.whitespace_),
+        }
+        for token in doc
+    ]
+
+
+def get_doc_spans(doc: Doc) -> List[Dict[str, Any]]:
+    """Span dicts for the entities of a Doc, with token offsets."""
+    return [
+        {
+            "start": ent.start_char,
+            "end": ent.end_char,
+            "token_start": ent.start,
+            "token_end": ent.end - 1,
+            "label": ent.label_,
+        }
+        for ent in doc.ents
+    ]
+
+
+class DocBinStream:
+    """Stream of tasks from spaCy DocBin files, i.e. a .spacy file or a
+    directory of .spacy files, for recipes that work with tokens.
+
+    Each file is read in one go and each task gets its "tokens" and entity
+    "spans" from the stored Doc, so the text doesn't need to be tokenized
+    again and existing entities are pre-highlighted. Iterating yields one
+    task per Doc (or per sentence with `split_sents=True`, if the Docs have
+    sentence boundaries). `iter_docs` yields (doc, task) tuples, e.g. to run a
+    model on the stored Docs with `pipe_docs`, which keeps their tokenization
+    and their entities.
+    """
+
+    def __init__(self, path: Union[str, Path], vocab: Vocab, split_sents: bool = False):
+        self.path = Path(path)
+        if not self.path.exists():
+            raise ValueError(f"Can't find DocBin file or directory: {self.path}")
+        self.vocab = vocab
+        self.split_sents = split_sents
+
+    @property
+    def files(self) -> List[Path]:
+        if self.path.is_dir():
+            return sorted(self.path.glob(f"*{DOCBIN_SUFFIX}"))
+        return [self.path]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for _, task in self.iter_docs():
+            yield task
+
+    def iter_docs(self) -> Iterator[Tuple[Doc, Dict[str, Any]]]:
+        for file_path in self.files:
+            doc_bin = DocBin().from_bytes(file_path.read_bytes())
+            for i, doc in enumerate(doc_bin.get_docs(self.vocab)):
+                meta = {"source": file_path.name, "doc": i}
+                if self.split_sents and doc.has_annotation("SENT_START"):
+                    for j, sent in enumerate(doc.sents):
+                        sent_doc = sent.as_doc()
+                        yield sent_doc, self._make_task(sent_doc, {**meta, "sent": j})
+                else:
+                    yield doc, self._make_task(doc, meta)
+
+    def _make_task(self, doc: Doc, meta: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "text": doc.text,
+            "tokens": get_doc_tokens(doc),
+            "spans": get_doc_spans(doc),
+            "meta": meta,
+        }
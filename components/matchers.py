@@ -0,0 +1,111 @@
+import io
+import os
+import pickle
+import stat
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import prodigy
+import spacy
+from prodigy.models.matcher import PatternMatcher
+from prodigy.util import log
+from spacy.language import Language
+from wasabi import msg
+
+from .util import get_cache_dir, hash_file
+
+
+class _Pickler(pickle.Pickler):
+    """Pickler that stores references to the live pipeline and its vocab
+    instead of serializing them, so only the matcher state is written."""
+
+    def __init__(self, f, nlp: Language):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared = {id(nlp): "nlp", id(nlp.vocab): "vocab", id(nlp.tokenizer): "tokenizer"}
+
+    def persistent_id(self, obj: Any) -> Optional[str]:
+        return self.shared.get(id(obj))
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, f, nlp: Language):
+        super().__init__(f)
+        self.shared = {"nlp": nlp, "vocab": nlp.vocab, "tokenizer": nlp.tokenizer}
+
+    def persistent_load(self, pid: str) -> Any:
+        return self.shared[pid]
+
+
+def is_private_path(path: Union[str, Path]) -> bool:
+    """Whether a file or directory is owned by the current user and can't be
+    written by anyone else, so it's safe to unpickle data from it."""
+    if not hasattr(os, "getuid"):
+        return True
+    info = Path(path).stat()
+    return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def get_matcher_key(nlp: Language, patterns: Union[str, Path], **kwargs) -> str:
+    """Hash of the patterns file, the matcher settings and the pipeline and
+    library versions, which all affect the built matcher."""
+    meta = {
+        "lang": nlp.lang,
+        "name": nlp.meta.get("name"),
+        "version": nlp.meta.get("version"),
+        "pipeline": nlp.pipe_names,
+        "spacy": spacy.__version__,
+        "prodigy": prodigy.__version__,
+        "settings": kwargs,
+    }
+    return hash_file(patterns, meta)
+
+
+def load_pattern_matcher(
+    nlp: Language,
+    patterns: Union[str, Path],
+    cache_dir: Optional[Union[str, Path]] = None,
+    **kwargs,
+) -> PatternMatcher:
+    """Create a PatternMatcher with the given settings and load the patterns
+    file, using a cached copy of the matcher if available.
+
+    Building the matcher parses every pattern and tokenizes all phrase
+    patterns, which takes minutes for large gazetteers. The built matcher is
+    pickled to the cache directory, keyed by the patterns file contents, the
+    settings and the pipeline. Unpickling still adds every pattern to spaCy's
+    matchers again, so the cache only saves parsing the patterns file and
+    tokenizing the phrase patterns.
+
+    Pickles can run arbitrary code, so the cache is only used if the cache
+    directory and file are owned by the current user and not writable by
+    anyone else. If the matcher can't be cached or the cached copy can't be
+    loaded, a warning is shown and it's built from the patterns file.
+    """
+    key = get_matcher_key(nlp, patterns, **kwargs)
+    cache_dir = get_cache_dir("matchers", cache_dir)
+    if not is_private_path(cache_dir):
+        msg.warn(f"Not caching pattern matcher, {cache_dir} is writable by other users")
+        return PatternMatcher(nlp, **kwargs).from_disk(patterns)
+    path = cache_dir / f"{key}.pkl"
+    if path.exists():
+        if not is_private_path(path):
+            msg.warn(f"Not loading cached pattern matcher, {path} is writable by other users")
+        else:
+            try:
+                matcher = _Unpickler(io.BytesIO(path.read_bytes()), nlp).load()
+                log(f"RECIPE: Loaded cached pattern matcher from {path}")
+                return matcher
+            except Exception as e:
+                msg.warn(f"Can't load cached pattern matcher, rebuilding it: {e}")
+    matcher = PatternMatcher(nlp, **kwargs).from_disk(patterns)
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            _Pickler(f, nlp).dump(matcher)
+        tmp_path.replace(path)
+    except Exception as e:
+        msg.warn(f"Can't cache pattern matcher: {e}")
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return matcher
@@ -0,0 +1,158 @@
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+from spacy.language import Language
+from spacy.tokens import Doc
+
+from .updates import locked
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+# Marks the end of a prefetched iterable
+_DONE = object()
+
+
+def prefetch(iterable: Iterable[T], size: int) -> Iterator[T]:
+    """Consume an iterable in a background thread and keep up to `size`
+    items ready in a bounded queue. Items are yielded in their original order
+    and the producer blocks once the queue is full, so memory stays bounded.
+    Errors raised while producing items are re-raised in the consumer.
+    """
+    buffer = _produce(iterable, size)
+    while True:
+        item = buffer.get()
+        if item is _DONE:
+            break
+        if isinstance(item, _Error):
+            raise item.error
+        yield item
+
+
+def micro_batch(iterable: Iterable[T], batch_size: int, max_wait: float) -> Iterator[List[T]]:
+    """Group the items of an iterable into batches of up to `batch_size`
+    items. A batch is yielded once it's full, or `max_wait` seconds after
+    its first item arrived, so a slow source doesn't hold back the items
+    that are already available. The items are read in a background thread,
+    up to one batch ahead.
+    """
+    buffer = _produce(iterable, batch_size)
+    item = buffer.get()
+    while item is not _DONE:
+        if isinstance(item, _Error):
+            raise item.error
+        batch = [item]
+        item = None
+        deadline = time.monotonic() + max_wait
+        while len(batch) < batch_size:
+            try:
+                next_item = buffer.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if next_item is _DONE or isinstance(next_item, _Error):
+                # Yield the items before the end or the error first
+                item = next_item
+                break
+            batch.append(next_item)
+        yield batch
+        if item is None:
+            item = buffer.get()
+
+
+def _produce(iterable: Iterable[T], size: int) -> queue.Queue:
+    """Start a background thread putting the items of an iterable into a
+    bounded queue, followed by _DONE or the error raised by the iterable."""
+    buffer = queue.Queue(maxsize=max(size, 1))
+
+    def produce():
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except BaseException as e:
+            buffer.put(_Error(e))
+        buffer.put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    return buffer
+
+
+def broadcast(
+    iterable: Iterable[T], n: int = 2, lock: Optional[threading.Lock] = None
+) -> List[Iterator[T]]:
+    """Split an iterable into n iterators over the same items, like
+    itertools.tee. Items are only buffered until every iterator has consumed
+    them, so memory is bounded by how far the consumers drift apart.
+
+    The iterators share a lock, so they can be consumed from different
+    threads, e.g. when a consumer is prefetched or runs nlp.pipe with
+    n_process > 1. A tee iterator can't be advanced by two threads at once.
+    """
+    if lock is None:
+        lock = threading.Lock()
+    return [locked(iterator, lock) for iterator in itertools.tee(iterable, n)]
+
+
+def ordered_map(
+    func: Callable[[T], R], iterable: Iterable[T], executor: Executor, max_pending: int
+) -> Iterator[R]:
+    """Apply a function to the items of an iterable in an executor, e.g. a
+    process pool, and yield the results in input order. At most `max_pending`
+    items are submitted at once, so the input is only read ahead that far.
+    """
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= max(max_pending, 1):
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+class _Error:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def pipe_examples(
+    nlp: Language,
+    stream: Iterable[Dict[str, Any]],
+    n_process: int = 1,
+    batch_size: int = 32,
+    prefetch_size: Optional[int] = None,
+    key: str = "text",
+) -> Iterator[Tuple[Doc, Dict[str, Any]]]:
+    """Process the examples of a stream with nlp.pipe and yield (doc, example)
+    tuples in input order.
+
+    With n_process > 1, spaCy shards the batches across a pool of worker
+    processes and only sends new batches as results are consumed. The docs
+    are prefetched in a background thread, so the workers keep running while
+    the annotators work through the current questions. By default, up to
+    two batches per worker are kept ready.
+    """
+    texts = ((eg[key], eg) for eg in stream)
+    return pipe_docs(nlp, texts, n_process, batch_size, prefetch_size)
+
+
+def pipe_docs(
+    nlp: Language,
+    docs: Iterable[Tuple[Union[str, Doc], Dict[str, Any]]],
+    n_process: int = 1,
+    batch_size: int = 32,
+    prefetch_size: Optional[int] = None,
+) -> Iterator[Tuple[Doc, Dict[str, Any]]]:
+    """Like pipe_examples, but for (text or Doc, example) tuples, e.g. to run
+    the pipeline on pre-tokenized Docs. Existing entities of the Docs are
+    kept by the entity recognizer."""
+    docs = nlp.pipe(docs, as_tuples=True, n_process=n_process, batch_size=batch_size)
+    if prefetch_size is None:
+        prefetch_size = 2 * n_process * batch_size if n_process > 1 else 0
+    if prefetch_size > 0:
+        docs = prefetch(docs, prefetch_size)
+    return docs
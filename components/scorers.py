@@ -0,0 +1,125 @@
+import threading
+from collections import deque
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class _Batch:
+    """Raw examples and their (score, example) predictions, together with the
+    model version that produced them."""
+
+    __slots__ = ("examples", "scored", "version")
+
+    def __init__(self, examples: List[Dict[str, Any]]):
+        self.examples = examples
+        self.scored = []
+        self.version = -1
+
+
+class LookaheadScorer:
+    """Score a stream in a background thread and keep a bounded buffer of
+    (score, example) tuples ready, so the annotation requests don't block on
+    the model.
+
+    Call `invalidate` after the model is updated. Buffered predictions that
+    are more than `max_stale` updates old are re-scored in bulk by the
+    background thread before they're handed out, so `max_stale=0` always
+    serves predictions from the latest model. The model calls are guarded by
+    `lock`, which should also be held while the model is updated.
+    """
+
+    def __init__(
+        self,
+        predict: Callable[[Iterable[Dict[str, Any]]], Iterable[Tuple[float, Dict[str, Any]]]],
+        stream: Iterable[Dict[str, Any]],
+        buffer_size: int = 128,
+        batch_size: int = 8,
+        max_stale: int = 1,
+        lock: Optional[threading.Lock] = None,
+    ):
+        self.predict = predict
+        self.stream = iter(stream)
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.max_stale = max_stale
+        self.lock = lock if lock is not None else threading.Lock()
+        self.version = 0
+        self._buffer = deque()
+        self._n_buffered = 0
+        self._exhausted = False
+        self._error = None
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def invalidate(self) -> None:
+        """Mark the buffered predictions as one model version older."""
+        with self._cond:
+            self.version += 1
+            self._cond.notify_all()
+
+    def __iter__(self) -> Iterator[Tuple[float, Dict[str, Any]]]:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        while True:
+            with self._cond:
+                while True:
+                    if self._error is not None:
+                        raise self._error
+                    if self._buffer and not self._is_stale(self._buffer[0]):
+                        batch = self._buffer.popleft()
+                        self._n_buffered -= len(batch.examples)
+                        self._cond.notify_all()
+                        break
+                    if self._exhausted and not self._buffer:
+                        return
+                    self._cond.wait()
+            yield from batch.scored
+
+    def _is_stale(self, batch: _Batch) -> bool:
+        return self.version - batch.version > self.max_stale
+
+    def _score(self, batch: _Batch) -> None:
+        with self._cond:
+            version = self.version
+        with self.lock:
+            scored = list(self.predict(batch.examples))
+        with self._cond:
+            batch.scored = scored
+            batch.version = version
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._cond:
+                    while True:
+                        stale = [b for b in self._buffer if self._is_stale(b)]
+                        if stale:
+                            break
+                        if not self._exhausted and self._n_buffered < self.buffer_size:
+                            break
+                        if self._exhausted and not self._buffer:
+                            return
+                        self._cond.wait()
+                if stale:
+                    # Re-score all outdated predictions in bulk before
+                    # reading any new examples from the stream
+                    for batch in stale:
+                        self._score(batch)
+                    with self._cond:
+                        self._cond.notify_all()
+                    continue
+                batch = _Batch(list(islice(self.stream, self.batch_size)))
+                if batch.examples:
+                    self._score(batch)
+                with self._cond:
+                    if batch.examples:
+                        self._buffer.append(batch)
+                        self._n_buffered += len(batch.examples)
+                    else:
+                        self._exhausted = True
+                    self._cond.notify_all()
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
@@ -0,0 +1,66 @@
+from typing import Any, Dict, Iterable, Iterator, List
+
+
+def derive_task(eg: Dict[str, Any], **updates: Any) -> Dict[str, Any]:
+    """Create a new task from an example without copying its contents.
+
+    The example is copied shallowly and only the keys passed in as keyword
+    arguments are replaced, so large values like base64-encoded images or
+    token lists are shared with the input instead of duplicated, e.g. every
+    task created from an image shares its base64-encoded data. Stages must
+    not mutate nested values of the new task in place (e.g. task["meta"]),
+    but pass in a new value for the key instead.
+    """
+    task = dict(eg)
+    task.update(updates)
+    return task
+
+
+def add_char_tokens(stream: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Add one token per character to each example, for character-based
+    highlighting in the manual NER interface.
+
+    Unlike add_tokens(nlp, stream, use_chars=True), the text isn't run through
+    the tokenizer first, and the tokens only have the keys the interface needs.
+    Since token and character offsets are the same, the token offsets of
+    existing spans are derived from their character offsets. Use
+    `remove_char_tokens` to strip the tokens again before saving.
+    """
+    for eg in stream:
+        text = eg["text"]
+        tokens = [
+            {"text": char, "start": i, "end": i + 1, "id": i}
+            for i, char in enumerate(text)
+        ]
+        spans = [
+            {**span, "token_start": span["start"], "token_end": span["end"] - 1}
+            for span in eg.get("spans", [])
+        ]
+        yield derive_task(eg, tokens=tokens, spans=spans)
+
+
+def remove_char_tokens(answers: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Remove the character tokens and the spans' token offsets from answers
+    before they're saved to the database."""
+    for eg in answers:
+        eg.pop("tokens", None)
+        for span in eg.get("spans", []):
+            span.pop("token_start", None)
+            span.pop("token_end", None)
+    return answers
+
+
+def align_span_tokens(stream: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Set the token offsets of the spans from the examples' existing tokens,
+    e.g. for spans that were matched on a different tokenization. Spans that
+    don't start and end on token boundaries are dropped."""
+    for eg in stream:
+        tokens = eg.get("tokens", [])
+        starts = {token["start"]: token["id"] for token in tokens}
+        ends = {token["end"]: token["id"] for token in tokens}
+        spans = [
+            {**span, "token_start": starts[span["start"]], "token_end": ends[span["end"]]}
+            for span in eg.get("spans", [])
+            if span["start"] in starts and span["end"] in ends
+        ]
+        yield derive_task(eg, spans=spans)
@@ -0,0 +1,125 @@
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+from prodigy.util import log
+
+
+T = TypeVar("T")
+
+
+def locked(iterable: Iterable[T], lock: threading.Lock) -> Iterator[T]:
+    """Hold a lock while each item of an iterable is produced, e.g. to make
+    sure a lazy prediction stream doesn't read the weights mid-update."""
+    iterator = iter(iterable)
+    while True:
+        with lock:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class UpdateScheduler:
+    """Update callback that queues incoming answers and applies the model
+    updates on a dedicated worker thread, so submitting answers never blocks
+    on the model.
+
+    Answers that arrive while an update is running are coalesced into larger
+    minibatches of up to `batch_size` answers. If fewer answers are queued,
+    the worker waits up to `max_wait` seconds for more before updating. The
+    update runs while holding `lock`, which the predictor should also hold, so
+    it only ever sees the weights before or after a complete update.
+    `on_update` is called after every update, e.g. to invalidate predictions.
+    The number of answers still waiting for an update is logged after every
+    update, so a lagging model shows up in the logs.
+    """
+
+    def __init__(
+        self,
+        update: Callable[[List[Dict[str, Any]]], Any],
+        batch_size: int = 32,
+        max_wait: float = 0.5,
+        lock: Optional[threading.Lock] = None,
+        on_update: Optional[Callable[[], Any]] = None,
+    ):
+        self.update = update
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.lock = lock if lock is not None else threading.Lock()
+        self.on_update = on_update
+        self.n_received = 0
+        self.n_applied = 0
+        self.n_failed = 0
+        self.last_loss = None
+        self._queue = deque()
+        self._error = None
+        self._thread = None
+        self._cond = threading.Condition()
+
+    @property
+    def pending(self) -> int:
+        """Number of answers that haven't been used to update the model yet."""
+        with self._cond:
+            return self._pending()
+
+    def __call__(self, answers: List[Dict[str, Any]]) -> int:
+        with self._cond:
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._queue.extend(answers)
+            self.n_received += len(answers)
+            pending = self._pending()
+            self._cond.notify_all()
+        log(f"RECIPE: Queued {len(answers)} answers, {pending} waiting for update")
+        return pending
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all queued answers are applied. Returns False if the
+        timeout expired first."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._pending() == 0 or self._error is not None,
+                timeout=timeout,
+            )
+
+    def _pending(self) -> int:
+        return self.n_received - self.n_applied - self.n_failed
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+                if len(self._queue) < self.batch_size:
+                    # Give more answers the chance to arrive, so they're
+                    # coalesced into one larger minibatch
+                    self._cond.wait_for(
+                        lambda: len(self._queue) >= self.batch_size,
+                        timeout=self.max_wait,
+                    )
+                n_answers = min(self.batch_size, len(self._queue))
+                batch = [self._queue.popleft() for _ in range(n_answers)]
+            try:
+                with self.lock:
+                    loss = self.update(batch)
+                if self.on_update is not None:
+                    self.on_update()
+            except Exception as e:
+                # Re-raised on the next call, so the error isn't swallowed.
+                # The failed answers don't count as applied.
+                with self._cond:
+                    self._error = e
+                    self.n_failed += len(batch)
+                    self._cond.notify_all()
+                continue
+            with self._cond:
+                self.n_applied += len(batch)
+                self.last_loss = loss
+                pending = self._pending()
+                self._cond.notify_all()
+            log(f"RECIPE: Updated model with {len(batch)} answers, {pending} waiting for update")
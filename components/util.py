@@ -0,0 +1,67 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import srsly
+from wasabi import msg
+
+
+# Size of the chunks files are hashed in
+HASH_CHUNK_SIZE = 2 ** 20
+
+
+def get_cache_dir(name: str, cache_dir: Optional[Union[str, Path]] = None) -> Path:
+    """Get (and create) a cache directory for persistent recipe artifacts.
+    Defaults to a subdirectory of the Prodigy home directory, which can be
+    customized via the PRODIGY_HOME environment variable.
+    """
+    if cache_dir is None:
+        prodigy_home = os.environ.get("PRODIGY_HOME", Path.home() / ".prodigy")
+        cache_dir = Path(prodigy_home) / "cache"
+    path = Path(cache_dir) / name
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def hash_file(path: Union[str, Path], *extra: Any) -> str:
+    """Hash the contents of a file, plus any extra JSON-serializable values
+    the derived artifact depends on, e.g. settings or library versions."""
+    h = hashlib.blake2b(digest_size=16)
+    with Path(path).open("rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    h.update(srsly.json_dumps(list(extra), sort_keys=True).encode("utf8"))
+    return h.hexdigest()
+
+
+def update_dataset_meta(db, name: str, meta: Dict[str, Any]) -> bool:
+    """Merge the given keys into the meta of an existing dataset. Prodigy has
+    no public API for this, so it relies on `add_dataset` returning the
+    dataset's database model. If it doesn't or the model can't be saved, a
+    warning is shown and False is returned, so the meta just isn't persisted.
+    """
+    # add_dataset returns the existing dataset if it's already in the database
+    dataset = db.add_dataset(name)
+    if not hasattr(dataset, "meta") or not callable(getattr(dataset, "save", None)):
+        _warn_meta(name, "the database doesn't expose the dataset model")
+        return False
+    dataset_meta = db.get_meta(name) or {}
+    dataset_meta.update(meta)
+    try:
+        dataset.meta = srsly.json_dumps(dataset_meta)
+        dataset.save()
+    except Exception as e:
+        _warn_meta(name, e)
+        return False
+    return True
+
+
+def _warn_meta(name: str, reason: Any) -> None:
+    # Only warn once per dataset, as the meta is updated after every batch
+    if name not in _meta_warnings:
+        _meta_warnings.add(name)
+        msg.warn(f"Can't update the meta of dataset '{name}', recipe state won't be saved: {reason}")
+
+
+_meta_warnings = set()
@@ -0,0 +1,94 @@
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from spacy.lexeme import Lexeme
+from spacy.vocab import Vocab
+
+
+class VectorTable:
+    """Unit-normalised matrix of term vectors, used to score every term
+    against a target vector with a single matrix-vector product instead of
+    one `.similarity()` call per term.
+    """
+
+    def __init__(self, texts: List[str], orths: np.ndarray, matrix: np.ndarray):
+        self.texts = texts
+        self.orths = orths
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.matrix = (matrix / norms).astype("float32")
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @classmethod
+    def from_vocab(
+        cls, vocab: Vocab, filter_func: Optional[Callable[[Lexeme], bool]] = None
+    ) -> "VectorTable":
+        """Create a table for the lexemes in the vocab that have a vector and
+        match the optional filter function."""
+        lexemes = [lex for lex in vocab if filter_func is None or filter_func(lex)]
+        orths = np.asarray([lex.orth for lex in lexemes], dtype="uint64")
+        rows = np.asarray(vocab.vectors.find(keys=orths), dtype="int64")
+        keep = rows >= 0
+        matrix = np.asarray(vocab.vectors.data[rows[keep]], dtype="float32")
+        # Only keep terms with a non-zero vector, like Lexeme.vector_norm
+        nonzero = np.any(matrix != 0, axis=1)
+        keep[keep] = nonzero
+        texts = [lex.text for lex, is_kept in zip(lexemes, keep) if is_kept]
+        return cls(texts, orths[keep], matrix[nonzero])
+
+    def cosine(self, vector: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Cosine similarity of every term (or only the given rows) to the
+        vector, clipped at 0. If the vector is all zeros, all similarities
+        are 0."""
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return np.zeros(len(matrix), dtype="float32")
+        scores = matrix @ (np.asarray(vector, dtype="float32") / norm)
+        return np.maximum(scores, 0.0)
+
+
+def top_k(scores: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """Get the indices of the k highest scores, sorted by descending score.
+    Only indices where the optional boolean mask is True are considered."""
+    indices = np.arange(len(scores)) if mask is None else np.flatnonzero(mask)
+    if len(indices) > k:
+        candidates = scores[indices]
+        indices = indices[np.argpartition(-candidates, k - 1)[:k]]
+    return indices[np.argsort(-scores[indices], kind="stable")]
+
+
+class Centroid:
+    """Running sum of term vectors, so the average vector can be updated in
+    O(batch) instead of re-averaging all terms for every batch of answers.
+    Terms without a vector count as zero vectors, like in spaCy's Doc.vector.
+    """
+
+    def __init__(self, width: int):
+        self.sum = np.zeros((width,), dtype="float64")
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def vector(self) -> np.ndarray:
+        if self.count == 0:
+            return np.zeros(self.sum.shape, dtype="float32")
+        return (self.sum / self.count).astype("float32")
+
+    def add(self, vector: np.ndarray) -> None:
+        self.sum += vector
+        self.count += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"sum": self.sum.tolist(), "count": self.count}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Centroid":
+        centroid = cls(len(data["sum"]))
+        centroid.sum = np.asarray(data["sum"], dtype="float64")
+        centroid.count = data["count"]
+        return centroid
@@ -3,7 +3,6 @@ from __future__ import unicode_literals, print_function
 
 import tensorflow as tf
 import numpy as np
-import copy
 import io
 from PIL import Image
 from time import time
@@ -13,10 +12,19 @@ from prodigy.components.preprocess import fetch_images
 from prodigy.core import recipe, recipe_args
 from prodigy.util import log, b64_uri_to_bytes, split_string
 
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from components.pipeline import micro_batch
+from components.tasks import derive_task
+
 from object_detection.utils import label_map_util
 
-detection_graph = None
-sess = None
+# Max. secs to wait for more images before running a smaller batch
+BATCH_WAIT = 0.05
+
+predictor = None
 
 
 @recipe(
@@ -33,6 +41,8 @@ sess = None
     label=(("One or more comma-separated labels. "
             "If not given inferred from labelmap"),
            "option", "l", split_string, None, None),
+    batch_size=("Max. number of images to predict at once",
+                "option", "bs", int, None, 4),
 )
 def image_tfodapimodel(dataset,
                        frozen_model_path,
@@ -42,20 +52,13 @@ def image_tfodapimodel(dataset,
                        api=None,
                        exclude=None,
                        use_display_name=False,
-                       label=None
+                       label=None,
+                       batch_size=4
                        ):
     log("RECIPE: Starting recipe image.tfodapimodel", locals())
     log("RECIPE: Loading frozen model")
-    global detection_graph
-    detection_graph = tf.Graph()
-    with detection_graph.as_default():
-        od_graph_def = tf.GraphDef()
-        with tf.gfile.GFile(frozen_model_path, 'rb') as fid:
-            serialized_graph = fid.read()
-            od_graph_def.ParseFromString(serialized_graph)
-            tf.import_graph_def(od_graph_def, name='')
-    global sess
-    sess = tf.Session(graph=detection_graph)
+    global predictor
+    predictor = FrozenGraphPredictor(frozen_model_path)
     log("RECIPE: Loaded frozen model")
     # key class names
     reverse_class_mapping_dict = label_map_util.get_label_map_dict(
@@ -73,7 +76,7 @@ def image_tfodapimodel(dataset,
         "view_id": "image_manual",
         "dataset": dataset,
         "stream": get_image_stream(stream, class_mapping_dict,
-                                   float(threshold)),
+                                   float(threshold), batch_size),
         "exclude": exclude,
         "on_exit": free_graph,
         'config': {
@@ -83,17 +86,41 @@ def image_tfodapimodel(dataset,
     }
 
 
-def get_image_stream(stream, class_mapping_dict, thresh):
-    """Function that gets the image stream with bounding box information
+def get_image_stream(stream, class_mapping_dict, thresh, batch_size=1):
+    """Function that gets the image stream with bounding box information.
+    Images are decoded in a background thread and predicted in batches of up
+    to batch_size images
 
     Arguments:
         stream (iterable): input image image stream
         class_mapping_dict (dict): with key as int and value as class name
         thresh (float): score threshold for predictions
+        batch_size (int): max. number of images to predict at once
 
     Returns:
         A generator that constantly yields a prodigy task
     """
+    for batch in micro_batch(decode_images(stream), batch_size, BATCH_WAIT):
+        np_images = [np_image for _, _, np_image in batch]
+        batch_predictions = get_batch_predictions(np_images,
+                                                  class_mapping_dict)
+        for (eg, pil_image, _), predictions in zip(batch, batch_predictions):
+            spans = [get_span(pred, pil_image) for pred in
+                     zip(*predictions) if pred[2] >= thresh]
+            task = derive_task(eg, width=pil_image.width,
+                               height=pil_image.height, spans=spans)
+            yield task
+
+
+def decode_images(stream):
+    """Decodes the images of the stream
+
+    Arguments:
+        stream (iterable): input image image stream
+
+    Returns:
+        A generator that yields (example, PIL image, numpy image) tuples
+    """
     for eg in stream:
         if not eg["image"].startswith("data"):
             msg = "Expected base64-encoded data URI, but got: '{}'."
@@ -101,14 +128,7 @@ def get_image_stream(stream, class_mapping_dict, thresh):
 
         pil_image = Image.open(io.BytesIO(b64_uri_to_bytes(eg["image"])))
         pil_image = preprocess_pil_image(pil_image)
-        np_image = np.array(pil_image)
-        predictions = get_predictions(np_image, class_mapping_dict)
-        eg["width"] = pil_image.width
-        eg["height"] = pil_image.height
-        eg["spans"] = [get_span(pred, pil_image) for pred in
-                       zip(*predictions) if pred[2] >= thresh]
-        task = copy.deepcopy(eg)
-        yield task
+        yield eg, pil_image, np.array(pil_image)
 
 
 def preprocess_pil_image(pil_img, color_mode='rgb', target_size=None):
@@ -141,6 +161,61 @@ def preprocess_pil_image(pil_img, color_mode='rgb', target_size=None):
     return pil_img
 
 
+class FrozenGraphPredictor(object):
+    """Runs a frozen object detection graph in a persistent session. The
+    input and output tensors are looked up once, and images of the same
+    size are stacked and predicted in a single sess.run
+
+    Arguments:
+        frozen_model_path (str): Path to frozen_model.pb
+    """
+
+    def __init__(self, frozen_model_path):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            od_graph_def = tf.GraphDef()
+            with tf.gfile.GFile(frozen_model_path, 'rb') as fid:
+                serialized_graph = fid.read()
+                od_graph_def.ParseFromString(serialized_graph)
+                tf.import_graph_def(od_graph_def, name='')
+        self.sess = tf.Session(graph=self.graph)
+        self.image_tensor = self.graph.get_tensor_by_name('image_tensor:0')
+        self.output_tensors = [
+            self.graph.get_tensor_by_name('detection_boxes:0'),
+            self.graph.get_tensor_by_name('detection_scores:0'),
+            self.graph.get_tensor_by_name('detection_classes:0'),
+        ]
+
+    def predict(self, numpy_images):
+        """Predicts a list of images
+
+        Arguments:
+            numpy_images (list): numpy arrays of images
+
+        Returns:
+            A list with a tuple containing numpy arrays of
+            (boxes, scores, class_ids) for each image, in order
+        """
+        groups = {}
+        for i, numpy_image in enumerate(numpy_images):
+            groups.setdefault(numpy_image.shape, []).append(i)
+        predictions = [None] * len(numpy_images)
+        for shape, indices in groups.items():
+            batch = np.stack([numpy_images[i] for i in indices])
+            start_time = time()
+            (boxes, scores, class_ids) = self.sess.run(
+                self.output_tensors, feed_dict={self.image_tensor: batch})
+            log("time taken for {} images of shape {} is {} secs".format(
+                len(indices), shape, time()-start_time))
+            for j, i in enumerate(indices):
+                predictions[i] = (boxes[j], scores[j],
+                                  class_ids[j].astype(np.int32))
+        return predictions
+
+    def close(self):
+        self.sess.close()
+
+
 def get_predictions(numpy_image, class_mapping_dict):
     """Gets predictions for a single image using Frozen Model
 
@@ -152,34 +227,26 @@ def get_predictions(numpy_image, class_mapping_dict):
         A tuple containing numpy arrays:
         (class_ids, class_names, scores, boxes)
     """
-    global detection_graph
-    global sess
-    image_tensor = detection_graph.get_tensor_by_name(
-        'image_tensor:0')
-    detection_boxes = detection_graph.get_tensor_by_name(
-        'detection_boxes:0')
-    detection_scores = detection_graph.get_tensor_by_name(
-        'detection_scores:0')
-    detection_classes = detection_graph.get_tensor_by_name(
-        'detection_classes:0')
-    num_detections = detection_graph.get_tensor_by_name(
-        'num_detections:0')
-
-    image_np_expanded = np.expand_dims(numpy_image, axis=0)
-    start_time = time()
-    (boxes, scores, class_ids, num) = sess.run(
-        [detection_boxes, detection_scores,
-         detection_classes, num_detections],
-        feed_dict={image_tensor: image_np_expanded}
-    )
-    log("time taken for image shape {} is {} secs".format(numpy_image.shape,
-                                                          time()-start_time))
-    boxes = np.squeeze(boxes)
-    class_ids = np.squeeze(class_ids).astype(np.int32)
-    class_names = np.array([class_mapping_dict[class_id]
-                            for class_id in class_ids])
-    scores = np.squeeze(scores)
-    return (class_ids, class_names, scores, boxes)
+    return get_batch_predictions([numpy_image], class_mapping_dict)[0]
+
+
+def get_batch_predictions(numpy_images, class_mapping_dict):
+    """Gets predictions for a list of images using Frozen Model
+
+    Arguments:
+        numpy_images (list): numpy arrays of images
+        class_mapping_dict (dict): with key as int and value as class name
+
+    Returns:
+        A list with a tuple of numpy arrays for each image, in order:
+        (class_ids, class_names, scores, boxes)
+    """
+    predictions = []
+    for boxes, scores, class_ids in predictor.predict(numpy_images):
+        class_names = np.array([class_mapping_dict[class_id]
+                                for class_id in class_ids])
+        predictions.append((class_ids, class_names, scores, boxes))
+    return predictions
 
 
 def get_span(prediction, pil_image, hidden=True):
@@ -226,8 +293,7 @@ def get_span(prediction, pil_image, hidden=True):
 
 
 def free_graph(ctrl):
-    global detection_graph
+    global predictor
     tf.reset_default_graph()
-    global sess
-    sess.close()
-    del detection_graph
+    predictor.close()
+    predictor = None
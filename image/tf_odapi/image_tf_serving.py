@@ -1,12 +1,8 @@
-import tensorflow as tf
-import grpc
 import numpy as np
-import copy
 import io
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 
-from tensorflow_serving.apis import predict_pb2
-from tensorflow_serving.apis import prediction_service_pb2_grpc
 from PIL import Image
 
 from prodigy.components.loaders import get_stream
@@ -14,6 +10,14 @@ from prodigy.components.preprocess import fetch_images
 from prodigy.core import recipe, recipe_args
 from prodigy.util import log, b64_uri_to_bytes, split_string
 
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from components.pipeline import micro_batch, ordered_map
+from components.tasks import derive_task
+from image.tf_odapi.serving import get_serving_client
+
 from object_detection.utils import label_map_util
 
 
@@ -33,6 +37,17 @@ from object_detection.utils import label_map_util
     label=(("One or more comma-separated labels. "
             "If not given inferred from labelmap"),
            "option", "l", split_string, None, None),
+    batch_size=("Max. number of images per prediction request",
+                "option", "bs", int, None, 8),
+    batch_wait=(("Max. milliseconds to wait for more images "
+                 "before sending a request"),
+                "option", "bw", float, None, 50),
+    concurrency=("Max. number of prediction requests in flight",
+                 "option", "cc", int, None, 4),
+    resize=(("Resize images to height,width before predicting, so images "
+             "of different sizes are sent in one request. Otherwise only "
+             "images of the same size are batched together"),
+            "option", "rs", split_string, None, None),
 )
 def image_servingmodel(dataset,
                        ip,
@@ -44,7 +59,11 @@ def image_servingmodel(dataset,
                        api=None,
                        exclude=None,
                        use_display_name=False,
-                       label=None
+                       label=None,
+                       batch_size=8,
+                       batch_wait=50,
+                       concurrency=4,
+                       resize=None
                        ):
     log("RECIPE: Starting recipe image.servingmodel", locals())
 
@@ -58,13 +77,21 @@ def image_servingmodel(dataset,
     class_mapping_dict = {v: k for k, v in reverse_class_mapping_dict.items()}
     stream = get_stream(source, api=api, loader="images", input_key="image")
     stream = fetch_images(stream)
+    target_size = tuple(int(size) for size in resize) if resize else None
+
+    def on_exit(ctrl):
+        client = get_serving_client(ip, port)
+        log("Tensorflow Serving latency: {}".format(client.latency.summary()))
 
     return {
         "view_id": "image_manual",
         "dataset": dataset,
         "stream": get_image_stream(stream, class_mapping_dict,
-                                   ip, port, model_name, float(threshold)),
+                                   ip, port, model_name, float(threshold),
+                                   batch_size, batch_wait / 1000,
+                                   concurrency, target_size),
         "exclude": exclude,
+        "on_exit": on_exit,
         'config': {
             'label': ', '.join(label) if label is not None else 'all',
             'labels': label,       # Selectable label options,
@@ -72,8 +99,16 @@ def image_servingmodel(dataset,
     }
 
 
-def get_image_stream(stream, class_mapping_dict, ip, port, model_name, thresh):
-    """Function that gets the image stream with bounding box information
+def get_image_stream(stream, class_mapping_dict, ip, port, model_name, thresh,
+                     batch_size=1, batch_wait=0.05, concurrency=1,
+                     target_size=None):
+    """Function that gets the image stream with bounding box information.
+    Images are sent to Tensorflow serving in batches of up to batch_size
+    images, or the images that arrived within batch_wait secs. Images are
+    fetched and decoded in a background thread and up to concurrency
+    requests are sent at once, while the tasks are yielded in order.
+    Only images of the same size can be sent in one request, so mixed-size
+    images are only batched if they're resized to target_size
 
     Arguments:
         stream (iterable): input image image stream
@@ -82,10 +117,47 @@ def get_image_stream(stream, class_mapping_dict, ip, port, model_name, thresh):
         port (str): tensorflow serving port
         model_name (str): model name in tensorflow serving
         thresh (float): score threshold for predictions
+        batch_size (int): max. number of images per request
+        batch_wait (float): max. secs to wait for a full batch
+        concurrency (int): max. number of requests in flight
+        target_size (tuple): (height, width) to resize the images to before
+            predicting, or None to keep their size
 
     Returns:
         A generator that constantly yields a prodigy task
     """
+    def make_tasks(batch):
+        np_images = [np_image for _, _, np_image in batch]
+        batch_predictions = get_batch_predictions(np_images, class_mapping_dict,
+                                                  ip, port, model_name)
+        tasks = []
+        for (eg, pil_image, _), predictions in zip(batch, batch_predictions):
+            spans = [get_span(pred, pil_image)
+                     for pred in zip(*predictions) if pred[2] >= thresh]
+            tasks.append(derive_task(eg, width=pil_image.width,
+                                     height=pil_image.height, spans=spans))
+        return tasks
+
+    batches = micro_batch(decode_images(stream, target_size), batch_size,
+                          batch_wait)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for tasks in ordered_map(make_tasks, batches, executor, concurrency):
+            yield from tasks
+
+
+def decode_images(stream, target_size=None):
+    """Decodes the images of the stream. The boxes predicted by the model are
+    relative to the image size, so the spans are placed on the original
+    image even if the numpy image is resized
+
+    Arguments:
+        stream (iterable): input image image stream
+        target_size (tuple): (height, width) of the numpy images, or None to
+            keep the original size
+
+    Returns:
+        A generator that yields (example, PIL image, numpy image) tuples
+    """
     for eg in stream:
         if not eg["image"].startswith("data"):
             msg = "Expected base64-encoded data URI, but got: '{}'."
@@ -93,15 +165,9 @@ def get_image_stream(stream, class_mapping_dict, ip, port, model_name, thresh):
 
         pil_image = Image.open(io.BytesIO(b64_uri_to_bytes(eg["image"])))
         pil_image = preprocess_pil_image(pil_image)
-        np_image = np.array(pil_image)
-        predictions = get_predictions(np_image, class_mapping_dict,
-                                      ip, port, model_name)
-        eg["width"] = pil_image.width
-        eg["height"] = pil_image.height
-        eg["spans"] = [get_span(pred, pil_image)
-                       for pred in zip(*predictions) if pred[2] >= thresh]
-        task = copy.deepcopy(eg)
-        yield task
+        np_image = np.array(preprocess_pil_image(pil_image,
+                                                 target_size=target_size))
+        yield eg, pil_image, np_image
 
 
 def get_predictions(numpy_image, class_mapping_dict, ip, port, model_name):
@@ -118,14 +184,41 @@ def get_predictions(numpy_image, class_mapping_dict, ip, port, model_name):
         A tuple containing numpy arrays:
         (class_ids, class_names, scores, boxes)
     """
-    if len(numpy_image.shape) == 3:
-        numpy_image = np.expand_dims(numpy_image, axis=0)
-    boxes, class_ids, scores = _tf_odapi_client(numpy_image,
-                                                ip,
-                                                port, model_name)
-    class_names = np.array([class_mapping_dict[class_id]
-                            for class_id in class_ids])
-    return (class_ids, class_names, scores, boxes)
+    if len(numpy_image.shape) == 4:
+        numpy_image = numpy_image[0]
+    return get_batch_predictions([numpy_image], class_mapping_dict,
+                                 ip, port, model_name)[0]
+
+
+def get_batch_predictions(numpy_images, class_mapping_dict, ip, port,
+                          model_name):
+    """Gets predictions for a list of images using Tensorflow serving. Images
+    of the same shape are stacked and sent in one request, so images of
+    different sizes need one request per size unless they're resized first
+
+    Arguments:
+        numpy_images (list): numpy arrays of images
+        class_mapping_dict (dict): with key as int and value as class name
+        ip (str): tensorflow serving IP
+        port (str): tensorflow serving port
+        model_name (str): model name in tensorflow serving
+
+    Returns:
+        A list with a tuple of numpy arrays for each image, in order:
+        (class_ids, class_names, scores, boxes)
+    """
+    groups = {}
+    for i, numpy_image in enumerate(numpy_images):
+        groups.setdefault(numpy_image.shape, []).append(i)
+    predictions = [None] * len(numpy_images)
+    for indices in groups.values():
+        batch = np.stack([numpy_images[i] for i in indices])
+        results = _tf_odapi_client(batch, ip, port, model_name)
+        for i, (boxes, class_ids, scores) in zip(indices, results):
+            class_names = np.array([class_mapping_dict[class_id]
+                                    for class_id in class_ids])
+            predictions[i] = (class_ids, class_names, scores, boxes)
+    return predictions
 
 
 def preprocess_pil_image(pil_img, color_mode='rgb', target_size=None):
@@ -199,13 +292,13 @@ def get_span(prediction, pil_image, hidden=True):
     }
 
 
-def _tf_odapi_client(image, ip, port, model_name,
+def _tf_odapi_client(images, ip, port, model_name,
                      signature_name="detection_signature", input_name="inputs",
                      timeout=300):
     """Client for using Tensorflow Serving with Tensorflow Object Detection API
 
     Arguments:
-        data (np.ndarray/bytes): A numpy array of data or bytes. No Default
+        images (np.ndarray): A batch of images of the same shape. No Default
         ip (str): IP address of tensorflow serving. No Default
         port (str/int): Port of tensorflow serving. No Default
         model_name (str): Model name. No Default
@@ -214,29 +307,32 @@ def _tf_odapi_client(image, ip, port, model_name,
         timeout (str): timeout for API call. Default 300 secs
 
     returns:
-        a tuple containing numpy arrays of (boxes, classes, scores)
+        a list with a tuple containing numpy arrays of (boxes, classes,
+        scores) for each image
     """
     start_time = time()
-    result = _generic_tf_serving_client(image, ip, port,
+    result = _generic_tf_serving_client(images, ip, port,
                                         model_name, signature_name,
                                         input_name, timeout
                                         )
-    log("time taken for image shape {} is {} secs".format(image.shape,
-                                                          time()-start_time))
+    log("time taken for images of shape {} is {} secs".format(
+        images.shape, time()-start_time))
+    n_images = images.shape[0]
     # boxes are ymin.xmin,ymax,xmax
     boxes = np.array(result.outputs['detection_boxes'].float_val)
     classes = np.array(result.outputs['detection_classes'].float_val)
     scores = np.array(result.outputs['detection_scores'].float_val)
-    boxes = boxes.reshape((len(scores), 4))
-    classes = np.squeeze(classes.astype(np.int32))
-    scores = np.squeeze(scores)
+    boxes = boxes.reshape((n_images, -1, 4))
+    classes = classes.astype(np.int32).reshape((n_images, -1))
+    scores = scores.reshape((n_images, -1))
 
-    return (boxes, classes, scores)
+    return list(zip(boxes, classes, scores))
 
 
 def _generic_tf_serving_client(data, ip, port, model_name,
                                signature_name, input_name, timeout=300):
-    """A generic tensorflow serving client that predicts using given data
+    """A generic tensorflow serving client that predicts using given data,
+    reusing the shared pooled channels for the server
 
     Arguments:
         data (np.ndarray): A numpy array of data. No Default
@@ -252,14 +348,6 @@ def _generic_tf_serving_client(data, ip, port, model_name,
     """
     assert isinstance(data, np.ndarray), \
         "data must be a numpy array but got {}".format(type(data))
-    channel = grpc.insecure_channel('{}:{}'.format(ip, port))
-    stub = prediction_service_pb2_grpc.PredictionServiceStub(channel)
-    request = predict_pb2.PredictRequest()
-    request.model_spec.name = model_name
-    request.model_spec.signature_name = signature_name
-    request.inputs['{}'.format(input_name)
-                   ].CopyFrom(tf.contrib.util.make_tensor_proto(
-                       data,
-                       shape=data.shape))
-    result = stub.Predict(request, timeout)
-    return result
+    client = get_serving_client(ip, port)
+    return client.predict(data, model_name, signature_name, input_name,
+                          timeout)
@@ -1,22 +1,26 @@
 import os
-import io
-import copy
-import grpc
 import shutil
 import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tensorflow as tf
 
-from PIL import Image
 from time import time
 
-from tensorflow_serving.apis import predict_pb2
-from tensorflow_serving.apis import prediction_service_pb2_grpc
-
 from prodigy.components.loaders import get_stream
 from prodigy.components.preprocess import fetch_images
 from prodigy.core import recipe, recipe_args
-from prodigy.util import log, b64_uri_to_bytes, split_string
+from prodigy.util import log, split_string
+
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from components.filters import get_input_hash
+from components.pipeline import ordered_map, prefetch
+from components.tasks import derive_task
+from image.tf_odapi.images import DecodedImageCache, decode_image
+from image.tf_odapi.serving import get_serving_client
 
 from object_detection.utils import config_util, label_map_util
 from object_detection.utils import dataset_util
@@ -66,6 +70,8 @@ from object_detection.model_hparams import create_hparams
                       "flag", "D", bool),
     tf_logging_level=("Log level for Tensorflow", "option",
                       "tl", int, (10, 20, 30, 40, 50), 40),
+    concurrency=("Max. number of prediction requests in flight",
+                 "option", "cc", int, None, 4),
     api=recipe_args["api"],
     exclude=recipe_args["exclude"],
 )
@@ -75,7 +81,7 @@ def image_trainmodel(dataset, source, config_path, ip, port, model_name,
                      steps_per_epoch=-1, threshold=0.5, temp_files_num=5,
                      max_checkpoints_num=5, run_eval=False, eval_steps=50,
                      use_display_name=False, tf_logging_level=40, api=None,
-                     exclude=None):
+                     exclude=None, concurrency=4):
     tf.logging.set_verbosity(tf_logging_level)
     _create_dir(model_dir)
     _create_dir(export_dir)
@@ -138,6 +144,8 @@ def image_trainmodel(dataset, source, config_path, ip, port, model_name,
 
     stream = get_stream(source, api=api, loader="images", input_key="image")
     stream = fetch_images(stream)
+    # Decoded images of the stream, reused when training on the answers
+    decoded_images = DecodedImageCache()
     update_fn = functools.partial(
         update_odapi_model, estimator=estimator,
         data_dir=data_dir,
@@ -146,15 +154,22 @@ def image_trainmodel(dataset, source, config_path, ip, port, model_name,
         steps_per_epoch=steps_per_epoch,
         export_dir=export_dir, run_eval=run_eval,
         eval_steps=eval_steps,
-        temp_files_num=temp_files_num)
+        temp_files_num=temp_files_num,
+        decoded_images=decoded_images)
+
+    def on_exit(ctrl):
+        client = get_serving_client(ip, port)
+        log("Tensorflow Serving latency: {}".format(client.latency.summary()))
 
     return {
         "view_id": "image_manual",
         "dataset": dataset,
         "stream": get_image_stream(stream, class_mapping_dict,
-                                   ip, port, model_name, float(threshold)),
+                                   ip, port, model_name, float(threshold),
+                                   concurrency, decoded_images),
         "exclude": exclude,
         "update": update_fn,
+        "on_exit": on_exit,
         # "progress": lambda *args, **kwargs: 0,
         'config': {
             'label': ', '.join(label) if label is not None else 'all',
@@ -163,8 +178,11 @@ def image_trainmodel(dataset, source, config_path, ip, port, model_name,
     }
 
 
-def get_image_stream(stream, class_mapping_dict, ip, port, model_name, thresh):
-    """Function that gets the image stream with bounding box information
+def get_image_stream(stream, class_mapping_dict, ip, port, model_name, thresh,
+                     concurrency=1, decoded_images=None):
+    """Function that gets the image stream with bounding box information.
+    Images are fetched in a background thread and up to concurrency images
+    are decoded and predicted at once, while the tasks are yielded in order
 
     Arguments:
         stream (iterable): input image image stream
@@ -173,31 +191,43 @@ def get_image_stream(stream, class_mapping_dict, ip, port, model_name, thresh):
         port (str): tensorflow serving port
         model_name (str): model name in tensorflow serving
         thresh (float): score threshold for predictions
+        concurrency (int): max. number of requests in flight
+        decoded_images (DecodedImageCache): cache to keep the decoded images
+            in for training on the answers. Optional
 
     Returns:
         A generator that constantly yields a prodigy task
     """
-    for eg in stream:
+    if decoded_images is None:
+        decoded_images = DecodedImageCache()
+
+    def make_task(eg):
         if not eg["image"].startswith("data"):
             msg = "Expected base64-encoded data URI, but got: '{}'."
             raise ValueError(msg.format(eg["image"][:100]))
 
-        pil_image = Image.open(io.BytesIO(b64_uri_to_bytes(eg["image"])))
+        # Decode the image once and keep it for training on the answer. Only
+        # the input hash is set here, so the answer has the same cache key and
+        # the task hash still covers the predicted spans.
+        get_input_hash(eg)
+        image = decoded_images.get(eg)
         predictions = get_predictions(eg, class_mapping_dict,
-                                      ip, port, model_name)
-        eg["width"] = pil_image.width
-        eg["height"] = pil_image.height
-        eg["spans"] = [get_span(pred, pil_image)
-                       for pred in zip(*predictions) if pred[2] >= thresh]
+                                      ip, port, model_name, image=image)
+        spans = [get_span(pred, image)
+                 for pred in zip(*predictions) if pred[2] >= thresh]
         log("Using threshold {}, got {} predictions for file {}".format(
-            thresh, len(eg["spans"]), eg["meta"]["file"]))
-        task = copy.deepcopy(eg)
-        yield task
+            thresh, len(spans), eg["meta"]["file"]))
+        return derive_task(eg, width=image.width, height=image.height,
+                           spans=spans)
+
+    stream = prefetch(stream, concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        yield from ordered_map(make_task, stream, executor, concurrency)
 
 
 def update_odapi_model(tasks, estimator, data_dir, reverse_class_mapping_dict,
                        odapi_configs, steps_per_epoch, export_dir, run_eval,
-                       eval_steps, temp_files_num):
+                       eval_steps, temp_files_num, decoded_images=None):
     """Update the object detection api model with annotations from prodigy
 
     Arguments:
@@ -212,6 +242,8 @@ def update_odapi_model(tasks, estimator, data_dir, reverse_class_mapping_dict,
         eval_steps (int): Number of steps for evaluations
         temp_files_num (int): Number of recent files/folders to keep in export
         and data directories
+        decoded_images (DecodedImageCache): decoded images of the stream.
+            Optional
 
     Returns:
         None if run_eval is False else evaluation loss (float)
@@ -221,7 +253,8 @@ def update_odapi_model(tasks, estimator, data_dir, reverse_class_mapping_dict,
         tasks=tasks,
         output_file=os.path.join(data_dir,
                                  train_data_name),
-        reverse_class_mapping_dict=reverse_class_mapping_dict
+        reverse_class_mapping_dict=reverse_class_mapping_dict,
+        decoded_images=decoded_images
     )
     if num_examples == 0:
         log("No training data found! Skipping model update")
@@ -279,7 +312,8 @@ def update_odapi_model(tasks, estimator, data_dir, reverse_class_mapping_dict,
         return None
 
 
-def get_predictions(single_stream, class_mapping_dict, ip, port, model_name):
+def get_predictions(single_stream, class_mapping_dict, ip, port, model_name,
+                    image=None):
     """Gets predictions for a single image using Tensorflow serving
 
     Arguments:
@@ -288,36 +322,22 @@ def get_predictions(single_stream, class_mapping_dict, ip, port, model_name):
         ip (str): tensorflow serving IP
         port (str): tensorflow serving port
         model_name (str): model name in tensorflow serving
+        image (DecodedImage): The decoded image of the stream. Optional
 
     Returns:
         A tuple containing numpy arrays:
         (class_ids, class_names, scores, boxes)
     """
-    image_byte_stream = b64_uri_to_bytes(single_stream["image"])
-    encoded_image_io = io.BytesIO(image_byte_stream)
-    image = Image.open(encoded_image_io)
-    width, height = image.size
-    filename = str(single_stream["meta"]["file"])
-    file_extension = filename.split(".")[1].lower()
-    if file_extension == "png":
-        image_format = b'png'
-    elif file_extension in ("jpg", "jpeg"):
-        image_format = b'jpg'
-    else:
-        log(("Only 'png', 'jpeg' or 'jpg' files are supported by ODAPI. "
-             "Got {}. Thus treating it as `jpg` file. "
-             "Might cause errors".format(file_extension)
-             ))
-        image_format = b'jpg'
-
-    filename = filename.encode("utf-8")
+    if image is None:
+        image = decode_image(single_stream)
+    filename = str(single_stream["meta"]["file"]).encode("utf-8")
     tf_example = tf.train.Example(features=tf.train.Features(feature={
-        'image/height': dataset_util.int64_feature(height),
-        'image/width': dataset_util.int64_feature(width),
+        'image/height': dataset_util.int64_feature(image.height),
+        'image/width': dataset_util.int64_feature(image.width),
         'image/filename': dataset_util.bytes_feature(filename),
         'image/source_id': dataset_util.bytes_feature(filename),
-        'image/encoded': dataset_util.bytes_feature(image_byte_stream),
-        'image/format': dataset_util.bytes_feature(image_format),
+        'image/encoded': dataset_util.bytes_feature(image.data),
+        'image/format': dataset_util.bytes_feature(image.format),
     }))
 
     boxes, class_ids, scores = tf_odapi_client(tf_example.SerializeToString(),
@@ -351,13 +371,16 @@ def _export_saved_model(export_dir, estimator, odapi_configs):
     log("Exported SavedModel!")
 
 
-def _write_tf_record(tasks, output_file, reverse_class_mapping_dict):
+def _write_tf_record(tasks, output_file, reverse_class_mapping_dict,
+                     decoded_images=None):
     """Private function which writes training TF-Record file
 
     Arguments:
         tasks (iterable): prodigy's tasks
         output_file (str): output TF-Record filename
         reverse_class_mapping_dict (dict): key as class name and value as int
+        decoded_images (DecodedImageCache): decoded images of the stream.
+            Optional
 
     Returns:
         a counter containing number of examples returned
@@ -366,7 +389,8 @@ def _write_tf_record(tasks, output_file, reverse_class_mapping_dict):
     counter = 0
     for task in tasks:
         if task['answer'] == 'accept':
-            tf_example = create_a_tf_example(task, reverse_class_mapping_dict)
+            tf_example = create_a_tf_example(task, reverse_class_mapping_dict,
+                                             decoded_images)
             writer.write(tf_example.SerializeToString())
             counter += 1
         else:
@@ -397,7 +421,7 @@ def get_span(prediction, pil_image, hidden=True):
 
     Arguments:
         prediction (iterable): containing one class_id, name, prob, box
-        pil_image (pil.Image): A PIL image
+        pil_image (pil.Image/DecodedImage): An image with width and height
         hidden (bool)
 
     Returns:
@@ -466,7 +490,8 @@ def tf_odapi_client(data, ip, port, model_name,
 
 def generic_tf_serving_client(data, ip, port, model_name,
                               signature_name, input_name, timeout=300):
-    """A generic tensorflow serving client that predicts using given data
+    """A generic tensorflow serving client that predicts using given data,
+    reusing the shared pooled channels for the server
 
     Arguments:
         data (np.ndarray/bytes): A numpy array of data or bytes. No Default
@@ -483,16 +508,9 @@ def generic_tf_serving_client(data, ip, port, model_name,
     start_time = time()
     assert isinstance(data, (np.ndarray, bytes)), \
         "data must be a numpy array or bytes but got {}".format(type(data))
-    channel = grpc.insecure_channel('{}:{}'.format(ip, port))
-    stub = prediction_service_pb2_grpc.PredictionServiceStub(channel)
-    request = predict_pb2.PredictRequest()
-    request.model_spec.name = model_name
-    request.model_spec.signature_name = signature_name
-    request.inputs['{}'.format(input_name)
-                   ].CopyFrom(tf.contrib.util.make_tensor_proto(
-                       data,
-                   ))
-    result = stub.Predict(request, timeout)
+    client = get_serving_client(ip, port)
+    result = client.predict(data, model_name, signature_name, input_name,
+                            timeout)
     log(("time taken for prediction using model {} "
          "version {} is: {} secs").format(
         str(result.model_spec.name), result.model_spec.version.value,
@@ -500,32 +518,25 @@ def generic_tf_serving_client(data, ip, port, model_name,
     return result
 
 
-def create_a_tf_example(single_stream, reverse_class_mapping_dict):
-    """Function to create a single training Tf.Example object
+def create_a_tf_example(single_stream, reverse_class_mapping_dict,
+                        decoded_images=None):
+    """Function to create a single training Tf.Example object. The decoded
+    image is reused from the stream if it's still cached
 
     Arguments:
         single_stream (dict): A single prodigy stream
         reverse_class_mapping_dict (dict): key as class name and value as int
+        decoded_images (DecodedImageCache): decoded images of the stream.
+            Optional
 
     Returns:
         A single training tf.Example compatible with object detection API
     """
-    image_byte_stream = b64_uri_to_bytes(single_stream["image"])
-    encoded_image_io = io.BytesIO(image_byte_stream)
-    image = Image.open(encoded_image_io)
-    width, height = image.size
-    filename = str(single_stream["meta"]["file"])
-    file_extension = filename.split(".")[1].lower()
-    if file_extension == "png":
-        image_format = b'png'
-    elif file_extension in ("jpg", "jpeg"):
-        image_format = b'jpg'
+    if decoded_images is not None:
+        image = decoded_images.get(single_stream)
     else:
-        log(("Only 'png', 'jpeg' or 'jpg' files are supported by ODAPI. "
-             "Got {}. Thus treating it as `jpg` file. "
-             "Might cause errors".format(file_extension)
-             ))
-        image_format = b'jpg'
+        image = decode_image(single_stream)
+    width, height = image.width, image.height
 
     xmins = []
     xmaxs = []
@@ -534,7 +545,7 @@ def create_a_tf_example(single_stream, reverse_class_mapping_dict):
     classes_text = []
     classes = []
 
-    filename = filename.encode("utf-8")
+    filename = str(single_stream["meta"]["file"]).encode("utf-8")
     for span in single_stream["spans"]:
         points = np.array(span["points"])
         xmin, ymin = np.amin(points, axis=0)
@@ -567,8 +578,8 @@ def create_a_tf_example(single_stream, reverse_class_mapping_dict):
         'image/width': dataset_util.int64_feature(width),
         'image/filename': dataset_util.bytes_feature(filename),
         'image/source_id': dataset_util.bytes_feature(filename),
-        'image/encoded': dataset_util.bytes_feature(image_byte_stream),
-        'image/format': dataset_util.bytes_feature(image_format),
+        'image/encoded': dataset_util.bytes_feature(image.data),
+        'image/format': dataset_util.bytes_feature(image.format),
         'image/object/bbox/xmin': dataset_util.float_list_feature(xmins),
         'image/object/bbox/xmax': dataset_util.float_list_feature(xmaxs),
         'image/object/bbox/ymin': dataset_util.float_list_feature(ymins),
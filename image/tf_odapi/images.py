@@ -0,0 +1,79 @@
+"""Decoded images shared between the stream and the model updates of the
+TF-ODAPI recipes, so each image is only decoded once."""
+import io
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image
+
+from prodigy.util import log, b64_uri_to_bytes, INPUT_HASH_ATTR
+
+
+# Number of recent decoded images kept for training on the answers
+DECODED_CACHE_SIZE = 128
+
+# The raw bytes, size and ODAPI format of a task's image
+DecodedImage = namedtuple("DecodedImage", ["data", "width", "height",
+                                           "format"])
+
+
+def decode_image(single_stream):
+    """Function to decode the image of a task. Only the image header is
+    parsed to get the image size
+
+    Arguments:
+        single_stream (dict): A single prodigy stream
+
+    Returns:
+        A DecodedImage with the raw bytes, width, height and format
+    """
+    image_byte_stream = b64_uri_to_bytes(single_stream["image"])
+    encoded_image_io = io.BytesIO(image_byte_stream)
+    image = Image.open(encoded_image_io)
+    width, height = image.size
+    filename = str(single_stream["meta"]["file"])
+    file_extension = filename.split(".")[1].lower()
+    if file_extension == "png":
+        image_format = b'png'
+    elif file_extension in ("jpg", "jpeg"):
+        image_format = b'jpg'
+    else:
+        log(("Only 'png', 'jpeg' or 'jpg' files are supported by ODAPI. "
+             "Got {}. Thus treating it as `jpg` file. "
+             "Might cause errors".format(file_extension)
+             ))
+        image_format = b'jpg'
+    return DecodedImage(image_byte_stream, width, height, image_format)
+
+
+class DecodedImageCache(object):
+    """Thread-safe LRU cache of decoded images, keyed by the input hash of
+    the tasks, so the images decoded for the predictions are reused when
+    training on the answers. The input hash must be set before the image is
+    decoded in the stream, so the answer has the same key. Tasks without an
+    input hash are decoded but not cached
+
+    Arguments:
+        maxsize (int): Number of images to keep. Default DECODED_CACHE_SIZE
+    """
+
+    def __init__(self, maxsize=DECODED_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, single_stream):
+        """Gets the decoded image of a task, decoding it if not cached"""
+        key = single_stream.get(INPUT_HASH_ATTR)
+        if key is None:
+            return decode_image(single_stream)
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+        image = decode_image(single_stream)
+        with self.lock:
+            self.images[key] = image
+            while len(self.images) > self.maxsize:
+                self.images.popitem(last=False)
+        return image
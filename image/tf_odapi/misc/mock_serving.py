@@ -0,0 +1,101 @@
+"""
+A mock Tensorflow Serving server for the TF-ODAPI recipes
+
+Answers every Predict request with random detections after a fixed delay,
+so the client side of `image.servingmodel` and `image.trainmodel` (channel
+reuse, retries, batching and the latency histogram logged on exit) can be
+measured without a real model.
+
+`python mock_serving.py --help` to know how to use this script
+"""
+import random
+from argparse import RawTextHelpFormatter, ArgumentParser
+from concurrent import futures
+from time import sleep
+
+import grpc
+import numpy as np
+import tensorflow as tf
+
+from tensorflow_serving.apis import predict_pb2
+from tensorflow_serving.apis import prediction_service_pb2_grpc
+
+
+class MockPredictionService(
+        prediction_service_pb2_grpc.PredictionServiceServicer):
+    """Returns num_detections random boxes for every input in the batch"""
+
+    def __init__(self, delay, num_detections, num_classes, failure_rate):
+        self.delay = delay
+        self.num_detections = num_detections
+        self.num_classes = num_classes
+        self.failure_rate = failure_rate
+
+    def Predict(self, request, context):
+        if random.random() < self.failure_rate:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "Mock failure")
+        sleep(self.delay)
+        batch_size = 1
+        for tensor in request.inputs.values():
+            dims = tensor.tensor_shape.dim
+            if dims:
+                batch_size = dims[0].size
+        shape = (batch_size, self.num_detections)
+        corners = np.sort(np.random.rand(*shape, 2, 2), axis=2)
+        # boxes are ymin,xmin,ymax,xmax
+        boxes = corners.reshape(shape + (4,))
+        scores = -np.sort(-np.random.rand(*shape), axis=1)
+        classes = np.random.randint(1, self.num_classes + 1, size=shape)
+        outputs = {
+            "detection_boxes": boxes,
+            "detection_scores": scores,
+            "detection_classes": classes,
+            "num_detections": np.full((batch_size,), self.num_detections),
+        }
+        response = predict_pb2.PredictResponse()
+        response.model_spec.CopyFrom(request.model_spec)
+        for name, value in outputs.items():
+            response.outputs[name].CopyFrom(
+                tf.contrib.util.make_tensor_proto(value.astype(np.float32)))
+        return response
+
+
+def main(port, delay, num_detections, num_classes, failure_rate, workers):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+    service = MockPredictionService(delay, num_detections, num_classes,
+                                    failure_rate)
+    prediction_service_pb2_grpc.add_PredictionServiceServicer_to_server(
+        service, server)
+    server.add_insecure_port("[::]:{}".format(port))
+    server.start()
+    print("Mock Tensorflow Serving listening on port {}".format(port))
+    server.wait_for_termination()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Mock Tensorflow Serving server",
+                            formatter_class=RawTextHelpFormatter
+                            )
+    parser.add_argument("--port", "-p",
+                        help="Port to listen on. Default 8500",
+                        type=int, metavar="", default=8500)
+    parser.add_argument("--delay", "-d",
+                        help="Seconds to wait before answering. Default 0.1",
+                        type=float, metavar="", default=0.1)
+    parser.add_argument("--num_detections", "-n",
+                        help="Detections per image. Default 10",
+                        type=int, metavar="", default=10)
+    parser.add_argument("--num_classes", "-c",
+                        help=("Number of classes, must match the label map. "
+                              "Default 1"),
+                        type=int, metavar="", default=1)
+    parser.add_argument("--failure_rate", "-f",
+                        help=("Share of requests failing with UNAVAILABLE. "
+                              "Default 0"),
+                        type=float, metavar="", default=0.0)
+    parser.add_argument("--workers", "-w",
+                        help="Number of server threads. Default 10",
+                        type=int, metavar="", default=10)
+    args = parser.parse_args()
+    main(args.port, args.delay, args.num_detections, args.num_classes,
+         args.failure_rate, args.workers)
@@ -0,0 +1,183 @@
+"""A pooled, reusable gRPC client for Tensorflow Serving, shared by the
+`image.servingmodel` and `image.trainmodel` recipes."""
+import threading
+from bisect import bisect_left
+from itertools import cycle
+from time import sleep, time
+
+import grpc
+import tensorflow as tf
+
+from tensorflow_serving.apis import predict_pb2
+from tensorflow_serving.apis import prediction_service_pb2_grpc
+
+from prodigy.util import log
+
+
+# Upper bounds of the latency histogram buckets in seconds. The last bucket
+# counts everything slower than the largest bound.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+# Errors that mean the request didn't reach the model or the server was
+# temporarily overloaded, so it's safe to send the request again
+RETRY_CODES = (grpc.StatusCode.UNAVAILABLE,
+               grpc.StatusCode.RESOURCE_EXHAUSTED)
+
+# Keep idle connections alive, so requests after an annotator's break don't
+# pay for a new connection. Images can be larger than the default 4 MB limit.
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+]
+
+
+class LatencyHistogram(object):
+    """Thread-safe histogram of request latencies with fixed buckets"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, seconds)] += 1
+            self.total += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the q-th quantile, or None
+        if nothing was observed (or it's in the last, open bucket)"""
+        n = len(self)
+        if n == 0:
+            return None
+        rank = q * n
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        n = len(self)
+        return {
+            "count": n,
+            "mean": self.total / n if n else None,
+            "buckets": {str(bound): count for bound, count
+                        in zip(self.buckets + ("inf",), self.counts)},
+        }
+
+    def summary(self):
+        n = len(self)
+        if n == 0:
+            return "no requests"
+        quantiles = ", ".join(
+            "p{}<={}".format(int(q * 100), self.quantile(q) or "inf")
+            for q in (0.5, 0.9, 0.99))
+        return "{} requests, mean {:.3f} secs, {}".format(
+            n, self.total / n, quantiles)
+
+
+class ServingClient(object):
+    """Client for the Tensorflow Serving prediction service using a pool of
+    long-lived gRPC channels to one server
+
+    Requests are spread round-robin over the channels, so concurrent
+    requests don't queue up on a single HTTP/2 connection. Each request has
+    a deadline covering all its attempts, and requests that fail because
+    the server is unavailable or overloaded are retried with exponential
+    back-off. The latency of every successful call is recorded in the
+    `latency` histogram.
+
+    Arguments:
+        ip (str): IP address of tensorflow serving. No Default
+        port (str/int): Port of tensorflow serving. No Default
+        pool_size (int): Number of channels. Default 4
+        max_retries (int): Number of retries per request. Default 3
+        backoff (float): Delay before the first retry in secs, doubled
+            for every further retry. Default 0.1
+    """
+
+    def __init__(self, ip, port, pool_size=4, max_retries=3, backoff=0.1):
+        self.target = "{}:{}".format(ip, port)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.channels = [grpc.insecure_channel(self.target,
+                                               options=CHANNEL_OPTIONS)
+                         for _ in range(pool_size)]
+        self.stubs = [prediction_service_pb2_grpc.PredictionServiceStub(c)
+                      for c in self.channels]
+        self.latency = LatencyHistogram()
+        self._stubs = cycle(self.stubs)
+        self._lock = threading.Lock()
+
+    def predict(self, data, model_name, signature_name, input_name,
+                timeout=300):
+        """Predict using given data
+
+        Arguments:
+            data (np.ndarray/bytes): A numpy array of data or bytes
+            model_name (str): Model name
+            signature_name (str): Signature name
+            input_name (str): Input tensor name
+            timeout (float): Deadline for the request including all
+                retries. Default 300 secs
+
+        returns:
+            Prediction protobuf
+        """
+        request = predict_pb2.PredictRequest()
+        request.model_spec.name = model_name
+        request.model_spec.signature_name = signature_name
+        request.inputs[input_name].CopyFrom(
+            tf.contrib.util.make_tensor_proto(data))
+        deadline = time() + timeout
+        attempt = 0
+        while True:
+            with self._lock:
+                stub = next(self._stubs)
+            start_time = time()
+            try:
+                result = stub.Predict(request,
+                                      timeout=max(deadline - start_time, 0))
+            except grpc.RpcError as e:
+                delay = self.backoff * 2 ** attempt
+                if (e.code() not in RETRY_CODES
+                        or attempt >= self.max_retries
+                        or time() + delay >= deadline):
+                    raise
+                log("Tensorflow Serving request failed with {}, retrying "
+                    "in {} secs".format(e.code(), delay))
+                sleep(delay)
+                attempt += 1
+                continue
+            self.latency.observe(time() - start_time)
+            return result
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_serving_client(ip, port, **kwargs):
+    """Get the shared client for a Tensorflow Serving server, creating it on
+    first use. Keyword arguments are passed to ServingClient."""
+    key = "{}:{}".format(ip, port)
+    with _clients_lock:
+        if key not in _clients:
+            log("Connecting to Tensorflow Serving at {}".format(key))
+            _clients[key] = ServingClient(ip, port, **kwargs)
+        return _clients[key]
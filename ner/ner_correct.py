@@ -1,19 +1,41 @@
-import copy
 from typing import List, Optional
+from itertools import islice
+import threading
+from wasabi import msg
 import spacy
+from spacy.tokens import Doc, Span
 from spacy.training import Example
 import prodigy
-from prodigy.components.loaders import JSONL
+from prodigy.components.db import connect
 from prodigy.components.preprocess import add_tokens, split_sentences
 from prodigy.util import split_string, set_hashes
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import DocBinStream, IndexedJSONL, is_docbin_source
+from components.filters import SeenInputs
+from components.pipeline import pipe_docs, pipe_examples
+from components.tasks import derive_task
+from components.updates import UpdateScheduler
 
-def make_tasks(nlp, stream, labels):
-    """Add a 'spans' key to each example, with predicted entities."""
-    # Process the stream using spaCy's nlp.pipe, which yields doc objects.
-    # If as_tuples=True is set, you can pass in (text, context) tuples.
-    texts = ((eg["text"], eg) for eg in stream)
-    for doc, eg in nlp.pipe(texts, as_tuples=True):
-        task = copy.deepcopy(eg)
+def make_tasks(nlp, stream, labels, n_process=1, batch_size=32, pretokenized=False, lock=None):
+    """
+    Add a 'spans' key to each example, with predicted entities. If
+    pretokenized is True, the stream yields (doc, example) tuples and the
+    model is run on the stored Docs, keeping their tokens and entities. If a
+    lock is given, it's held while the model predicts a batch, but not while
+    the examples are read from the stream.
+    """
+    # Process the stream using spaCy's nlp.pipe, which yields (doc, example)
+    # tuples in input order. With n_process > 1, the batches are sharded
+    # across a pool of worker processes and prefetched in the background.
+    pipe = pipe_docs if pretokenized else pipe_examples
+    if lock is None:
+        docs = pipe(nlp, stream, n_process=n_process, batch_size=batch_size)
+    else:
+        docs = locked_pipe(pipe, nlp, stream, lock, batch_size=batch_size)
+    for doc, eg in docs:
         spans = []
         for ent in doc.ents:
             # Ignore if the predicted entity is not in the selected labels.
@@ -30,12 +52,63 @@ def make_tasks(nlp, stream, labels):
                     "label": ent.label_,
                 }
             )
-        task["spans"] = spans
+        task = derive_task(eg, spans=spans)
         # Rehash the newly created task so that hashes reflect added data.
         task = set_hashes(task)
         yield task
 
 
+def locked_pipe(pipe, nlp, stream, lock, batch_size=32):
+    """
+    Read a batch of examples from the stream, then run the pipeline on it
+    while holding the lock, so only the prediction waits for model updates.
+    """
+    stream = iter(stream)
+    while True:
+        batch = list(islice(stream, batch_size))
+        if not batch:
+            return
+        with lock:
+            docs = list(pipe(nlp, batch, batch_size=batch_size))
+        yield from docs
+
+
+def make_examples(nlp, answers, default_label="missing"):
+    """
+    Create training examples from the accepted answers. The Docs are built
+    from the tokens of the tasks, so pre-tokenized examples keep their stored
+    tokenization. Spans that don't align with the tokens are skipped.
+    """
+    examples = []
+    for eg in answers:
+        if eg["answer"] != "accept":
+            continue
+        if "tokens" in eg:
+            words = [token["text"] for token in eg["tokens"]]
+            spaces = [token["ws"] for token in eg["tokens"]]
+            pred = Doc(nlp.vocab, words=words, spaces=spaces)
+            ref = Doc(nlp.vocab, words=words, spaces=spaces)
+        else:
+            pred = nlp.make_doc(eg["text"])
+            ref = nlp.make_doc(eg["text"])
+        spans = []
+        for span in eg.get("spans", []):
+            if "token_start" in span and "token_end" in span:
+                start, end = span["token_start"], span["token_end"] + 1
+                ent = Span(ref, start, end, label=span["label"]) if 0 <= start < end <= len(ref) else None
+            else:
+                ent = ref.char_span(span["start"], span["end"], label=span["label"])
+            if ent is None or (ent.start_char, ent.end_char) != (span["start"], span["end"]):
+                msg.warn(f"Skipping span that doesn't align with the tokens: {span}")
+                continue
+            spans.append(ent)
+        # Use the information in spans to set named entites in the document specifying
+        # how to handle the tokens outside the provided spans.
+        ref.set_ents(spans, default=default_label)
+        examples.append(Example(pred, ref))
+    return examples
+
+
 # Recipe decorator with argument annotations: (description, argument type,
 # shortcut, type / converter function called on value before it's passed to
 # the function). Descriptions are also shown when typing --help.
@@ -43,12 +116,14 @@ def make_tasks(nlp, stream, labels):
     "ner.correct",
     dataset=("The dataset to use", "positional", None, str),
     spacy_model=("The base model", "positional", None, str),
-    source=("The source data as a JSONL file", "positional", None, str),
+    source=("The source data as a JSONL file, or a .spacy file or directory of pre-tokenized Docs", "positional", None, str),
     label=("One or more comma-separated labels", "option", "l", split_string),
     update=("Whether to update the model during annotation", "flag", "UP", bool),
     exclude=("Names of datasets to exclude", "option", "e", split_string),
     unsegmented=("Don't split sentences", "flag", "U", bool),
     component=("Name of NER component in the pipeline", "option", "c", str),
+    n_process=("Number of processes to use for model inference", "option", "np", int),
+    batch_size=("Batch size for model inference", "option", "bs", int),
 )
 def ner_correct(
     dataset: str,
@@ -59,6 +134,8 @@ def ner_correct(
     exclude: Optional[List[str]] = None,
     unsegmented: bool = False,
     component: Optional[str] = "ner",
+    n_process: int = 1,
+    batch_size: int = 32,
 ):
     """
     Create gold-standard data by correcting a model's predictions manually.
@@ -77,50 +154,71 @@ def ner_correct(
     # Check if we're annotating all labels present in the model or a subset.
     use_all_model_labels = len(set(labels).intersection(set(model_labels))) == len(model_labels)
 
-    # Load the stream from a JSONL file and return a generator that yields a
-    # dictionary for each example in the data.
-    stream = JSONL(source)
+    # Skip examples that are already annotated in the dataset or in one of the
+    # excluded datasets before they're tokenized and the model runs on them.
+    # The seen input hashes are kept in a persistent index that's updated with
+    # every batch of answers, so restarts don't need to read all annotations.
+    # Prodigy's own exclude filter still runs as the source of truth.
+    seen_inputs = SeenInputs(connect(), dataset, exclude)
 
-    if not unsegmented:
-        # Use spaCy to split text into sentences.
-        stream = split_sentences(nlp, stream)
+    pretokenized = is_docbin_source(source)
+    if pretokenized:
+        # Load (doc, example) tuples from spaCy DocBin files, split into
+        # sentences if the Docs have sentence boundaries. The examples
+        # already have the tokens of the stored Docs, and the model keeps
+        # their existing entities.
+        stream = DocBinStream(source, nlp.vocab, split_sents=not unsegmented)
+        stream = ((doc, eg) for doc, eg in stream.iter_docs() if eg not in seen_inputs)
+    else:
+        # Load the stream from a JSONL file and return a generator that yields a
+        # dictionary for each example in the data.
+        stream = IndexedJSONL(source)
 
-    # Tokenize the incoming examples and add a "tokens" property to each
-    # example. Also handles pre-defined selected spans. Tokenization allows
-    # faster highlighting, because the selection can "snap" to token boundaries.
-    stream = add_tokens(nlp, stream)
+        if not unsegmented:
+            # Use spaCy to split text into sentences.
+            stream = split_sentences(nlp, stream)
+
+        stream = seen_inputs.filter(stream)
+
+        # Tokenize the incoming examples and add a "tokens" property to each
+        # example. Also handles pre-defined selected spans. Tokenization allows
+        # faster highlighting, because the selection can "snap" to token boundaries.
+        stream = add_tokens(nlp, stream)
 
     # Add the entities predicted by the model to the tasks in the stream.
-    stream = make_tasks(nlp, stream, labels)
+    # Updates are only applied to the model in the main process, so the
+    # worker processes would keep predicting with the initial weights.
+    if update and n_process > 1:
+        msg.warn("Model updates aren't visible to worker processes, using --n-process 1")
+        n_process = 1
+    # The lock makes sure the model isn't updated while it's predicting. It's
+    # only held around the predictions, not while the stream is read.
+    model_lock = threading.Lock()
+    stream = make_tasks(
+        nlp, stream, labels, n_process=n_process, batch_size=batch_size,
+        pretokenized=pretokenized, lock=model_lock if update else None,
+    )
 
     def make_update(answers):
         """Update the model with the received answers to improve future suggestions"""
-        examples = []
         # Set the default label for the tokens outside the provided spans.
         default_label = "outside" if use_all_model_labels else "missing"
-        for eg in answers:
-            if eg["answer"] == "accept":
-                # Create a "predicted" doc object and a "reference" doc objects to be used
-                # as a training example in the model update. If your examples contain tokenization
-                # make sure not to loose this information by initializing the doc object from scratch.
-                pred = nlp.make_doc(eg["text"])
-                ref = nlp.make_doc(eg["text"])
-                spans = [
-                    pred.char_span(span["start"], span["end"], label=span["label"])
-                    for span in eg.get("spans", [])
-                ]
-                # Use the information in spans to set named entites in the document specifying
-                # how to handle the tokens outside the provided spans.
-                ref.set_ents(spans, default=default_label)
-                examples.append(Example(pred, ref))
-        nlp.update(examples)
+        examples = make_examples(nlp, answers, default_label)
+        if examples:
+            nlp.update(examples)
+
+    # Queue the incoming answers and update the model on a dedicated worker
+    # thread, so submitting answers doesn't block. Answers that arrive while
+    # the model is updating are coalesced into larger minibatches.
+    update_scheduler = UpdateScheduler(make_update, lock=model_lock)
 
     return {
         "view_id": "ner_manual",  # Annotation interface to use
         "dataset": dataset,  # Name of dataset to save annotations
         "stream": stream,  # Incoming stream of examples
-        "update": make_update if update else None, # Update the model in the loop if required
+        "update": update_scheduler if update else None, # Update the model in the loop if required
         "exclude": exclude,  # List of dataset names to exclude
+        "before_db": seen_inputs.add,  # Add new answers to the index of seen inputs
         "config": {  # Additional config settings, mostly for app UI
             "lang": nlp.lang,
             "labels": labels,  # Selectable label options
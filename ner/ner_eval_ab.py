@@ -1,30 +1,89 @@
-from collections import Counter
+from itertools import islice
 from typing import List, Optional
 import random
 from wasabi import msg
 import spacy
 import prodigy
-from prodigy.components.loaders import JSONL
-from prodigy.util import split_string
+from prodigy.components.db import connect
+from prodigy.util import split_string, INPUT_HASH_ATTR
 from prodigy.components.preprocess import split_sentences, set_hashes
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.cache import PredictionCache
+from components.evaluation import ABTally
+from components.loaders import IndexedJSONL
+from components.pipeline import broadcast, pipe_examples, prefetch
+from components.util import update_dataset_meta
 
+# Key of the running tally of the answers in the dataset meta
+TALLY_META_KEY = "eval_ab_tally"
 
-def make_tasks(nlp, labels, stream):
+
+def get_entities(doc):
+    """Get the start and end character offsets and labels of all entities."""
+    return [
+        {"start": ent.start_char, "end": ent.end_char, "label": ent.label_}
+        for ent in doc.ents
+    ]
+
+
+def predict_cached(nlp, stream, cache, n_process=1, batch_size=10):
+    """
+        Yield (entities, example) tuples in input order. The cache is looked
+        up in batches and the model is only run on the examples that aren't
+        cached yet. New predictions are added to the cache.
+    """
+
+    def lookup():
+        examples = iter(stream)
+        while True:
+            batch = list(islice(examples, batch_size))
+            if not batch:
+                return
+            # Key the predictions by the input hash of the sentence
+            hashes = [set_hashes({"text": eg["text"]})[INPUT_HASH_ATTR] for eg in batch]
+            cached = cache.get_many(hashes)
+            for input_hash, eg in zip(hashes, batch):
+                yield input_hash, cached.get(input_hash), eg
+
+    # With n_process > 1, the misses are read by the prefetch thread of
+    # pipe_examples while the items are read here. The iterators returned by
+    # broadcast share a lock, so the lookup only ever runs in one thread.
+    items, pending = broadcast(lookup(), 2)
+    misses = (eg for _, ents, eg in pending if ents is None)
+    docs = pipe_examples(nlp, misses, n_process=n_process, batch_size=batch_size)
+    new = []
+    for input_hash, ents, eg in items:
+        if ents is None:
+            doc, _ = next(docs)
+            ents = get_entities(doc)
+            new.append((input_hash, ents))
+            if len(new) >= batch_size:
+                cache.set_many(new)
+                new = []
+        yield ents, eg
+    if new:
+        cache.set_many(new)
+
+
+def make_tasks(nlp, labels, stream, n_process=1, batch_size=10, cache=None):
     """
         Generate a task for each example in a stream so that it contains:
         a unique id, text input and model's predictions as output.
     """
-    texts = ((eg["text"], eg) for eg in stream)
-    # Process the stream using spaCy's nlp.pipe, which yields doc objects.
-    # If as_tuples=True is set, you can pass in (text, context) tuples.
-    for i, (doc, eg) in enumerate(nlp.pipe(texts, as_tuples=True, batch_size=10)):
-        spans = []
-        for ent in doc.ents:
-            label = ent.label_
-            if not labels or label in labels:
-                start = ent.start_char
-                end = ent.end_char
-                spans.append({"start": start, "end": end, "label": label})
+    if cache is not None:
+        # Only run the model on the examples that aren't in the cache
+        predictions = predict_cached(nlp, stream, cache, n_process, batch_size)
+    else:
+        # Process the stream using spaCy's nlp.pipe, which yields (doc, example)
+        # tuples in input order. With n_process > 1, the batches are sharded
+        # across a pool of worker processes and prefetched in the background.
+        docs = pipe_examples(nlp, stream, n_process=n_process, batch_size=batch_size)
+        predictions = ((get_entities(doc), eg) for doc, eg in docs)
+    for i, (ents, eg) in enumerate(predictions):
+        spans = [span for span in ents if not labels or span["label"] in labels]
         task = {
             "id": i,
             "input": {"text": eg["text"]},
@@ -34,23 +93,21 @@ def make_tasks(nlp, labels, stream):
         task = set_hashes(task)
         yield task
 
-def get_compare_questions(a_questions, b_questions):
+def get_compare_questions(pairs):
     """Generate evaluation stream that consists of choice type tasks."""
-    a_questions = {a["id"]: a for a in a_questions}
-    b_questions = {b["id"]: b for b in b_questions}
-    for id_, a in a_questions.items():
-        # Ignore the questions that do not appear in both streams.
-        if id_ not in b_questions:
-            continue
+    for a, b in pairs:
         question = {
             **a["input"],
-            "id": id_,
+            "id": a["id"],
             "A": a["output"],
-            "B": b_questions[id_]["output"],
+            "B": b["output"],
         }
         # Ignore if the answers from both models are the same.
         if question["A"] == question["B"]:
             continue
+        # Hash the outputs before their order is randomized, so the same
+        # comparison has the same task hash in every session.
+        question = set_hashes(question, task_keys=("A", "B"))
         # Randomize the order of the outputs of the compared models.
         if  random.random() >= 0.5:
             order = ["B", "A"]
@@ -64,28 +121,13 @@ def get_compare_questions(a_questions, b_questions):
             question["options"].append(option)
         yield question
 
-def print_results(ctrl):
+def print_results(tally):
     """Print the results of the evaluation to stdout."""
     # Set the mapping from stream identifiers used in the tasks to meanigful stream names
     # to be used in the report.
     streamnames = {"A": "Before", "B": "After"}
-    examples = ctrl.db.get_dataset(ctrl.dataset)
-    counts = Counter()
-    answers = {}
-    for eg in examples:
-        if "answer" not in eg:
-            continue
-        if "options" in eg:  # task created with choice UI
-            selected = eg.get("accept", [])
-            if not selected or len(selected) != 1 or eg["answer"] != "accept":
-                continue
-            answers[eg["id"]] = (eg["answer"], selected[0])
-    for answer, selected in answers.values():
-        if answer == "ignore":
-            counts["ignore"] += 1
-        else:
-            counts[selected] += 1
-    if not counts:
+    counts = tally.counts
+    if not any(counts.values()):
         raise ValueError("No answers found!")
 
     msg.divider("Evaluation results")
@@ -95,6 +137,9 @@ def print_results(ctrl):
         pref = None
     else:
         msg.good(f"You preferred {pref} ({streamnames.get(pref)})")
+        share = tally.get_metrics()[pref]
+        low, high = share["ci95"]
+        msg.text(f"{share['share']:.1%} of decisions (95% CI {low:.1%}-{high:.1%})")
     rows = [
         ("A", counts["A"], streamnames.get("A")),
         ("B", counts["B"], streamnames.get("B")),
@@ -116,6 +161,11 @@ def print_results(ctrl):
     label=("One or more comma-separated labels", "option", "l", split_string),
     exclude=("Names of datasets to exclude", "option", "e", split_string),
     unsegmented=("Don't split sentences", "flag", "U", bool),
+    n_process=("Number of processes to use for model inference", "option", "np", int),
+    batch_size=("Batch size for model inference", "option", "bs", int),
+    parallel=("Run the two models in parallel threads", "flag", "P", bool),
+    cache=("Cache the models' predictions on disk, e.g. for repeated runs against the same baseline", "flag", "C", bool),
+    metrics=("Optional path to a JSON file updated with the live results", "option", "m", str),
 )
 def ner_eval_ab(
     dataset: str,
@@ -125,6 +175,11 @@ def ner_eval_ab(
     label: Optional[List[str]] = None,
     exclude: Optional[List[str]] = None,
     unsegmented: bool = False,
+    n_process: int = 1,
+    batch_size: int = 10,
+    parallel: bool = False,
+    cache: bool = False,
+    metrics: Optional[str] = None,
 ):
     """
     Evaluate two NER models by comparing their predictions and building an evaluation set from the stream.
@@ -135,26 +190,65 @@ def ner_eval_ab(
 
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     if not unsegmented:
         # Use spaCy to split text into sentences
-        stream = list(split_sentences(before_nlp, stream))
+        stream = split_sentences(before_nlp, stream)
 
+    # Run both models over the same sentences in lockstep, so the sentences
+    # and predictions are only buffered until both models have seen them.
+    # With --parallel, each model runs in its own thread and can be up to one
+    # batch ahead of the other.
+    before_sents, after_sents = broadcast(stream, 2)
+    # Optionally keep the predictions of each model in an on-disk cache keyed
+    # by the model's weights, so an unchanged model isn't re-run next time.
+    before_cache = PredictionCache(before_nlp) if cache else None
+    after_cache = PredictionCache(after_nlp) if cache else None
     # Generate tasks for both streams with the predictions of the models.
-    before_stream = list(make_tasks(before_nlp, label, stream))
-    after_stream = list(make_tasks(after_nlp, label, stream))
-   
+    before_stream = make_tasks(
+        before_nlp, label, before_sents, n_process, batch_size, before_cache
+    )
+    after_stream = make_tasks(
+        after_nlp, label, after_sents, n_process, batch_size, after_cache
+    )
+    if parallel:
+        before_stream = prefetch(before_stream, batch_size)
+        after_stream = prefetch(after_stream, batch_size)
+
     # Generate choice tasks with models' predictions as options.
-    stream = get_compare_questions(before_stream, after_stream)
+    stream = get_compare_questions(zip(before_stream, after_stream))
+
+    # Keep a running tally of the answers, which is stored in the dataset meta,
+    # so the results can be reported without re-reading the whole dataset
+    DB = connect()
+    if dataset in DB:
+        meta = DB.get_meta(dataset) or {}
+        if TALLY_META_KEY in meta:
+            tally = ABTally(meta[TALLY_META_KEY])
+        else:
+            # Datasets created before the tally was stored are counted once
+            tally = ABTally.from_examples(DB.get_dataset(dataset))
+    else:
+        tally = ABTally()
+
+    def update(answers):
+        # Called whenever Prodigy receives new answers
+        tally.update(answers)
+        update_dataset_meta(DB, dataset, {TALLY_META_KEY: tally.to_dict()})
+        if metrics:
+            tally.write_metrics(metrics)
 
+    def on_exit(ctrl):
+        print_results(tally)
 
     return {
         "view_id": "choice", # Annotation interface to use
         "dataset": dataset, # Name of dataset to save evaluation set
         "stream": stream, # Incoming stream of examples
-        "on_exit": print_results,
+        "update": update, # Update the tally of the results with the answers
+        "on_exit": on_exit,
         # Action to perform when the user stops the server. Here: print the evaluation results to stdout
         "exclude": exclude, # List of dataset names to exclude
-        "config": {"auto_count_stream": True}, # Whether to recount the stream at initialization
+        "config": {"auto_count_stream": False}, # Don't count the stream upfront, which would consume it
     }
\ No newline at end of file
@@ -0,0 +1,190 @@
+from collections import Counter
+from typing import List, Optional
+import random
+from wasabi import msg
+import spacy
+import srsly
+import prodigy
+from prodigy.components.db import connect
+from prodigy.components.preprocess import split_sentences, set_hashes
+from prodigy.util import split_string, TASK_HASH_ATTR
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.cache import PredictionCache
+from components.evaluation import EloRatings
+from components.loaders import IndexedJSONL
+from components.pipeline import broadcast, prefetch
+from components.util import update_dataset_meta
+from ner.ner_eval_ab import make_tasks
+
+# Key of the model ratings in the dataset meta
+RATINGS_META_KEY = "eval_tournament_ratings"
+
+
+def get_tournament_questions(names, task_rows, ratings, assignments):
+    """
+        Generate a choice task for each sentence the models disagree on.
+        Models with identical outputs are grouped, so each distinct output is
+        only shown once, and the two groups to compare are picked Swiss-style:
+        the pair of models that was scheduled least often, and among those the
+        pair with the closest ratings, as it's the most informative.
+        The models behind the options are stored in assignments, keyed by the
+        task hash, so they're never sent to the browser.
+    """
+    scheduled = Counter()
+
+    def get_pair_key(pair):
+        # Use the first model of each group to represent it
+        a, b = pair[0][1][0], pair[1][1][0]
+        gap = abs(ratings.ratings[a] - ratings.ratings[b])
+        return (scheduled[frozenset((a, b))], gap)
+
+    for tasks in task_rows:
+        groups = {}
+        for name, task in zip(names, tasks):
+            key = srsly.json_dumps(task["output"]["spans"], sort_keys=True)
+            groups.setdefault(key, (task["output"], []))[1].append(name)
+        # Ignore if the answers from all models are the same.
+        if len(groups) < 2:
+            continue
+        groups = list(groups.values())
+        pairs = [(a, b) for i, a in enumerate(groups) for b in groups[i + 1:]]
+        a, b = min(pairs, key=get_pair_key)
+        for name_a in a[1]:
+            for name_b in b[1]:
+                scheduled[frozenset((name_a, name_b))] += 1
+        # Randomize the order of the outputs of the compared models.
+        if random.random() >= 0.5:
+            a, b = b, a
+        question = {
+            **tasks[0]["input"],
+            "id": tasks[0]["id"],
+            "options": [],
+        }
+        for option_id, (output, _) in zip(("A", "B"), (a, b)):
+            question["options"].append({**output, "id": option_id})
+        question = set_hashes(question)
+        assignments[question[TASK_HASH_ATTR]] = {"A": a[1], "B": b[1]}
+        yield question
+
+
+def print_leaderboard(ratings):
+    """Print the ratings of the models to stdout."""
+    if not any(ratings.games.values()):
+        raise ValueError("No answers found!")
+    msg.divider("Tournament results")
+    rows = [
+        (i + 1, name, f"{rating:.0f}", wins, games)
+        for i, (name, rating, wins, games) in enumerate(ratings.leaderboard())
+    ]
+    msg.table(rows, header=("#", "Model", "Rating", "Wins", "Games"),
+              aligns=("r", "l", "r", "r", "r"))
+
+
+# Recipe decorator with argument annotations: (description, argument type,
+# shortcut, type / converter function called on value before it's passed to
+# the function). Descriptions are also shown when typing --help.
+@prodigy.recipe(
+    "ner.eval-tournament",
+    dataset=("The dataset to use", "positional", None, str),
+    models=("Two or more comma-separated loadable spaCy pipelines with an entity recognizer", "positional", None, split_string),
+    source=("The source data as a JSONL file", "positional", None, str),
+    label=("One or more comma-separated labels", "option", "l", split_string),
+    exclude=("Names of datasets to exclude", "option", "e", split_string),
+    unsegmented=("Don't split sentences", "flag", "U", bool),
+    n_process=("Number of processes to use for model inference", "option", "np", int),
+    batch_size=("Batch size for model inference", "option", "bs", int),
+    parallel=("Run the models in parallel threads", "flag", "P", bool),
+    cache=("Cache the models' predictions on disk", "flag", "C", bool),
+    metrics=("Optional path to a JSON file updated with the live leaderboard", "option", "m", str),
+)
+def ner_eval_tournament(
+    dataset: str,
+    models: List[str],
+    source: str,
+    label: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    unsegmented: bool = False,
+    n_process: int = 1,
+    batch_size: int = 10,
+    parallel: bool = False,
+    cache: bool = False,
+    metrics: Optional[str] = None,
+):
+    """
+    Evaluate two or more NER models in a tournament by comparing pairs of their predictions and rating the models.
+    """
+    if len(set(models)) < 2:
+        msg.fail("Need at least two different models to compare", exits=1)
+    names = list(dict.fromkeys(models))
+    nlps = [spacy.load(name) for name in names]
+
+    # Load the stream from a JSONL file and return a generator that yields a
+    # dictionary for each example in the data.
+    stream = IndexedJSONL(source)
+
+    if not unsegmented:
+        # Use spaCy to split text into sentences
+        stream = split_sentences(nlps[0], stream)
+
+    # Run all models over the same sentences in lockstep, so each model only
+    # processes each sentence once. With --parallel, each model runs in its
+    # own thread and can be up to one batch ahead of the others. The copies
+    # of the stream are locked, so they can also be read from the prefetch
+    # threads of nlp.pipe with --n-process > 1.
+    model_streams = []
+    for nlp, sents in zip(nlps, broadcast(stream, len(nlps))):
+        # Optionally look up the predictions in the on-disk cache first
+        pred_cache = PredictionCache(nlp) if cache else None
+        tasks = make_tasks(nlp, label, sents, n_process, batch_size, pred_cache)
+        model_streams.append(prefetch(tasks, batch_size) if parallel else tasks)
+
+    # Restore the ratings from a previous session, which are stored in the
+    # dataset meta and updated with every batch of answers
+    DB = connect()
+    ratings = EloRatings(names)
+    if dataset in DB:
+        meta = DB.get_meta(dataset) or {}
+        if RATINGS_META_KEY in meta:
+            ratings.restore(meta[RATINGS_META_KEY])
+
+    # Generate choice tasks with pairs of the models' predictions as options.
+    # Which models are behind the options A and B is only kept on the server,
+    # so the evaluation stays blind.
+    assignments = {}
+    stream = get_tournament_questions(names, zip(*model_streams), ratings, assignments)
+
+    def update(answers):
+        # Called whenever Prodigy receives new answers
+        for eg in answers:
+            selected = eg.get("accept", [])
+            if eg.get("answer") != "accept" or len(selected) != 1:
+                continue
+            # Skip questions that weren't generated in this session
+            models = assignments.get(eg.get(TASK_HASH_ATTR))
+            if models is None:
+                continue
+            winner = selected[0]
+            loser = "B" if winner == "A" else "A"
+            # Models with the same output share the result
+            for winner_name in models[winner]:
+                for loser_name in models[loser]:
+                    ratings.update(winner_name, loser_name)
+        update_dataset_meta(DB, dataset, {RATINGS_META_KEY: ratings.to_dict()})
+        if metrics:
+            ratings.write_metrics(metrics)
+
+    def on_exit(ctrl):
+        print_leaderboard(ratings)
+
+    return {
+        "view_id": "choice", # Annotation interface to use
+        "dataset": dataset, # Name of dataset to save evaluation set
+        "stream": stream, # Incoming stream of examples
+        "update": update, # Update the model ratings with the answers
+        "on_exit": on_exit, # Print the leaderboard when the user stops the server
+        "exclude": exclude, # List of dataset names to exclude
+        "config": {"auto_count_stream": False}, # Don't count the stream upfront, which would consume it
+    }
@@ -1,13 +1,19 @@
 from typing import List, Optional
-import copy
 from collections import defaultdict
 import prodigy
 from prodigy.components.loaders import JSONL
 from prodigy.components.preprocess import add_tokens
 from prodigy.util import split_string, set_hashes
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.fuzzy import CandidateFuzzyMatcher, FuzzyMatcherPool, load_pattern_docs
+from components.loaders import IndexedJSONL
+from components.pipeline import broadcast
+from components.tasks import derive_task
 import spacy
 from spacy.tokens import Span
-from spaczz.matcher import FuzzyMatcher
 
 
 def parse_phrase_patterns(patterns):
@@ -27,15 +33,23 @@ def parse_phrase_patterns(patterns):
     return phrase_patterns, line_numbers
 
 
-def apply_fuzzy_matcher(stream, nlp, fuzzy_matcher, line_numbers):
-    """Add a 'spans' key to each example, with fuzzy pattern matches."""
+def apply_fuzzy_matcher(stream, nlp, match_docs, line_numbers):
+    """
+        Add a 'spans' key to each example, with fuzzy pattern matches.
+        `match_docs` takes an iterable of docs and yields the matches of each
+        doc in order, either in this process or in a pool of workers.
+    """
     # Process the stream using spaCy's nlp.pipe, which yields doc objects.
     # If as_tuples=True is set, you can pass in (text, context) tuples.
     texts_examples = ((eg["text"], eg) for eg in stream)
-    for doc, eg in nlp.pipe(texts_examples, as_tuples=True):
-        task = copy.deepcopy(eg)
+    docs_examples, docs_to_match = broadcast(nlp.pipe(texts_examples, as_tuples=True))
+    all_matches = match_docs(doc for doc, _ in docs_to_match)
+    for (doc, eg), matches in zip(docs_examples, all_matches):
         matched_spans = []
-        for line_number, start_token, end_token, _ in fuzzy_matcher(doc):
+        for match in matches:
+            # spaczz returns (key, start, end, ratio) tuples, newer versions
+            # also include the pattern
+            line_number, start_token, end_token = match[:3]
             span_obj = Span(doc, start_token, end_token)
             span = {
                         "text": span_obj.text,
@@ -48,15 +62,17 @@ def apply_fuzzy_matcher(stream, nlp, fuzzy_matcher, line_numbers):
                     }
             matched_spans.append(span)
         if matched_spans:
-            task["spans"] = matched_spans
             all_ids = []
-            for s in task["spans"]:
+            for s in matched_spans:
                 all_ids.append(s["line_number"])
                 # Not needed anymore
                 del s["line_number"]
-            task["meta"]["pattern"] = ", ".join([f"{p}" for p in all_ids])
+            meta = {**eg.get("meta", {}), "pattern": ", ".join([f"{p}" for p in all_ids])}
+            task = derive_task(eg, spans=matched_spans, meta=meta)
             # Rehash the newly created task so that hashes reflect added data
             task = set_hashes(task)
+        else:
+            task = eg
         yield task
 
 
@@ -71,7 +87,9 @@ def apply_fuzzy_matcher(stream, nlp, fuzzy_matcher, line_numbers):
     patterns=("Phrase patterns", "positional", None, str),
     label=("One or more comma-separated labels", "option", "l", split_string),
     exclude=("Names of datasets to exclude", "option", "e", split_string),
-    
+    min_share=("Minimum share of a pattern's character 3-grams a text needs to contain for the pattern to be fuzzy-matched against it (0 to match all patterns)", "option", "ms", float),
+    n_process=("Number of worker processes for fuzzy matching", "option", "np", int),
+    batch_size=("Number of examples sent to a worker process at once", "option", "bs", int),
 )
 def ner_fuzzy_manual(
     dataset: str,
@@ -80,7 +98,9 @@ def ner_fuzzy_manual(
     patterns: str,
     label: Optional[List[str]] = None,
     exclude: Optional[List[str]] = None,
-    
+    min_share: float = 0.5,
+    n_process: int = 1,
+    batch_size: int = 32,
 ):
     """
     Mark spans manually by token with suggestions from phrase patterns pre-highlighted.
@@ -94,20 +114,41 @@ def ner_fuzzy_manual(
     # Load the spaCy model for tokenization
     nlp = spacy.load(spacy_model)
 
-    # Initialize spaczz fuzzy matcher
-    fuzzy_matcher = FuzzyMatcher(nlp.vocab)
+    pool = None
+    # Load phrase patterns and feed them to the fuzzy matcher
+    phrase_patterns, line_numbers = parse_phrase_patterns(list(JSONL(patterns)))
+    # Use the line number from the patterns source file as the pattern_id
+    keyed_patterns = [p for group in phrase_patterns.values() for p in group]
+    # Only tokenize the patterns, in batches. The Docs are cached per patterns file.
+    docs = load_pattern_docs(nlp, patterns, [text for _, text in keyed_patterns])
 
-    # Load phrase patterns and feed them to spaczz matcher
-    patterns = JSONL(patterns)
-    phrase_patterns, line_numbers = parse_phrase_patterns(list(patterns))
-    for pattern_label, patterns in phrase_patterns.items():
-        for (line_number, pattern) in patterns:
-            # Use the line number from the patterns source file as the pattern_id
-            fuzzy_matcher.add(line_number, [nlp(pattern)], kwargs= [{"ignorecase": True}])
+    if n_process > 1:
+        # Match in a pool of worker processes, which each load the model and
+        # build the fuzzy matcher once, using the cached pattern docs
+        pool = FuzzyMatcherPool(
+            n_process,
+            spacy_model,
+            patterns,
+            keyed_patterns,
+            min_share=min_share,
+            kwargs={"ignorecase": True},
+            batch_size=batch_size,
+        )
+        match_docs = pool.pipe
+    else:
+        # Initialize the fuzzy matcher. The patterns are indexed by their
+        # character 3-grams, and only the patterns sharing enough 3-grams with
+        # an example are run through spaczz's fuzzy matcher, instead of every
+        # pattern for every example.
+        pattern_docs = [(line_number, doc) for (line_number, _), doc in zip(keyed_patterns, docs)]
+        fuzzy_matcher = CandidateFuzzyMatcher(
+            nlp.vocab, pattern_docs, min_share=min_share, kwargs={"ignorecase": True}
+        )
+        match_docs = lambda docs: (fuzzy_matcher(doc) for doc in docs)
 
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     # Tokenize the incoming examples and add a "tokens" property to each
     # example. Also handles pre-defined selected spans. Tokenization allows
@@ -115,13 +156,19 @@ def ner_fuzzy_manual(
     stream = add_tokens(nlp, stream)
 
     # Apply the spaczz matcher to the stream.
-    stream = apply_fuzzy_matcher(stream, nlp, fuzzy_matcher, line_numbers)
+    stream = apply_fuzzy_matcher(stream, nlp, match_docs, line_numbers)
+
+    def on_exit(ctrl):
+        # Shut down the worker processes of the matcher pool with the server
+        if pool is not None:
+            pool.close()
 
     return {
         "view_id": "ner_manual",  # Annotation interface to use
         "dataset": dataset,  # Name of dataset to save annotations
         "stream": stream,  # Incoming stream of examples
         "exclude": exclude,  # List of dataset names to exclude
+        "on_exit": on_exit,  # Called when the server is stopped
         "config": {  # Additional config settings, mostly for app UI
             "lang": nlp.lang,
             "labels": label
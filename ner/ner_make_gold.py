@@ -1,19 +1,28 @@
 import prodigy
-from prodigy.components.loaders import JSONL
 from prodigy.components.preprocess import add_tokens
 from prodigy.util import split_string, set_hashes
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import DocBinStream, IndexedJSONL, is_docbin_source
+from components.pipeline import pipe_docs, pipe_examples
+from components.tasks import derive_task
 import spacy
-import copy
 from typing import List, Optional
 
 
-def make_tasks(nlp, stream, labels):
-    """Add a 'spans' key to each example, with predicted entities."""
-    # Process the stream using spaCy's nlp.pipe, which yields doc objects.
-    # If as_tuples=True is set, you can pass in (text, context) tuples.
-    texts = ((eg["text"], eg) for eg in stream)
-    for doc, eg in nlp.pipe(texts, as_tuples=True):
-        task = copy.deepcopy(eg)
+def make_tasks(nlp, stream, labels, n_process=1, batch_size=32, pretokenized=False):
+    """
+    Add a 'spans' key to each example, with predicted entities. If
+    pretokenized is True, the stream yields (doc, example) tuples and the
+    model is run on the stored Docs, keeping their tokens and entities.
+    """
+    # Process the stream using spaCy's nlp.pipe, which yields (doc, example)
+    # tuples in input order. With n_process > 1, the batches are sharded
+    # across a pool of worker processes and prefetched in the background.
+    pipe = pipe_docs if pretokenized else pipe_examples
+    for doc, eg in pipe(nlp, stream, n_process=n_process, batch_size=batch_size):
         spans = []
         for ent in doc.ents:
             # Continue if predicted entity is not selected in labels
@@ -30,7 +39,7 @@ def make_tasks(nlp, stream, labels):
                     "label": ent.label_,
                 }
             )
-        task["spans"] = spans
+        task = derive_task(eg, spans=spans)
         # Rehash the newly created task so that hashes reflect added data
         task = set_hashes(task)
         yield task
@@ -43,9 +52,11 @@ def make_tasks(nlp, stream, labels):
     "ner.make-gold",
     dataset=("The dataset to use", "positional", None, str),
     spacy_model=("The base model", "positional", None, str),
-    source=("The source data as a JSONL file", "positional", None, str),
+    source=("The source data as a JSONL file, or a .spacy file or directory of pre-tokenized Docs", "positional", None, str),
     label=("One or more comma-separated labels", "option", "l", split_string),
     exclude=("Names of datasets to exclude", "option", "e", split_string),
+    n_process=("Number of processes to use for model inference", "option", "np", int),
+    batch_size=("Batch size for model inference", "option", "bs", int),
 )
 def ner_make_gold(
     dataset: str,
@@ -53,6 +64,8 @@ def ner_make_gold(
     source: str,
     label: Optional[List[str]] = None,
     exclude: Optional[List[str]] = None,
+    n_process: int = 1,
+    batch_size: int = 32,
 ):
     """
     There exist an updated version of this recipe called `ner_correct.py`.
@@ -63,17 +76,27 @@ def ner_make_gold(
     # Load the spaCy model
     nlp = spacy.load(spacy_model)
 
-    # Load the stream from a JSONL file and return a generator that yields a
-    # dictionary for each example in the data.
-    stream = JSONL(source)
+    pretokenized = is_docbin_source(source)
+    if pretokenized:
+        # Load (doc, example) tuples from spaCy DocBin files. The examples
+        # already have the tokens of the stored Docs, and the model keeps
+        # their existing entities.
+        stream = DocBinStream(source, nlp.vocab).iter_docs()
+    else:
+        # Load the stream from a JSONL file and return a generator that yields a
+        # dictionary for each example in the data.
+        stream = IndexedJSONL(source)
 
-    # Tokenize the incoming examples and add a "tokens" property to each
-    # example. Also handles pre-defined selected spans. Tokenization allows
-    # faster highlighting, because the selection can "snap" to token boundaries.
-    stream = add_tokens(nlp, stream)
+        # Tokenize the incoming examples and add a "tokens" property to each
+        # example. Also handles pre-defined selected spans. Tokenization allows
+        # faster highlighting, because the selection can "snap" to token boundaries.
+        stream = add_tokens(nlp, stream)
 
     # Add the entities predicted by the model to the tasks in the stream
-    stream = make_tasks(nlp, stream, label)
+    stream = make_tasks(
+        nlp, stream, label, n_process=n_process, batch_size=batch_size,
+        pretokenized=pretokenized,
+    )
 
     return {
         "view_id": "ner_manual",  # Annotation interface to use
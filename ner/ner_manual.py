@@ -1,22 +1,15 @@
 from typing import List, Optional
 import spacy
 import prodigy
-from prodigy.components.loaders import JSONL
 from prodigy.components.preprocess import add_tokens
-from prodigy.models.matcher import PatternMatcher
 from prodigy.util import split_string
-
-
-# Helper function for removing token information from examples
-# before they're placed in the database. Used if character highlighting is enabled.
-def remove_tokens(answers):
-    for eg in answers:
-        del eg["tokens"]
-        if "spans" in eg:
-            for span in eg["spans"]:
-                del span["token_start"]
-                del span["token_end"]
-    return answers
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import DocBinStream, IndexedJSONL, is_docbin_source
+from components.matchers import load_pattern_matcher
+from components.tasks import add_char_tokens, align_span_tokens, remove_char_tokens
 
 
 # Recipe decorator with argument annotations: (description, argument type,
@@ -26,7 +19,7 @@ def remove_tokens(answers):
     "ner.manual",
     dataset=("The dataset to use", "positional", None, str),
     spacy_model=("The base model", "positional", None, str),
-    source=("The source data as a JSONL file", "positional", None, str),
+    source=("The source data as a JSONL file, or a .spacy file or directory of pre-tokenized Docs", "positional", None, str),
     label=("One or more comma-separated labels", "option", "l", split_string),
     patterns=("The match patterns file","option","p",str),
     exclude=("Names of datasets to exclude", "option", "e", split_string),
@@ -52,31 +45,49 @@ def ner_manual(
     # Load the spaCy model for tokenization.
     nlp = spacy.load(spacy_model)
 
-    # Load the stream from a JSONL file and return a generator that yields a
-    # dictionary for each example in the data.
-    stream = JSONL(source)
+    docbin = is_docbin_source(source)
+    if docbin:
+        # Load the stream from spaCy DocBin files. The tokens and entities of
+        # each example are taken from the stored Doc, so they don't need to
+        # be tokenized again.
+        stream = DocBinStream(source, nlp.vocab)
+    else:
+        # Load the stream from a JSONL file and return a generator that yields a
+        # dictionary for each example in the data.
+        stream = IndexedJSONL(source)
 
     # If patterns are provided, apply matcher to the stream, which returns (score, example) tuples.
     # `all_examples=True` will display all examples, including the ones without any matches and
     # `combine_matches=True` will show all matches in one task as opposed to splitting them to different tasks.
     if patterns is not None:
-        pattern_matcher = PatternMatcher(nlp, combine_matches=True, all_examples=True)
-        pattern_matcher = pattern_matcher.from_disk(patterns)
+        # The phrase patterns are cached, so they're only tokenized once per file
+        pattern_matcher = load_pattern_matcher(
+            nlp, patterns, combine_matches=True, all_examples=True
+        )
         stream = (eg for _,eg in pattern_matcher(stream))
 
-    # Tokenize the incoming examples and add a "tokens" property to each
-    # example. Also handles pre-defined selected spans. Tokenization allows
-    # faster highlighting, because the selection can "snap" to token boundaries.
-    # If `use_chars` is True, tokens are split into individual characters, which enables
-    # character based selection as opposed to default token based selection.
-    stream = add_tokens(nlp, stream, use_chars=highlight_chars)
+    if highlight_chars:
+        # Add one minimal token per character, which enables character based
+        # selection as opposed to default token based selection. The text
+        # doesn't need to be tokenized for this.
+        stream = add_char_tokens(stream)
+    elif docbin:
+        # The examples already have tokens, so only the token offsets of the
+        # matched spans need to be aligned to them
+        if patterns is not None:
+            stream = align_span_tokens(stream)
+    else:
+        # Tokenize the incoming examples and add a "tokens" property to each
+        # example. Also handles pre-defined selected spans. Tokenization allows
+        # faster highlighting, because the selection can "snap" to token boundaries.
+        stream = add_tokens(nlp, stream)
 
     return {
         "view_id": "ner_manual",  # Annotation interface to use
         "dataset": dataset,  # Name of dataset to save annotations
         "stream": stream,  # Incoming stream of examples
         "exclude": exclude,  # List of dataset names to exclude
-        "before_db": remove_tokens if highlight_chars else None,
+        "before_db": remove_char_tokens if highlight_chars else None,
         # Remove token information to permit highlighting individual characters
         "config": {  # Additional config settings, mostly for app UI
             "lang": nlp.lang,
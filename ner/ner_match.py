@@ -1,8 +1,12 @@
 import prodigy
-from prodigy.components.loaders import JSONL
-from prodigy.models.matcher import PatternMatcher
 from prodigy.components.db import connect
 from prodigy.util import split_string
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import IndexedJSONL
+from components.matchers import load_pattern_matcher
 import spacy
 from typing import List, Optional
 
@@ -35,8 +39,9 @@ def ner_match(
     # Load the spaCy model
     nlp = spacy.load(spacy_model)
 
-    # Initialize the pattern matcher and load in the JSONL patterns
-    matcher = PatternMatcher(nlp).from_disk(patterns)
+    # Initialize the pattern matcher and load in the JSONL patterns. The
+    # phrase patterns are cached, so they're only tokenized once per file.
+    matcher = load_pattern_matcher(nlp, patterns)
 
     if resume:
         # Connect to the database using the settings from prodigy.json
@@ -48,7 +53,7 @@ def ner_match(
 
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     # Apply the matcher to the stream, which returns (score, example) tuples.
     # Filter out the scores to only yield the examples for annotations.
@@ -1,11 +1,18 @@
 import prodigy
-from prodigy.components.loaders import JSONL
 from prodigy.models.ner import EntityRecognizer
-from prodigy.models.matcher import PatternMatcher
 from prodigy.components.preprocess import split_sentences
 from prodigy.components.sorters import prefer_uncertain
 from prodigy.util import combine_models, split_string
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import IndexedJSONL
+from components.matchers import load_pattern_matcher
+from components.scorers import LookaheadScorer
+from components.updates import UpdateScheduler
 import spacy
+import threading
 from typing import List, Optional
 
 
@@ -21,6 +28,8 @@ from typing import List, Optional
     patterns=("Optional match patterns", "option", "p", str),
     exclude=("Names of datasets to exclude", "option", "e", split_string),
     unsegmented=("Don't split sentences", "flag", "U", bool),
+    lookahead=("Number of examples to score ahead in the background", "option", "la", int),
+    max_stale=("Number of model updates after which scored examples are re-scored", "option", "ms", int),
 )
 def ner_teach(
     dataset: str,
@@ -30,6 +39,8 @@ def ner_teach(
     patterns: Optional[str] = None,
     exclude: Optional[List[str]] = None,
     unsegmented: bool = False,
+    lookahead: int = 128,
+    max_stale: int = 1,
 ):
     """
     Collect the best possible training data for a named entity recognition
@@ -38,7 +49,7 @@ def ner_teach(
     """
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     # Load the spaCy model
     nlp = spacy.load(spacy_model)
@@ -53,8 +64,9 @@ def ner_teach(
         predict = model
         update = model.update
     else:
-        # Initialize the pattern matcher and load in the JSONL patterns
-        matcher = PatternMatcher(nlp).from_disk(patterns)
+        # Initialize the pattern matcher and load in the JSONL patterns. The
+        # phrase patterns are cached, so they're only tokenized once per file.
+        matcher = load_pattern_matcher(nlp, patterns)
         # Combine the NER model and the matcher and interleave their
         # suggestions and update both at the same time
         predict, update = combine_models(model, matcher)
@@ -63,16 +75,32 @@ def ner_teach(
         # Use spaCy to split text into sentences
         stream = split_sentences(nlp, stream)
 
+    # Score the stream in a background thread, which keeps a buffer of up to
+    # `lookahead` scored examples ready, so the annotators don't have to wait
+    # for the beam search. Predictions made more than `max_stale` updates ago
+    # are re-scored in bulk before they're sent out. The lock makes sure the
+    # model isn't updated while it's predicting.
+    model_lock = threading.Lock()
+    scorer = LookaheadScorer(
+        predict, stream, buffer_size=lookahead, max_stale=max_stale, lock=model_lock
+    )
+
+    # Queue the incoming answers and update the model on a dedicated worker
+    # thread, so submitting answers doesn't block. Answers that arrive while
+    # the model is updating are coalesced into larger minibatches. After each
+    # update, the buffered predictions are marked as outdated.
+    update_scheduler = UpdateScheduler(update, lock=model_lock, on_update=scorer.invalidate)
+
     # Use the prefer_uncertain sorter to focus on suggestions that the model
     # is most uncertain about (i.e. with a score closest to 0.5). The model
     # yields (score, example) tuples and the sorter yields just the example
-    stream = prefer_uncertain(predict(stream))
+    stream = prefer_uncertain(scorer)
 
     return {
         "view_id": "ner",  # Annotation interface to use
         "dataset": dataset,  # Name of dataset to save annotations
         "stream": stream,  # Incoming stream of examples
-        "update": update,  # Update callback, called with batch of answers
+        "update": update_scheduler,  # Update callback, called with batch of answers
         "exclude": exclude,  # List of dataset names to exclude
         "config": {"lang": nlp.lang},  # Additional config settings, mostly for app UI
     }
@@ -1,6 +1,10 @@
 import prodigy
-from prodigy.components.loaders import JSONL
 from prodigy.util import split_string
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import IndexedJSONL
 from typing import List
 
 
@@ -30,7 +34,7 @@ def choice(dataset: str, source: str, options: List[str], multiple: bool = False
     """
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     # Add the options to all examples in the stream
     stream = add_options(stream, options)
@@ -1,6 +1,10 @@
 import prodigy
-from prodigy.components.loaders import JSONL
 from prodigy.util import split_string
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import IndexedJSONL
 from collections import Counter
 from typing import List, Optional
 
@@ -23,7 +27,7 @@ def mark(dataset: str, source: str, view_id: str, exclude: Optional[List[str]] =
 
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     def on_load(controller):
         # Check if current dataset is available in database. The on_load
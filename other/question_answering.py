@@ -1,5 +1,9 @@
 import prodigy
-from prodigy.components.loaders import JSONL
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import IndexedJSONL
 
 
 # Recipe decorator with argument annotations: (description, argument type,
@@ -23,7 +27,7 @@ def question_answering(dataset: str, source: str):
     """
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     # The HTML template to use. While we could also reformat the stream to
     # include a "html" field for each example, a template allows rendering
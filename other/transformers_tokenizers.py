@@ -1,4 +1,5 @@
 """This recipe requires Prodigy v1.10+."""
+from itertools import islice
 from typing import List, Optional, Union, Iterable, Dict, Any
 from tokenizers import BertWordPieceTokenizer
 from prodigy.components.loaders import get_stream
@@ -16,7 +17,8 @@ import prodigy
     tokenizer_vocab=("Tokenizer vocab file", "option", "tv", str),
     lowercase=("Set lowercase=True for tokenizer", "flag", "LC", bool),
     hide_special=("Hide SEP and CLS tokens visually", "flag", "HS", bool),
-    hide_wp_prefix=("Hide wordpieces prefix like ##", "flag", "HW", bool)
+    hide_wp_prefix=("Hide wordpieces prefix like ##", "flag", "HW", bool),
+    batch_size=("Number of texts to tokenize at once", "option", "bs", int),
     # fmt: on
 )
 def ner_manual_tokenizers_bert(
@@ -28,6 +30,7 @@ def ner_manual_tokenizers_bert(
     lowercase: bool = False,
     hide_special: bool = False,
     hide_wp_prefix: bool = False,
+    batch_size: int = 64,
 ) -> Dict[str, Any]:
     """Example recipe that shows how to use model-specific tokenizers like the
     BERT word piece tokenizer to preprocess your incoming text for fast and
@@ -50,46 +53,58 @@ def ner_manual_tokenizers_bert(
     special_tokens = (sep_token, cls_token)
     wp_prefix = tokenizer._parameters.get("wordpieces_prefix")
 
+    def get_tokens(encoding):
+        # Drop the special tokens first if we don't want to see them, so the
+        # whitespace can be computed from the neighbouring offsets in one pass
+        pieces = [
+            (text, start, end, tid)
+            for text, (start, end), tid in zip(
+                encoding.tokens, encoding.offsets, encoding.ids
+            )
+            if not (hide_special and text in special_tokens)
+        ]
+        next_pieces = pieces[1:] + [None]
+        eg_tokens = []
+        for idx, ((text, start, end, tid), next_piece) in enumerate(
+            zip(pieces, next_pieces)
+        ):
+            is_special = text in special_tokens
+            # If the next start offset != the current end offset, we
+            # assume there's whitespace in between
+            if next_piece is None or is_special:
+                ws = True
+            else:
+                ws = next_piece[1] > end or next_piece[0] in special_tokens
+            # If we want to strip out word piece prefix, remove it from text
+            if hide_wp_prefix and wp_prefix is not None:
+                if text.startswith(wp_prefix):
+                    text = text[len(wp_prefix) :]
+            token = {
+                "text": text,
+                "id": idx,
+                "start": start,
+                "end": end,
+                # This is the encoded ID returned by the tokenizer
+                "tokenizer_id": tid,
+                # Don't allow selecting spacial SEP/CLS tokens
+                "disabled": is_special,
+                "ws": ws,
+            }
+            eg_tokens.append(token)
+        return eg_tokens
+
     def add_tokens(stream):
-        for eg in stream:
-            tokens = tokenizer.encode(eg["text"])
-            eg_tokens = []
-            idx = 0
-            for (text, (start, end), tid) in zip(
-                tokens.tokens, tokens.offsets, tokens.ids
-            ):
-                # If we don't want to see special tokens, don't add them
-                if hide_special and text in special_tokens:
-                    continue
-                # If we want to strip out word piece prefix, remove it from text
-                if hide_wp_prefix and wp_prefix is not None:
-                    if text.startswith(wp_prefix):
-                        text = text[len(wp_prefix) :]
-                token = {
-                    "text": text,
-                    "id": idx,
-                    "start": start,
-                    "end": end,
-                    # This is the encoded ID returned by the tokenizer
-                    "tokenizer_id": tid,
-                    # Don't allow selecting spacial SEP/CLS tokens
-                    "disabled": text in special_tokens,
-                }
-                eg_tokens.append(token)
-                idx += 1
-            for i, token in enumerate(eg_tokens):
-                # If the next start offset != the current end offset, we
-                # assume there's whitespace in between
-                if i < len(eg_tokens) - 1 and token["text"] not in special_tokens:
-                    next_token = eg_tokens[i + 1]
-                    token["ws"] = (
-                        next_token["start"] > token["end"]
-                        or next_token["text"] in special_tokens
-                    )
-                else:
-                    token["ws"] = True
-            eg["tokens"] = eg_tokens
-            yield eg
+        # Encode the texts in batches, which the tokenizer processes in
+        # parallel instead of one call per example
+        stream = iter(stream)
+        while True:
+            batch = list(islice(stream, batch_size))
+            if not batch:
+                break
+            encodings = tokenizer.encode_batch([eg["text"] for eg in batch])
+            for eg, encoding in zip(batch, encodings):
+                eg["tokens"] = get_tokens(encoding)
+                yield eg
 
     stream = add_tokens(stream)
 
@@ -2,9 +2,20 @@ import prodigy
 from prodigy.components.db import connect
 from prodigy.components.sorters import Probability
 from prodigy.util import split_string, set_hashes
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.ann import get_ann_index, get_table_hash
+from components.util import update_dataset_meta
+from components.vectors import Centroid, VectorTable, top_k
+import numpy as np
 import spacy
-from spacy.tokens import Doc
 from typing import List
+from wasabi import msg
+
+# Key of the centroid state in the dataset meta
+CENTROIDS_META_KEY = "terms_teach_centroids"
 
 
 # Recipe decorator with argument annotations: (description, argument type,
@@ -15,8 +26,16 @@ from typing import List
     dataset=("The dataset to use", "positional", None, str),
     vectors=("Loadable spaCy model with word vectors", "positional", None, str),
     seeds=("One or more comma-separated seed terms", "option", "o", split_string),
+    batch_size=("Number of top-scored terms to suggest before re-scoring", "option", "b", int),
+    ann=("Use an approximate nearest-neighbour index (for large vector tables)", "flag", "A", bool),
 )
-def terms_teach(dataset: str, vectors: str, seeds: List[str]):
+def terms_teach(
+    dataset: str,
+    vectors: str,
+    seeds: List[str],
+    batch_size: int = 100,
+    ann: bool = False,
+):
     """
     Bootstrap a terminology list with word vectors and seeds terms. Prodigy
     will suggest similar terms based on the word vectors, and update the
@@ -32,62 +51,126 @@ def terms_teach(dataset: str, vectors: str, seeds: List[str]):
     # Load the spaCy model with vectors
     nlp = spacy.load(vectors)
 
-    # Create two Doc objects for the accepted and rejected terms
-    accept_doc = Doc(nlp.vocab, words=seeds)
-    reject_doc = Doc(nlp.vocab, words=[])
+    # Pack the vectors of all lowercase alphabetic terms in the vocab into one
+    # normalised matrix, so all terms can be scored at once
+    table = VectorTable.from_vocab(nlp.vocab, lambda lex: lex.is_alpha and lex.is_lower)
+    rows = {orth: i for i, orth in enumerate(table.orths.tolist())}
+    vectors_name = nlp.vocab.vectors.name or ""
+    # The index is built once per vector table and cached on disk. It uses
+    # HNSW if hnswlib is installed and a NumPy IVF index otherwise.
+    ann_index = get_ann_index(table, vectors_name) if ann else None
+
+    # Keep running sums of the accepted and rejected term vectors. They're
+    # stored in the dataset meta after every update, so a restarted session
+    # picks up where it left off instead of starting from the seeds again.
+    width = nlp.vocab.vectors_length
+    vectors_key = get_table_hash(table, vectors_name)
+    meta = DB.get_meta(dataset) if dataset and dataset in DB else None
+    state = (meta or {}).get(CENTROIDS_META_KEY)
+    # Only restore centroids created with the same vectors, as centroids from
+    # another vector space of the same width would be meaningless
+    if state and state.get("vectors") == vectors_key:
+        accept = Centroid.from_dict(state["accept"])
+        reject = Centroid.from_dict(state["reject"])
+        used_seeds = state["seeds"]
+    else:
+        if state:
+            msg.warn("Discarding saved centroids, they were created with different vectors")
+        accept = Centroid(width)
+        reject = Centroid(width)
+        used_seeds = []
     score = 0
+    # Terms answered in this session, which aren't suggested again
+    answered = np.zeros(len(table), dtype=bool)
 
-    def predict(term):
-        """Score a term given the current accept_doc and reject_doc."""
-        if len(accept_doc) == 0 and len(reject_doc) == 0:
-            return 0.5
-        # Use spaCy's .similarity() method to compare the term to the
-        # accepted and rejected Doc
-        if len(accept_doc) and accept_doc.vector_norm != 0.0:
-            accept_score = max(term.similarity(accept_doc), 0.0)
-        else:
-            accept_score = 0.0
-        if len(reject_doc) and reject_doc.vector_norm != 0:
-            reject_score = max(term.similarity(reject_doc), 0.0)
+    def mark_answered(text):
+        row = rows.get(nlp.vocab.strings[text])
+        if row is not None:
+            answered[row] = True
+
+    def add_term(centroid, text):
+        centroid.add(nlp.vocab[text].vector)
+        mark_answered(text)
+
+    # Seeds from a previous session are already part of the restored centroid
+    for seed in seeds:
+        if seed in used_seeds:
+            mark_answered(seed)
         else:
-            reject_score = 0.0
-        score = accept_score / (accept_score + reject_score + 0.2)
-        return max(score, 0.0)
+            add_term(accept, seed)
+            used_seeds.append(seed)
+
+    def save_centroids():
+        if dataset and dataset in DB:
+            state = {"accept": accept.to_dict(), "reject": reject.to_dict(),
+                     "seeds": used_seeds, "vectors": vectors_key}
+            update_dataset_meta(DB, dataset, {CENTROIDS_META_KEY: state})
+
+    def predict(rows=None):
+        """Score all terms (or the terms in the given rows) given the current
+        accept and reject centroids."""
+        if len(accept) == 0 and len(reject) == 0:
+            n_rows = len(table) if rows is None else len(rows)
+            return np.full(n_rows, 0.5, dtype="float32")
+        # The cosine similarity to the average of the word vectors is the same
+        # as spaCy's .similarity() with a Doc of the terms. It's 0 if none of
+        # the terms have vectors.
+        accept_scores = table.cosine(accept.vector, rows) if len(accept) else 0.0
+        reject_scores = table.cosine(reject.vector, rows) if len(reject) else 0.0
+        scores = accept_scores / (accept_scores + reject_scores + 0.2)
+        return np.maximum(scores, 0.0)
 
     def update(answers):
         # Called whenever Prodigy receives new annotations
-        nonlocal accept_doc, reject_doc, score
-        accept_words = [t.text for t in accept_doc]
-        reject_words = [t.text for t in reject_doc]
+        nonlocal score
         for answer in answers:
-            # Increase or decrease score depending on answer and update
-            # list of accepted and rejected terms
+            # Increase or decrease score depending on answer and add the
+            # term's vector to the accepted or rejected centroid
             if answer["answer"] == "accept":
                 score += 1
-                accept_words.append(answer["text"])
+                add_term(accept, answer["text"])
             elif answer["answer"] == "reject":
                 score -= 1
-                reject_words.append(answer["text"])
-        # Update the target documents in place
-        accept_doc = Doc(nlp.vocab, words=accept_words)
-        reject_doc = Doc(nlp.vocab, words=reject_words)
-
-    def score_stream(stream):
-        # Get all lexemes in the vocab and score them
-        lexemes = [lex for lex in stream if lex.is_alpha and lex.is_lower]
+                add_term(reject, answer["text"])
+        save_centroids()
+
+    def score_stream():
+        # Keep track of the terms that were already suggested in this pass
+        # over the vocab, so they're not repeated while waiting for answers
+        suggested = np.zeros(len(table), dtype=bool)
         while True:
-            seen = set(w.orth for w in accept_doc)
-            seen.update(set(w.orth for w in reject_doc))
-            lexemes = [w for w in lexemes if w.orth not in seen and w.vector_norm]
-            by_score = [(predict(lex), lex) for lex in lexemes]
-            by_score.sort(reverse=True)
-            for _, term in by_score:
-                score = predict(term)
+            unanswered = ~answered
+            if not unanswered.any():
+                return
+            candidates = unanswered & ~suggested
+            if not candidates.any():
+                # All terms were suggested, so start a new pass over the vocab
+                suggested[:] = False
+                continue
+            accept_vector = accept.vector
+            norm = np.linalg.norm(accept_vector)
+            if ann_index is not None and norm > 0:
+                # Only score the nearest neighbours of the accept centroid
+                # and re-rank them, instead of scanning the whole table
+                rows = ann_index.query(accept_vector / norm, batch_size * 2, candidates)
+                row_scores = predict(rows)
+                batch = [(rows[i], row_scores[i]) for i in top_k(row_scores, batch_size)]
+            else:
+                # Score all terms and only sort the top batch of candidates,
+                # which is re-scored after every batch to reflect the latest
+                # answers
+                scores = predict()
+                batch = [(i, scores[i]) for i in top_k(scores, batch_size, candidates)]
+            for i, score in batch:
+                suggested[i] = True
+                score = float(score)
                 # Return (score, example) tuples for the scored terms
-                yield score, {"text": term.text, "meta": {"score": score}}
+                yield score, {"text": table.texts[i], "meta": {"score": score}}
+
+    save_centroids()
 
     # Sort the scored vocab by probability and return examples
-    stream = Probability(score_stream(nlp.vocab))
+    stream = Probability(score_stream())
 
     return {
         "view_id": "text",  # Annotation interface to use
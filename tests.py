@@ -1,9 +1,17 @@
 # coding: utf8
 from __future__ import unicode_literals
 
+import numpy
+import spacy
+from spacy.tokens import Doc, DocBin, Span
 import pytest
 import tempfile
 import shutil
+import time
+import threading
+import io
+import base64
+from spaczz.matcher import FuzzyMatcher
 from pathlib import Path
 from contextlib import contextmanager
 from prodigy.components.db import connect
@@ -16,17 +24,31 @@ from spacy.lang.en import English
 from ner.ner_teach import ner_teach
 from ner.ner_match import ner_match
 from ner.ner_manual import ner_manual
-from ner.ner_correct import ner_correct
+from ner.ner_correct import ner_correct, make_examples, make_tasks
 from ner.ner_silver_to_gold import ner_silver_to_gold
-from ner.ner_eval_ab import ner_eval_ab
+from ner.ner_eval_ab import ner_eval_ab, make_tasks as make_eval_tasks
+from ner.ner_eval_tournament import ner_eval_tournament, get_tournament_questions
 from textcat.textcat_teach import textcat_teach
 from textcat.textcat_custom_model import textcat_custom_model
 from textcat.textcat_manual import textcat_manual
 from textcat.textcat_correct import textcat_correct
 from terms.terms_teach import terms_teach
 from image.image_manual import image_manual
+from image.tf_odapi.images import DecodedImageCache
 from other.mark import mark
 from other.choice import choice
+from components.loaders import IndexedJSONL, DocBinStream, is_docbin_source
+from components.filters import SeenInputs, get_input_hash
+from components.matchers import load_pattern_matcher
+from components.cache import PredictionCache
+from components.tasks import derive_task, add_char_tokens, remove_char_tokens
+from components.vectors import Centroid
+from components.util import update_dataset_meta
+from components.evaluation import ABTally, EloRatings, wilson_interval
+from components.pipeline import broadcast, prefetch
+from components.scorers import LookaheadScorer
+from components.fuzzy import QGramIndex, CandidateFuzzyMatcher, FuzzyMatcherPool, load_pattern_docs
+from components.updates import UpdateScheduler
 
 
 
@@ -193,6 +215,27 @@ def test_ner_eval_ab(dataset, spacy_model, source):
     assert len(stream[0]["options"]) == 2
     assert hasattr(recipe['on_exit'], '__call__')
 
+def test_ner_eval_tournament(dataset, spacy_model, source):
+    recipe = ner_eval_tournament(dataset, [spacy_model, "blank:en"], source, ["ORG"])
+    stream = list(recipe['stream'])
+    assert len(stream[0]["options"]) == 2
+    assert "models" not in stream[0]
+    assert hasattr(recipe['update'], '__call__')
+
+def test_tournament_questions_blind():
+    names = ["a", "b", "c"]
+    def task(spans):
+        return {"id": 0, "input": {"text": "Hello Apple"}, "output": {"text": "Hello Apple", "spans": spans}}
+    org = [{"start": 6, "end": 11, "label": "ORG"}]
+    rows = [[task(org), task([]), task(org)]]
+    assignments = {}
+    stream = list(get_tournament_questions(names, rows, EloRatings(names), assignments))
+    assert len(stream) == 1
+    assert "models" not in stream[0]
+    models = assignments[stream[0][TASK_HASH_ATTR]]
+    assert sorted(models["A"] + models["B"]) == names
+    assert ["b"] in models.values()
+
 def test_textcat_teach(dataset, spacy_model, source, labels, patterns):
     recipe = textcat_teach(dataset, spacy_model, source, labels, patterns)
     stream = list(recipe['stream'])
@@ -279,3 +322,391 @@ def test_choice(dataset, source):
     assert stream[0]['options'][0]['id'] == 'OPTION_A'
     assert recipe['config']['choice_style'] == 'single'
     assert recipe['config']['choice_auto_accept']
+
+
+def test_indexed_jsonl(source):
+    stream = IndexedJSONL(source)
+    # The records are streamed, and an incomplete pass doesn't write an index
+    assert next(iter(stream))['text'] == 'This is a text about David Bowie'
+    assert not Path(source + '.idx').exists()
+    assert [eg['text'] for eg in stream] == ['This is a text about David Bowie', 'Apple makes iPhones']
+    assert Path(source + '.idx').exists()
+    assert len(stream) == 2
+    assert stream[1]['text'] == 'Apple makes iPhones'
+    # The index is reused when the source is opened again
+    resumed = IndexedJSONL(source, start=1)
+    assert len(resumed) == 1
+    assert list(resumed)[0]['text'] == 'Apple makes iPhones'
+
+
+def test_seen_inputs():
+    seen_dataset = '__test_seen_inputs__'
+    examples = [{INPUT_HASH_ATTR: 1, TASK_HASH_ATTR: 11, 'text': 'Hello world', 'answer': 'accept'}]
+    stream = [
+        {INPUT_HASH_ATTR: 1, 'text': 'Hello world'},
+        {INPUT_HASH_ATTR: 2, 'text': 'This is a test'},
+    ]
+    with tmp_dataset(seen_dataset, examples), make_tmpdir() as tempdir:
+        seen_inputs = SeenInputs(connect(), seen_dataset, cache_dir=tempdir)
+        assert [eg['text'] for eg in seen_inputs.filter(stream)] == ['This is a test']
+        answers = [{INPUT_HASH_ATTR: 2, TASK_HASH_ATTR: 12, 'text': 'This is a test', 'answer': 'accept'}]
+        connect().add_examples(seen_inputs.add(answers), datasets=[seen_dataset])
+        # The index is restored from disk, including the newly added answers
+        restored = SeenInputs(connect(), seen_dataset, cache_dir=tempdir)
+        assert list(restored.filter(stream)) == []
+
+
+def test_seen_inputs_refresh():
+    seen_dataset = '__test_seen_inputs_refresh__'
+    examples = [{INPUT_HASH_ATTR: 1, TASK_HASH_ATTR: 11, 'text': 'Hello world', 'answer': 'accept'}]
+    stream = [
+        {INPUT_HASH_ATTR: 2, 'text': 'This is a test'},
+        {INPUT_HASH_ATTR: 3, 'text': 'Another test'},
+    ]
+    with tmp_dataset(seen_dataset, examples), make_tmpdir() as tempdir:
+        seen_inputs = SeenInputs(connect(), seen_dataset, cache_dir=tempdir)
+        answers = [{INPUT_HASH_ATTR: 2, TASK_HASH_ATTR: 12, 'text': 'This is a test', 'answer': 'accept'}]
+        connect().add_examples(seen_inputs.add(answers), datasets=[seen_dataset])
+        # The index covers the saved answers, so it isn't read again
+        assert not seen_inputs.dataset_index.refresh()
+        # Answers saved by another session are picked up by the count check
+        other = [{INPUT_HASH_ATTR: 3, TASK_HASH_ATTR: 13, 'text': 'Another test', 'answer': 'accept'}]
+        connect().add_examples(other, datasets=[seen_dataset])
+        assert seen_inputs.dataset_index.refresh()
+        assert list(seen_inputs.filter(stream)) == []
+        # Answers added via db-in while the recipe wasn't running, too
+        more = [{INPUT_HASH_ATTR: 4, TASK_HASH_ATTR: 14, 'text': 'More', 'answer': 'accept'}]
+        connect().add_examples(more, datasets=[seen_dataset])
+        restored = SeenInputs(connect(), seen_dataset, cache_dir=tempdir)
+        assert {INPUT_HASH_ATTR: 4, 'text': 'More'} in restored
+        # Answers added to the index but never saved are dropped on the next load
+        restored.add([{INPUT_HASH_ATTR: 5, TASK_HASH_ATTR: 15, 'text': 'Lost', 'answer': 'accept'}])
+        assert {INPUT_HASH_ATTR: 5, 'text': 'Lost'} not in SeenInputs(connect(), seen_dataset, cache_dir=tempdir)
+
+
+def test_derive_task():
+    eg = {'text': 'Hello world', 'meta': {'source': 'test'}}
+    task = derive_task(eg, spans=[{'start': 0, 'end': 5, 'label': 'PERSON'}])
+    assert task['spans'][0]['label'] == 'PERSON'
+    assert 'spans' not in eg
+    assert task['meta'] is eg['meta']
+
+
+def test_centroid():
+    centroid = Centroid(3)
+    assert len(centroid) == 0
+    assert not centroid.vector.any()
+    centroid.add(numpy.asarray([2.0, 4.0, 0.0]))
+    centroid.add(numpy.zeros((3,)))
+    assert list(centroid.vector) == [1.0, 2.0, 0.0]
+    restored = Centroid.from_dict(centroid.to_dict())
+    assert len(restored) == 2
+    assert list(restored.vector) == [1.0, 2.0, 0.0]
+
+
+def test_ab_tally():
+    tally = ABTally({'A': 1})
+    options = [{'id': 'A'}, {'id': 'B'}]
+    tally.update([
+        {'id': 0, 'options': options, 'answer': 'accept', 'accept': ['B']},
+        {'id': 1, 'options': options, 'answer': 'accept', 'accept': ['B']},
+        {'id': 2, 'options': options, 'answer': 'reject', 'accept': ['A']},
+    ])
+    tally.update([{'id': 1, 'options': options, 'answer': 'accept', 'accept': ['A']}])
+    assert tally.to_dict() == {'A': 2, 'B': 1}
+    # Questions from different sessions can share an id, but not a task hash
+    tally.update([
+        {'id': 0, TASK_HASH_ATTR: 10, 'options': options, 'answer': 'accept', 'accept': ['A']},
+        {'id': 0, TASK_HASH_ATTR: 20, 'options': options, 'answer': 'accept', 'accept': ['A']},
+    ])
+    assert tally.to_dict() == {'A': 4, 'B': 1}
+    tally = ABTally({'A': 2, 'B': 1})
+    metrics = tally.get_metrics()
+    assert metrics['decisions'] == 3
+    low, high = metrics['A']['ci95']
+    assert 0.0 <= low < 2 / 3 < high <= 1.0
+    assert wilson_interval(0, 0) == (0.0, 1.0)
+
+
+def test_add_char_tokens():
+    eg = {'text': 'Hi Bob', 'spans': [{'start': 3, 'end': 6, 'label': 'PERSON'}]}
+    task = next(add_char_tokens([eg]))
+    assert [t['text'] for t in task['tokens']] == list('Hi Bob')
+    assert task['spans'][0]['token_start'] == 3
+    assert task['spans'][0]['token_end'] == 5
+    assert 'token_start' not in eg['spans'][0]
+    answer = remove_char_tokens([task])[0]
+    assert 'tokens' not in answer
+    assert 'token_start' not in answer['spans'][0]
+
+
+def test_docbin_stream(tmp_path):
+    nlp = spacy.blank('en')
+    doc = Doc(nlp.vocab, words=['Hi', 'Bob', '!'], spaces=[True, False, False])
+    doc.ents = [Span(doc, 1, 2, label='PERSON')]
+    DocBin(docs=[doc]).to_disk(tmp_path / 'docs.spacy')
+    tasks = list(DocBinStream(tmp_path, nlp.vocab))
+    assert len(tasks) == 1
+    assert tasks[0]['text'] == 'Hi Bob!'
+    assert [t['text'] for t in tasks[0]['tokens']] == ['Hi', 'Bob', '!']
+    assert tasks[0]['spans'][0]['token_start'] == 1
+    assert tasks[0]['spans'][0]['label'] == 'PERSON'
+    assert tasks[0]['meta'] == {'source': 'docs.spacy', 'doc': 0}
+    assert is_docbin_source(tmp_path)
+    # Only directories with .spacy files are DocBin sources
+    (tmp_path / 'empty').mkdir()
+    assert not is_docbin_source(tmp_path / 'empty')
+
+
+def test_make_examples_docbin_tokens(tmp_path):
+    nlp = spacy.blank('en')
+    # The stored Doc keeps "York-based" as one token, but make_doc splits it
+    doc = Doc(nlp.vocab, words=['A', 'York-based', 'startup'], spaces=[True, True, False])
+    doc.ents = [Span(doc, 1, 2, label='LOC')]
+    assert len(nlp.make_doc(doc.text)) != len(doc)
+    DocBin(docs=[doc]).to_disk(tmp_path / 'docs.spacy')
+    task = next(iter(DocBinStream(tmp_path / 'docs.spacy', nlp.vocab)))
+    misaligned = {'start': 2, 'end': 6, 'token_start': 1, 'token_end': 1, 'label': 'LOC'}
+    answer = dict(task, answer='accept', spans=task['spans'] + [misaligned])
+    examples = make_examples(nlp, [answer, dict(task, answer='reject')])
+    assert len(examples) == 1
+    assert [t.text for t in examples[0].predicted] == ['A', 'York-based', 'startup']
+    assert [(ent.text, ent.label_) for ent in examples[0].reference.ents] == [('York-based', 'LOC')]
+
+
+def test_broadcast_threads():
+    def slow_range(n):
+        for i in range(n):
+            # Release the GIL, so the consumer threads interleave
+            time.sleep(0.0001)
+            yield i
+
+    # Each copy is consumed by its own prefetch thread
+    copies = [prefetch(it, 4) for it in broadcast(slow_range(500), 2)]
+    assert list(zip(*copies)) == [(i, i) for i in range(500)]
+
+
+def test_ner_eval_ab_cached_n_process(tmp_path):
+    nlp = spacy.blank('en')
+    ruler = nlp.add_pipe('entity_ruler')
+    ruler.add_patterns([{'label': 'PERSON', 'pattern': 'Bob'}])
+    stream = [{'text': 'Bob said {}'.format(i)} for i in range(100)]
+    cache = PredictionCache(nlp, cache_dir=tmp_path)
+    # Cache every other sentence, so hits and misses are interleaved and the
+    # misses are read by the prefetch thread of nlp.pipe
+    list(make_eval_tasks(nlp, None, stream[::2], cache=cache))
+    tasks = list(make_eval_tasks(nlp, None, stream, n_process=2, batch_size=4, cache=cache))
+    assert [task['input']['text'] for task in tasks] == [eg['text'] for eg in stream]
+    for task in tasks:
+        assert task['output']['spans'] == [{'start': 0, 'end': 3, 'label': 'PERSON'}]
+
+
+def test_decoded_image_cache():
+    from PIL import Image
+    f = io.BytesIO()
+    Image.new('RGB', (3, 2)).save(f, format='PNG')
+    data_uri = 'data:image/png;base64,' + base64.b64encode(f.getvalue()).decode('ascii')
+    cache = DecodedImageCache(maxsize=2)
+    # The stream sets the input hash before decoding, like image.trainmodel
+    eg = {'image': data_uri, 'meta': {'file': 'image.png'}}
+    get_input_hash(eg)
+    image = cache.get(eg)
+    assert (image.width, image.height, image.format) == (3, 2, b'png')
+    task = derive_task(eg, width=image.width, height=image.height, spans=[])
+    # The task hash is left to Prodigy, so it covers the predicted spans
+    assert TASK_HASH_ATTR not in task
+    answer = dict(task, answer='accept', spans=[{'label': 'A', 'points': [[0, 0], [1, 1]]}])
+    assert cache.get(answer) is image
+    assert len(cache.images) == 1
+
+
+def test_lookahead_scorer():
+    model = {'version': 0, 'calls': 0}
+
+    def predict(examples):
+        model['calls'] += 1
+        for eg in examples:
+            yield (model['version'], eg)
+
+    stream = [{'text': str(i)} for i in range(20)]
+    scorer = LookaheadScorer(predict, stream, buffer_size=32, batch_size=4, max_stale=0)
+    scored = iter(scorer)
+    # The first batch is handed out before the model is updated
+    first = [next(scored) for _ in range(4)]
+    assert [score for score, _ in first] == [0, 0, 0, 0]
+    calls = model['calls']
+    model['version'] = 1
+    scorer.invalidate()
+    rest = list(scored)
+    # Everything still buffered is re-scored with the updated model
+    assert [score for score, _ in rest] == [1] * 16
+    assert model['calls'] > calls
+    assert [eg['text'] for _, eg in first + rest] == [str(i) for i in range(20)]
+
+
+def test_lookahead_scorer_error():
+    def predict(examples):
+        if any(eg['text'] == '5' for eg in examples):
+            raise ValueError('Model failed')
+        return [(0.5, eg) for eg in examples]
+
+    stream = [{'text': str(i)} for i in range(10)]
+    scorer = LookaheadScorer(predict, stream, batch_size=4)
+    with pytest.raises(ValueError):
+        list(scorer)
+
+
+def test_update_scheduler():
+    batches = []
+    scheduler = UpdateScheduler(lambda batch: batches.append(list(batch)), batch_size=4, max_wait=0.5)
+    # Hold the model lock, so answers queue up while the first update waits
+    with scheduler.lock:
+        for i in range(10):
+            scheduler([{'text': str(i)}])
+        assert scheduler.pending > 0
+    assert scheduler.join(timeout=5)
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert [eg['text'] for batch in batches for eg in batch] == [str(i) for i in range(10)]
+    assert scheduler.pending == 0
+    assert scheduler.n_applied == 10
+
+
+def test_update_scheduler_error():
+    def update(batch):
+        if any(eg['text'] == 'bad' for eg in batch):
+            raise ValueError('Update failed')
+
+    scheduler = UpdateScheduler(update, batch_size=1, max_wait=0)
+    scheduler([{'text': 'bad'}])
+    assert scheduler.join(timeout=5)
+    # Failed answers aren't counted as applied
+    assert scheduler.n_applied == 0
+    assert scheduler.n_failed == 1
+    # The error is raised on the next call, and only once
+    with pytest.raises(ValueError):
+        scheduler([{'text': 'good'}])
+    scheduler([{'text': 'good'}])
+    assert scheduler.join(timeout=5)
+    assert scheduler.pending == 0
+    assert scheduler.n_applied == 1
+
+
+def test_load_pattern_matcher(tmp_path, monkeypatch):
+    nlp = spacy.blank('en')
+    patterns_path = tmp_path / 'patterns.jsonl'
+    write_jsonl(patterns_path, [
+        {'label': 'FRUIT', 'pattern': 'apple pie'},
+        {'label': 'FRUIT', 'pattern': [{'lower': 'banana'}]},
+    ])
+    examples = [{'text': 'An apple pie and a banana'}, {'text': 'A cherry'}]
+    cache_dir = tmp_path / 'cache'
+
+    def get_spans(matcher):
+        return [[(span['start'], span['end'], span['label']) for span in eg['spans']]
+                for _, eg in matcher(examples)]
+
+    built = load_pattern_matcher(nlp, patterns_path, cache_dir=cache_dir)
+    assert len(list((cache_dir / 'matchers').glob('*.pkl'))) == 1
+    # A cache hit doesn't read the patterns file and finds the same matches
+    with monkeypatch.context() as m:
+        m.setattr('components.matchers.PatternMatcher', None)
+        cached = load_pattern_matcher(nlp, patterns_path, cache_dir=cache_dir)
+    assert get_spans(cached) == get_spans(built)
+    # Changed patterns have a new key, so the matcher is rebuilt
+    write_jsonl(patterns_path, [{'label': 'FRUIT', 'pattern': 'cherry'}])
+    rebuilt = load_pattern_matcher(nlp, patterns_path, cache_dir=cache_dir)
+    assert get_spans(rebuilt)[1] == [(2, 8, 'FRUIT')]
+    assert len(list((cache_dir / 'matchers').glob('*.pkl'))) == 2
+
+
+def test_update_dataset_meta_unsupported():
+    class Database:
+        # A database whose add_dataset doesn't return the dataset model
+        def add_dataset(self, name):
+            return True
+
+        def get_meta(self, name):
+            return {}
+
+    assert not update_dataset_meta(Database(), '__test_meta__', {'key': 'value'})
+
+
+def test_ner_correct_make_tasks_lock():
+    nlp = spacy.blank('en')
+    ruler = nlp.add_pipe('entity_ruler')
+    ruler.add_patterns([{'label': 'PERSON', 'pattern': 'Bob'}])
+    lock = threading.Lock()
+    held = []
+
+    def read_stream():
+        for i in range(10):
+            # The lock isn't held while the stream is read
+            held.append(lock.locked())
+            yield {'text': f'Bob {i}'}
+
+    tasks = list(make_tasks(nlp, read_stream(), ['PERSON'], batch_size=4, lock=lock))
+    assert not any(held)
+    assert [task['text'] for task in tasks] == [f'Bob {i}' for i in range(10)]
+    assert all(task['spans'][0]['label'] == 'PERSON' for task in tasks)
+
+
+def test_qgram_index():
+    index = QGramIndex(['New York', 'Berlin', 'NY'], q=3, min_share=0.5)
+    assert len(index) == 3
+    # Texts shorter than q are always candidates
+    assert index.candidates('I moved to new yrok') == [0, 2]
+    assert index.candidates('Greetings from Berlin') == [1, 2]
+    assert QGramIndex(['New York', 'Berlin'], min_share=0).candidates('Paris') == [0, 1]
+
+
+def test_candidate_fuzzy_matcher():
+    nlp = spacy.blank('en')
+    texts = ['New York', 'San Francisco', 'Berlin', 'Los Angeles']
+    patterns = [(str(i), nlp.make_doc(text)) for i, text in enumerate(texts)]
+    fuzzy_matcher = FuzzyMatcher(nlp.vocab)
+    for key, doc in patterns:
+        fuzzy_matcher.add(key, [doc], kwargs=[{'ignorecase': True}])
+    candidate_matcher = CandidateFuzzyMatcher(nlp.vocab, patterns, kwargs={'ignorecase': True})
+    for text in ['I moved from new yrok to San Fransisco', 'Berlln and los angeles', 'Nothing here']:
+        doc = nlp.make_doc(text)
+        expected = sorted(match[:4] for match in fuzzy_matcher(doc))
+        assert sorted(match[:4] for match in candidate_matcher(doc)) == expected
+
+
+def test_load_pattern_docs(tmp_path, monkeypatch):
+    nlp = spacy.blank('en')
+    patterns_path = tmp_path / 'patterns.jsonl'
+    write_jsonl(patterns_path, [{'label': 'GPE', 'pattern': 'New York'}])
+    docs = load_pattern_docs(nlp, patterns_path, ['New York'], cache_dir=tmp_path)
+    assert [[t.text for t in doc] for doc in docs] == [['New', 'York']]
+    assert len(list((tmp_path / 'fuzzy_patterns').glob('*.spacy'))) == 1
+    # A cache hit doesn't run the tokenizer
+    with monkeypatch.context() as m:
+        m.setattr(nlp, 'tokenizer', None)
+        cached = load_pattern_docs(nlp, patterns_path, ['New York'], cache_dir=tmp_path)
+    assert [doc.text for doc in cached] == ['New York']
+    # Changed patterns are a cache miss and are tokenized again
+    write_jsonl(patterns_path, [{'label': 'GPE', 'pattern': 'Los Angeles'}])
+    docs = load_pattern_docs(nlp, patterns_path, ['Los Angeles'], cache_dir=tmp_path)
+    assert [doc.text for doc in docs] == ['Los Angeles']
+    assert len(list((tmp_path / 'fuzzy_patterns').glob('*.spacy'))) == 2
+
+
+def test_fuzzy_matcher_pool(tmp_path, monkeypatch):
+    monkeypatch.setenv('PRODIGY_HOME', str(tmp_path))
+    nlp = spacy.blank('en')
+    nlp.to_disk(tmp_path / 'model')
+    patterns_path = tmp_path / 'patterns.jsonl'
+    texts = ['New York', 'Berlin']
+    write_jsonl(patterns_path, [{'label': 'GPE', 'pattern': text} for text in texts])
+    keyed_patterns = [(i, text) for i, text in enumerate(texts)]
+    pattern_docs = load_pattern_docs(nlp, patterns_path, texts)
+    matcher = CandidateFuzzyMatcher(nlp.vocab, list(zip(range(len(texts)), pattern_docs)))
+    docs = [nlp.make_doc(text) for text in ['From new york', 'To Berlln', 'Nowhere'] * 3]
+    pool = FuzzyMatcherPool(2, str(tmp_path / 'model'), patterns_path, keyed_patterns, batch_size=2)
+    try:
+        results = list(pool.pipe(docs))
+    finally:
+        pool.close()
+    assert results == [[match[:3] for match in matcher(doc)] for doc in docs]
+    assert results[1] == [(1, 1, 2)]
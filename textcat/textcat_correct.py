@@ -1,8 +1,14 @@
-import copy
 from typing import List, Optional
 import prodigy
-from prodigy.components.loaders import JSONL
+from prodigy.components.db import connect
 from prodigy.util import split_string
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import IndexedJSONL
+from components.filters import SeenInputs
+from components.tasks import derive_task
 import spacy
 from spacy.tokens import Doc
 from spacy.training import Example
@@ -42,7 +48,7 @@ def textcat_correct(
     """
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     # Load the spaCy model
     nlp = spacy.load(spacy_model)
@@ -67,7 +73,6 @@ def textcat_correct(
         # Process the stream using spaCy's nlp.pipe, which yields doc objects.
         # If as_tuples=True is set, you can pass in (text, context) tuples.
         for doc, eg in nlp.pipe(texts, as_tuples=True, batch_size=10):
-            task = copy.deepcopy(eg)
             options = []
             selected = []
             for cat, score in doc.cats.items():
@@ -75,9 +80,7 @@ def textcat_correct(
                     options.append({"id": cat, "text": cat, "meta": f"{score:.2f}"})
                     if score >= threshold:
                         selected.append(cat)
-            task["options"] = options
-            task["accept"] = selected
-            yield task
+            yield derive_task(eg, options=options, accept=selected)
 
     # Update the model with the corrected examples.
     def make_update(answers):
@@ -96,6 +99,14 @@ def textcat_correct(
                 examples.append(Example.from_dict(doc, {"cats": cats}))
         nlp.update(examples)
 
+    # Skip examples that are already annotated in the dataset or in one of the
+    # excluded datasets before the model runs on them. The seen input hashes
+    # are kept in a persistent index that's updated with every batch of
+    # answers, so restarts don't need to read all annotations. Prodigy's own
+    # exclude filter still runs as the source of truth.
+    seen_inputs = SeenInputs(connect(), dataset, exclude)
+    stream = seen_inputs.filter(stream)
+
     # Add model's predictions to the tasks in the stream.
     stream = add_suggestions(stream)
 
@@ -105,6 +116,7 @@ def textcat_correct(
         "stream": stream,  # Incoming stream of examples
         "update": make_update if update else None,
         "exclude": exclude,  # List of dataset names to exclude
+        "before_db": seen_inputs.add,  # Add new answers to the index of seen inputs
         "config": {  # Additional config settings, mostly for app UI
             # Style of choice interface
             "choice_style": "single" if exclusive and len(label) > 1 else "multiple",
@@ -1,7 +1,11 @@
 import prodigy
-from prodigy.components.loaders import JSONL
 from prodigy.components.sorters import prefer_uncertain
 from prodigy.util import split_string
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import IndexedJSONL
 import random
 from typing import List, Iterable
 
@@ -52,7 +56,7 @@ def textcat_custom_model(dataset: str, source: str, label: List[str]):
     """
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     # Load the dummy model
     model = DummyModel(labels=label)
@@ -1,7 +1,11 @@
 from typing import List, Optional
 import prodigy
-from prodigy.components.loaders import JSONL
 from prodigy.util import split_string
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import IndexedJSONL
 
 
 # Helper functions for adding user provided labels to annotation tasks.
@@ -44,7 +48,7 @@ def textcat_manual(
 
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     #Add labels to each task in stream
     has_options = len(label) > 1
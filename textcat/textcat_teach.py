@@ -1,12 +1,18 @@
 from typing import List, Optional
+import threading
 import spacy
 from spacy.training import Example
 import prodigy
-from prodigy.components.loaders import JSONL
 from prodigy.models.textcat import TextClassifier
-from prodigy.models.matcher import PatternMatcher
 from prodigy.components.sorters import prefer_uncertain
 from prodigy.util import combine_models, split_string
+import sys
+from pathlib import Path
+# Make the shared components importable when the recipe is loaded with -F
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from components.loaders import IndexedJSONL
+from components.matchers import load_pattern_matcher
+from components.updates import UpdateScheduler, locked
 
 
 # Recipe decorator with argument annotations: (description, argument type,
@@ -37,7 +43,7 @@ def textcat_teach(
     labels = label
     # Load the stream from a JSONL file and return a generator that yields a
     # dictionary for each example in the data.
-    stream = JSONL(source)
+    stream = IndexedJSONL(source)
 
     # Load the spaCy model
     nlp = spacy.load(spacy_model)
@@ -68,28 +74,36 @@ def textcat_teach(
     else:
         # Initialize the pattern matcher and load in the JSONL patterns.
         # Set the matcher to not label the highlighted spans, only the text.
-        matcher = PatternMatcher(
+        # The phrase patterns are cached, so they're only tokenized once.
+        matcher = load_pattern_matcher(
             nlp,
+            patterns,
             prior_correct=5.0,
             prior_incorrect=5.0,
             label_span=False,
             label_task=True,
         )
-        matcher = matcher.from_disk(patterns)
         # Combine the NER model and the matcher and interleave their
         # suggestions and update both at the same time
         predict, update = combine_models(model, matcher)
 
+    # Queue the incoming answers and update the model on a dedicated worker
+    # thread, so submitting answers doesn't block. Answers that arrive while
+    # the model is updating are coalesced into larger minibatches. The lock
+    # makes sure the model isn't updated while it's predicting.
+    model_lock = threading.Lock()
+    update_scheduler = UpdateScheduler(update, lock=model_lock)
+
     # Use the prefer_uncertain sorter to focus on suggestions that the model
     # is most uncertain about (i.e. with a score closest to 0.5). The model
     # yields (score, example) tuples and the sorter yields just the example
-    stream = prefer_uncertain(predict(stream))
+    stream = prefer_uncertain(locked(predict(stream), model_lock))
 
     return {
         "view_id": "classification",  # Annotation interface to use
         "dataset": dataset,  # Name of dataset to save annotations
         "stream": stream,  # Incoming stream of examples
-        "update": update,  # Update callback, called with batch of answers
+        "update": update_scheduler,  # Update callback, called with batch of answers
         "exclude": exclude,  # List of dataset names to exclude
         "config": {"lang": nlp.lang},  # Additional config settings, mostly for app UI
     }
\ No newline at end of file
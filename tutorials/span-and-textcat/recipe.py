@@ -1,14 +1,31 @@
 import spacy
 import prodigy 
+from spacy.tokens import DocBin
 from prodigy.components.preprocess import add_tokens
 from prodigy.components.loaders import JSONL
 
 
+def docbin_stream(nlp, file_in):
+    """Examples from a .spacy file, with the tokens and spans of the stored
+    Docs, so the text doesn't need to be tokenized again."""
+    doc_bin = DocBin().from_disk(file_in)
+    for doc in doc_bin.get_docs(nlp.vocab):
+        tokens = [
+            {"text": t.text, "start": t.idx, "end": t.idx + len(t.text), "id": t.i, "ws": bool(t.whitespace_)}
+            for t in doc
+        ]
+        spans = [
+            {"start": ent.start_char, "end": ent.end_char, "token_start": ent.start, "token_end": ent.end - 1, "label": ent.label_}
+            for ent in doc.ents
+        ]
+        yield {"text": doc.text, "tokens": tokens, "spans": spans}
+
+
 @prodigy.recipe(
     "span-and-textcat",
     dataset=("Dataset to save annotations into", "positional", None, str),
     lang=("Language to use", "positional", None, str),
-    file_in=("Path to examples.jsonl file", "positional", None, str)
+    file_in=("Path to examples.jsonl or .spacy file", "positional", None, str)
 )
 def custom_recipe(dataset, lang, file_in):
     span_labels = ["product", "amount", "size", "type", "topping"]
@@ -22,8 +39,11 @@ def custom_recipe(dataset, lang, file_in):
             yield ex
 
     nlp = spacy.blank(lang)
-    stream = JSONL(file_in)
-    stream = add_tokens(nlp, stream, use_chars=None)
+    if file_in.endswith(".spacy"):
+        stream = docbin_stream(nlp, file_in)
+    else:
+        stream = JSONL(file_in)
+        stream = add_tokens(nlp, stream, use_chars=None)
 
     stream = add_options(stream)
     blocks = [